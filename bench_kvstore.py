@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Compare kvstore engines on N random 32-byte keys (default one million).
+
+    python bench_kvstore.py [N] [engine ...]
+"""
+import os, sys, tempfile, time
+import kvstore
+
+
+def bench(engine, keys, value):
+    with tempfile.TemporaryDirectory() as d:
+        db = kvstore.open_store(os.path.join(d, "db"), engine)
+        out = {}
+
+        t = time.perf_counter()
+        batch = 10000
+        for i in range(0, len(keys), batch):
+            db.put_many((k, value) for k in keys[i : i + batch])
+        out["put_many"] = len(keys), time.perf_counter() - t
+
+        t = time.perf_counter()
+        for k in keys:
+            db.get(k)
+        out["get"] = len(keys), time.perf_counter() - t
+
+        misses = [os.urandom(32) for _ in range(len(keys) // 10)]
+        t = time.perf_counter()
+        for k in misses:
+            k in db
+        out["contains(miss)"] = len(misses), time.perf_counter() - t
+
+        t = time.perf_counter()
+        n = sum(1 for _ in db.items())
+        out["items"] = n, time.perf_counter() - t
+        assert n == len(keys), (n, len(keys))
+
+        db.close()
+        return out
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    engines = sys.argv[2:] or list(kvstore.engines)
+    keys = [os.urandom(32) for _ in range(n)]
+    value = os.urandom(64)
+    for engine in engines:
+        r = bench(engine, keys, value)
+        print(
+            f"{engine:8} "
+            + "  ".join(
+                f"{k}={t:.2f}s ({ops / t:,.0f}/s)" for (k, (ops, t)) in r.items()
+            )
+        )
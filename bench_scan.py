@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Time Path.contents() on a synthetic source tree.
+
+    python bench_scan.py [N] [workers ...]
+
+Builds a tree of N small files (default 200k) in a temp dir, then scans it
+with each worker count, each time into a fresh cache (cold) and again into
+the same cache (warm).
+"""
+import os, sys, tempfile, time
+import cas, config, fs
+
+
+def make_tree(root, n, per_dir=100):
+    for i in range(n):
+        d = os.path.join(root, f"d{i // (per_dir * per_dir)}", f"d{i // per_dir}")
+        if i % per_dir == 0:
+            os.makedirs(d, exist_ok=True)
+        with open(os.path.join(d, f"f{i}.c"), "wb") as f:
+            f.write(b"int f%d() { return %d; }\n" % (i, i) * 40)
+
+
+def scan(workers, db_root):
+    config.init(db_root=db_root, src_root=src, scan_workers=workers)
+    t = time.perf_counter()
+    tree = fs.src_root.contents()
+    return cas.sig(tree), time.perf_counter() - t
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    worker_counts = [int(w) for w in sys.argv[2:]] or [1, os.cpu_count() or 1]
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "src")
+        make_tree(src, n)
+        time.sleep(fs.RACY_NS / 1e9)  # so directory info is recorded
+        sigs = set()
+        for workers in worker_counts:
+            db_root = os.path.join(tmp, f"db{workers}")
+            s, cold = scan(workers, db_root)
+            s2, warm = scan(workers, db_root)
+            sigs |= {s, s2}
+            print(f"{n} files, {workers} workers: cold {cold:.2f}s, warm {warm:.2f}s")
+        config.uninit()
+        assert len(sigs) == 1, sigs
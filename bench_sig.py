@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Measure the cost of hashing memo arguments that include a large Tree.
+
+"cold" is the cost of the first hash of a freshly built tree, which is what
+every memo call paid before sigs were cached on objects. "warm" is the cost
+of hashing the same argument tuple again.
+
+    python bench_sig.py [N]
+"""
+import sys, time
+import cas, fs
+
+
+def make_tree(n):
+    per_dir = 1000
+    dirs = {}
+    for d in range(0, n, per_dir):
+        entries = {}
+        for i in range(d, min(n, d + per_dir)):
+            content = cas.hash_bytes(b"file contents %d, long enough to hash" % i)
+            entries[f"f{i}.c"] = fs.Blob(content_sig=content)
+        dirs[f"d{d // per_dir}"] = fs.Tree(entries)
+    return fs.Tree(dirs)
+
+
+def timed(f):
+    t = time.perf_counter()
+    r = f()
+    return r, time.perf_counter() - t
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    tree = make_tree(n)
+    args = ((tree, "-O2"), {})
+    h0, cold = timed(lambda: cas.sig(args))
+    h1, warm = timed(lambda: cas.sig(args))
+    assert h0 == h1
+    print(f"{n} entries: cold {cold * 1000:.1f}ms, warm {warm * 1000:.3f}ms")
@@ -4,7 +4,7 @@ Main entry point
 """
 import logging, os, types, sys
 import fs, config, context
-import importer
+import importer, remote_cache
 
 
 src_root = os.path.abspath(os.path.join(__file__, "../test_data"))
@@ -35,3 +35,7 @@ if __name__ == "__main__":
     bin = b.main()
 
     bin.tree.write_copy(fs.out_root, makedirs=True)
+
+    # build summary
+    if remote_cache.summary() is not None:
+        print(remote_cache.summary())
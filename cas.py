@@ -19,16 +19,16 @@ One bit of the hash digest is reserved for distinguishing flat `bytes` from
 compound object hashes.
 
 This structure means:
-- We could lazily decode an object, though that isn't done yet.
+- We can lazily decode an object (see `Sig.object(lazy=True)`).
 - We can trace references for garbage collection without decoding the objects,
   just following hashes.
 
 
 FS hash cache
 -------------
-To avoid re-hashing large input files over and over, we keep a db of file
-hashes. This is a separate module that effectively just makes `stat()` very
-fast.
+To avoid re-hashing large input files over and over, we keep a cache of file
+hashes, loaded into memory at startup (see fs_sig_cache.py). This is a
+separate module that effectively just makes `stat()` very fast.
 
 
 Mode bits (+x)
@@ -47,6 +47,109 @@ that *does* track modes (like fs.py with Blob vs. XBlob) to get files with
 desired mode bits without incurring extra copies.
 
 
+Large blobs
+-----------
+Byte strings larger than `blob_file_threshold` (a config setting) are kept as
+files under `blob/` instead of in the db, the same place `store_file()` puts
+them. They're never held in memory unless someone asks for the bytes.
+`store_stream()` stores a stream this way, hashing it as it's copied.
+
+
+Chunked blobs
+-------------
+Optionally (`chunked_blob_threshold` in the config), byte strings above a size
+are split into content-defined chunks, and their sig is the hash of the list of
+chunk sigs. Each chunk is stored as its own bytes object, so near-identical
+versions of a large file share most of their storage. See `_chunk_end()`.
+
+A chunked blob is a compound object, so `Sig.is_bytes()` is False for it;
+`Sig.is_chunked()` tells them apart from other compound objects. Sigs made by
+hashing something know which they are. So do sigs of file contents (always
+bytes or chunked), so working out a blob's path doesn't take a lookup.
+
+
+Compression
+-----------
+With `compression` set in the config ("zlib" or "lzma"), bytes objects of at
+least `compress_threshold` bytes are compressed where they're stored, if that
+makes them at least 10% smaller. Hashes are always of the uncompressed data.
+
+- In the db, a compressed record starts with a 0 byte and a method byte (see
+  `_Z_METHODS`). Raw records that happen to start with 0 get a header too,
+  with method 0. Records from before compression existed have no header; if
+  one looks like it has a header but doesn't decode to its hash, it's taken
+  as raw. Compound records are lists of hashes and never compressed.
+- Large blobs go in `zblob/` as a method byte plus a gzip or xz stream,
+  instead of in `blob/`. Tools need plain files, so `blob_fspath()` and
+  materializing a `fs.Blob` decompress them into `blob/` (or `xblob/`) on
+  demand. Reading the bytes doesn't need the plain file.
+
+It's off by default: a blob that gets materialized is then kept twice,
+compressed and plain. So it pays off where most blobs are only read as
+bytes, not used as files.
+
+
+Hash algorithms
+---------------
+Long hashes are SHA-256 digests unless `hash_algorithm` in the config says
+otherwise (see `HASH_ALGORITHMS`):
+
+- "blake2b", "blake2s": BLAKE2 from hashlib, with 32-byte digests. Faster
+  than SHA-256 on machines without SHA instructions.
+- "blake2b-tree": BLAKE2b, except that data longer than TREE_LEAF is hashed
+  as a BLAKE2b tree: TREE_LEAF-sized leaves, hashed in parallel on the hash
+  pool, then a root over their digests (see `_TreeHash`).
+
+The first byte of a long hash still has the flag bits, and short bytes are
+still stored in their hash, whatever the algorithm. Hashes from different
+algorithms can't be mixed, so the algorithm of a cas_root is recorded in its
+`hash_algorithm` file when it's made, and opening it with another one is
+refused. Stores from before there was a choice are SHA-256.
+
+Sigs are cached in places that outlive `config.init` (e.g. `__sig__` on
+objects), so stick to one algorithm per process.
+
+
+Source files
+------------
+With `lazy_src_files` in the config, files under `src_root` aren't copied
+into the CAS when they're hashed (see `fs.Path.contents`). `store_file(...,
+lazy=True)` just records the file's path and stat key (as in fs_sig_cache)
+in `src_db`. Reads go straight to the source file as long as its stat key
+still matches. A CAS file is only made when a path is needed
+(`blob_fspath()`, materializing a `fs.Blob`), and then as a reflink where the
+filesystem supports it (see `_copy_file()`).
+
+If the source changes before its contents were needed, they're gone: the
+entry is dropped and the hash is no longer in the CAS. So sources count as
+present for reads, but not when deciding whether something needs storing
+(`CasDB.stored`): otherwise output with the same contents would go with them.
+
+Other stores can supply file contents the same way by adding themselves to
+`backing_stores`: objects with `has(h)` and `open(h)` (a binary file object,
+or None). See gitstore.py.
+
+Anything else missing (records too) can be fetched on demand by
+`fetch_missing`, e.g. from a remote cache (see remote_cache.py).
+
+
+Sharing cas_root between processes
+----------------------------------
+Any number of builds can use the same cas_root at once:
+
+- Files (blobs, and trees under `tree/`) are built under a temp name next to
+  their final path and renamed into place, so they appear complete or not at
+  all. Everything is named by content, so if two processes race, whichever
+  rename lands last wins and they're the same anyway.
+- Records are only ever added, with the same value for a key, so writers
+  never conflict. The sqlite engine handles concurrent writers itself; the
+  dbm engine locks its file around each operation (see kvstore.py).
+- Repacks take a lock (see pack.py).
+
+Deleting things (gc, `validate_cas` repairs) still has to be done while
+nothing else is running.
+
+
 Mutable objects
 ---------------
 It would be really nice if we could reliably ensure immutability. Unfortunately
@@ -170,9 +273,16 @@ Python is stupid
 - could keep the objects alive, but occasionally scan for objects with
   refcount==1
 """
-from typing import List
-import dbm, hashlib, logging, os, shutil, stat, sys, types
-import all_globals, config, fs_sig_cache, util
+from typing import Iterator, List
+import bisect, collections, collections.abc, concurrent.futures, contextlib, enum
+import gzip, hashlib, itertools, logging, lzma, mmap, os, secrets, shutil, stat
+import struct, sys, types, zlib
+import all_globals, config, existence, fs_sig_cache, kvstore, pack, util
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows
 
 
 logger = logging.getLogger(__name__)
@@ -181,79 +291,486 @@ HFLAG_LONG = 128
 HFLAG_COMPOUND = 64
 HFLAG_MASK = 63
 HASH_SIZE = 32
+BLOCKSIZE = 65536
+TREE_LEAF = 1 << 20  # leaf size for "blake2b-tree"
 
 _cas_db = None
 _cas_root = None
+_chunk_threshold = 0  # 0 = never chunk
+
+
+class WriteBatch:
+    """
+    CAS records waiting to be written by `CasDB.batch()`.
+    """
+
+    def __init__(self):
+        self.pending = {}  # hash -> bytes
+        self._after = []
+
+    def after_commit(self, f, *args):
+        """
+        Call `f(*args)` once this batch has been committed. Nothing is called
+        if the batch is abandoned.
+        """
+        self._after.append((f, args))
+
+
+# other places to find the contents of files; see "Source files"
+backing_stores = []
+
+# called with a long hash that isn't anywhere in the CAS; returns its bytes,
+# having stored them, or None. See remote_cache.py.
+fetch_missing = None
 
 
 class CasDB:
-    def __init__(self, cas_root):
-        self._db = dbm.open(os.path.join(cas_root, "cas_db"), "c")
+    def __init__(
+        self,
+        cas_root,
+        engine="sqlite",
+        blob_threshold=BLOCKSIZE,
+        compression="",
+        compress_threshold=256,
+        hash_algorithm="sha256",
+    ):
+        assert blob_threshold >= HASH_SIZE
+        check_hash_algorithm(cas_root, hash_algorithm)
+        self._root = cas_root
+        self.blob_threshold = blob_threshold
+        try:
+            self._method = _Z_NAMES[compression]
+        except KeyError:
+            raise ValueError(f"unknown compression {compression!r}") from None
+        self._compress_threshold = compress_threshold
+        self._db = kvstore.open_store(os.path.join(cas_root, "cas_db"), engine)
+        self._packs = pack.Packs(os.path.join(cas_root, "pack"))
+        self._sources = kvstore.open_store(os.path.join(cas_root, "src_db"), engine)
         self._cache = fs_sig_cache.FsSigCache(
             os.path.join(cas_root, "fs_sig_db"), hasher=_hash_file
         )
+        self._batch = None
+        self._exists = existence.ExistenceIndex(
+            os.path.join(cas_root, "exists.bloom"), self._all_hashes
+        )
 
     def close(self):
+        self._exists.close()
         self._db.close()
+        self._packs.close()
+        self._sources.close()
         self._cache.close()
 
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Collect all records stored inside the `with` block and write them in
+        one commit at the end. Records are readable from this CasDB as soon as
+        they're stored, but nobody else sees them until the commit.
+
+        If the block raises, the pending records are dropped.
+
+        Nested batches are folded into the outermost one.
+        """
+        if self._batch is not None:
+            yield self._batch
+            return
+
+        b = self._batch = WriteBatch()
+        try:
+            yield b
+        finally:
+            self._batch = None
+        if b.pending:
+            self._db.put_many((h, self._encode(h, v)) for (h, v) in b.pending.items())
+            for h in b.pending:
+                self._exists.add(h)
+        for (f, args) in b._after:
+            f(*args)
+
     def __setitem__(self, h, data):
         """
         Store raw byte contents of the given h.
         """
         assert isinstance(h, bytes)
-        assert isinstance(data, bytes)
+        assert isinstance(data, (bytes, memoryview))
         db = self._db
-        if (h[0] & HFLAG_LONG) and h not in db:
-            db[h] = data
+        batch = self._batch
+        # "absent" from the existence index may be wrong, but then we just
+        # store it again
+        exists = self._exists
+        if not (h[0] & HFLAG_LONG) or exists.present(h):
+            return  # data encoded in h, or already stored
+        absent = exists.absent(h)
+        if len(data) > self.blob_threshold and not (h[0] & HFLAG_COMPOUND):
+            # big blob: goes in a file. This isn't part of any batch, but
+            # that's fine, since it only means it may exist a little early.
+            if absent or not self._has_file(h):
+                z = self._compress(data, file=True)
+                if z is None:
+                    _write_new_file(self._fspath(h, "blob"), data)
+                else:
+                    _write_new_file(self._fspath(h, "zblob"), bytes([self._method]) + z)
+            exists.add(h, new=absent)
+        elif not absent and h in self._packs:
+            exists.add(h)  # already stored
+        elif batch is not None:
+            if h not in batch.pending and (absent or h not in db):
+                batch.pending[h] = bytes(data)
+        elif absent or h not in db:
+            db[h] = self._encode(h, bytes(data))
+            exists.add(h, new=absent)
         else:
-            # data encoded in h or already stored, nothing to do
-            ...
-
-        # TODO: can't store in a file here because we don't know the mode,
-        # but should check if file exists. Doing a stat() call every time
-        # we store some bytes would be expensive, though, so need an in-memory
-        # cache.
-        """
-            # store blobs in files since we usually need them there anyway
-            p = _blob_fspath(sig)
-            if os.path.isfile(p):
-                return
-            os.makedirs(os.path.dirname(p), exist_ok=True)
-            with open(p, "wb") as f:
-                f.write(data)
-        """
+            exists.add(h)  # already stored
 
     def __getitem__(self, h):
         n = h[0]
         if n & HFLAG_LONG:
             # stored in cache
             assert len(h) == HASH_SIZE, h
-            return self._db[h]
+            batch = self._batch
+            if batch is not None and h in batch.pending:
+                return batch.pending[h]
+            data = self.record(h)
+            if data is not None:
+                return data
+            f = self.open_file(h)
+            if f is None:
+                data = fetch_missing(h) if fetch_missing is not None else None
+                if data is None:
+                    raise KeyError(h)
+                return data
+            with f:
+                return f.read()
         else:
             # short string is encoded in the hash itself
             assert (n & HFLAG_MASK) == len(h)
             return h[1:]
 
     def __contains__(self, h):
-        return (h[0] & HFLAG_LONG) == 0 or h in self._db
+        if self.stored(h):
+            return True
+        # (not remembered as present, since these can go away)
+        return self._source(h) is not None or any(b.has(h) for b in backing_stores)
+
+    def stored(self, h):
+        """
+        Like `h in self`, but not counting source files and backing stores,
+        which can change or go away. For deciding whether to store something.
+        """
+        if (h[0] & HFLAG_LONG) == 0:
+            return True
+        batch = self._batch
+        if (batch is not None and h in batch.pending) or self._exists.present(h):
+            return True
+        if h in self._packs or h in self._db or self._has_file(h):
+            self._exists.add(h)
+            return True
+        return False
+
+    def record(self, h):
+        """
+        Return the db record for `h`, or None. Doesn't look at blob files.
+        """
+        v = self._packs.get(h)
+        if v is None:
+            v = self._db.get(h)
+            if v is None and self._packs.refresh():
+                # maybe someone just moved it into a new pack
+                v = self._packs.get(h)
+        if v and v[0] == 0 and not h[0] & HFLAG_COMPOUND:
+            v = _decode_record(h, v)
+        return v
+
+    def _encode(self, h, data):
+        # db value for record data; see "Compression"
+        if h[0] & HFLAG_COMPOUND:
+            return data
+        z = self._compress(data)
+        if z is not None:
+            return bytes([0, self._method]) + z
+        if data[:1] == b"\0":
+            return b"\0\0" + data
+        return data
+
+    def _compress(self, data, file=False):
+        # compressed data (in file format if `file`), or None if it's not
+        # worth it
+        if not self._method or len(data) < self._compress_threshold:
+            return None
+        z = _Z_METHODS[self._method][2 if file else 0](data)
+        return z if len(z) <= COMPRESS_RATIO * len(data) else None
+
+    def record_hashes(self):
+        # (may have duplicates)
+        return itertools.chain(self._packs.keys(), self._db.keys())
+
+    def discard_records(self, hs):
+        """
+        Delete loose db records. Packed records are only dropped by `repack`.
+        """
+        self._db.delete_many(hs)
+        self._exists.discard(hs)
+
+    def forget_present(self):
+        """
+        Forget which hashes are known to be present, and the Trees scanned
+        from directories (whose contents may be gone); for after deleting
+        things from the CAS directly (see cas_gc).
+        """
+        self._exists.clear_recent()
+        self._cache.forget_dirs()
+
+    def _all_hashes(self):
+        # every hash stored in the CAS proper, for rebuilding the existence
+        # index
+        yield from self.record_hashes()
+        for kind in ("blob", "xblob", "zblob"):
+            top = os.path.join(self._root, kind)
+            if not os.path.isdir(top):
+                continue
+            for d in os.scandir(top):
+                if not d.is_dir():
+                    continue
+                for e in os.scandir(d.path):
+                    try:
+                        h = bytes.fromhex(d.name + e.name)
+                    except ValueError:
+                        continue  # a temp file
+                    if len(h) == HASH_SIZE:
+                        yield h
+
+    def repack(self, keep=None):
+        """
+        Move the records in the db into a new pack (see pack.py). If `keep` is
+        given, also rewrite the existing packs, keeping only records for which
+        `keep(h)` is true.
+        """
+        taken = self._packs.repack(self._db.items(), keep=keep)
+        for i in range(0, len(taken), 10000):
+            self._db.delete_many(taken[i : i + 10000])
+        if keep is not None:
+            self._exists.clear_recent()
+
+    def _fspath(self, h, kind):
+        return os.path.join(self._root, _relpath(h, kind))
+
+    def blob_fspath(self, h):
+        """
+        Return the path of a file in the CAS holding the bytes for `h`, or None
+        if there isn't one. Compressed blobs are decompressed to `blob/` first.
+        """
+        if h[0] & HFLAG_COMPOUND:
+            return None
+        for kind in ("blob", "xblob"):
+            p = self._fspath(h, kind)
+            if os.path.exists(p):
+                return p
+        p = self._fspath(h, "blob")
+        tmp = f"{p}.{secrets.token_hex(4)}.tmp"
+        zp = self._fspath(h, "zblob")
+        if os.path.exists(zp):
+            f = _open_zblob(zp)
+        elif self._copy_source(h, tmp):
+            f = None  # already copied
+        else:
+            f = self._open_backing(h)
+            if f is None:
+                return None
+        if f is not None:
+            os.makedirs(os.path.dirname(p), exist_ok=True)
+            with f, open(tmp, "wb") as out:
+                shutil.copyfileobj(f, out)
+        _publish_file(tmp, p)
+        return p
+
+    def open_file(self, h):
+        """
+        Return a binary file object reading the bytes for `h` from a file in
+        the CAS, or None if there isn't one. Doesn't decompress to disk.
+        """
+        if h[0] & HFLAG_COMPOUND or not h[0] & HFLAG_LONG:
+            return None
+        for kind in ("blob", "xblob"):
+            try:
+                return open(self._fspath(h, kind), "rb")
+            except FileNotFoundError:
+                pass
+        try:
+            return _open_zblob(self._fspath(h, "zblob"))
+        except FileNotFoundError:
+            pass
+        src = self._source(h)
+        if src is not None:
+            path, key = src
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                f = None
+            if f is not None:
+                if fs_sig_cache._st_key_match(os.fstat(f.fileno()), key):
+                    return f
+                f.close()  # changed since we looked
+        return self._open_backing(h)
+
+    def _open_backing(self, h):
+        for b in backing_stores:
+            f = b.open(h)
+            if f is not None:
+                return f
+        return None
+
+    def map_file(self, h):
+        """
+        Return a read-only memoryview over an mmap of the uncompressed CAS
+        file for `h`, or None if there isn't one.
+        """
+        if h[0] & HFLAG_COMPOUND or not h[0] & HFLAG_LONG:
+            return None
+        for kind in ("blob", "xblob"):
+            try:
+                return _map_file(self._fspath(h, kind))
+            except FileNotFoundError:
+                pass
+        return None
+
+    def buffer(self, h):
+        """
+        Return the bytes for `h` as a read-only memoryview. Bytes in files are
+        mapped rather than read; compressed ones are decompressed to `blob/`
+        first (see `blob_fspath`).
+        """
+        v = self.map_file(h)
+        if v is None and self.blob_fspath(h) is not None:
+            v = self.map_file(h)
+        return v if v is not None else memoryview(self[h])
+
+    def _has_file(self, h):
+        if h[0] & HFLAG_COMPOUND or not h[0] & HFLAG_LONG:
+            return False
+        return any(
+            os.path.exists(self._fspath(h, kind)) for kind in ("blob", "xblob", "zblob")
+        )
+
+    def add_file(self, h, src, kind="blob", *, move=False, st=None):
+        """
+        Store the file at `src` as the contents of `h`, compressed if that's
+        worth it; otherwise as a plain file under `kind` (blob or xblob).
+        If `move` is true, `src` is a temp file we can take over. If `st` (the
+        stat result `h` was hashed from) is given, raises RuntimeError if
+        `src` changed before it was copied.
+        """
+        zp = self._fspath(h, "zblob")
+        tmp = f"{zp}.{secrets.token_hex(4)}.tmp"
+        if self._method and _compress_file(src, tmp, self._method):
+            _check_unchanged(src, st, tmp)
+            _publish_file(tmp, zp)
+            self._exists.add(h)
+            return
+        dst = self._fspath(h, kind)
+        if not move:
+            # copy to a temp name first, since other threads and processes
+            # may be storing the same contents
+            tmp = f"{dst}.{secrets.token_hex(4)}.tmp"
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            _copy_file(src, tmp)
+            _check_unchanged(src, st, tmp)
+            src = tmp
+        _publish_file(src, dst, 0o555 if kind == "xblob" else 0o444)
+        self._exists.add(h)
+
+    def add_source(self, h, path, st):
+        """
+        Record that source file `path`, as of stat result `st`, holds the
+        contents of `h` (see "Source files").
+        """
+        path = os.fsencode(os.path.abspath(path))
+        self._sources[h] = fs_sig_cache._st_key(st) + path
+
+    def _source(self, h):
+        # (path, stat key) of an unchanged source file holding h, or None
+        v = self._sources.get(h)
+        if v is None:
+            return None
+        key = v[: fs_sig_cache._ST_KEY_SIZE]
+        path = os.fsdecode(v[fs_sig_cache._ST_KEY_SIZE :])
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            st = None
+        if st is None or not fs_sig_cache._st_key_match(st, key):
+            self._sources.delete_many([h])
+            return None
+        return path, key
+
+    def copy_file(self, h, dst):
+        """
+        Copy an uncompressed file holding the bytes for `h` (in the CAS, or a
+        source file) to new file `dst`, as a reflink if possible. Returns
+        False, leaving no `dst`, if there's no such file.
+        """
+        if h[0] & HFLAG_COMPOUND or not h[0] & HFLAG_LONG:
+            return False
+        for kind in ("blob", "xblob"):
+            try:
+                _copy_file(self._fspath(h, kind), dst)
+                return True
+            except FileNotFoundError:
+                pass
+        return self._copy_source(h, dst)
+
+    def _copy_source(self, h, dst):
+        # copy the source file holding h to dst; False if there isn't one, or
+        # it changed while we copied
+        src = self._source(h)
+        if src is None:
+            return False
+        path, key = src
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        _copy_file(path, dst)
+        if not fs_sig_cache._st_key_match(os.stat(path), key):
+            os.remove(dst)
+            self._sources.delete_many([h])
+            return False
+        return True
+
+    def source_hashes(self):
+        return self._sources.keys()
+
+    def discard_sources(self, hs):
+        self._sources.delete_many(hs)
 
     def file_hash(self, path, *, st=None) -> bytes:
         return self._cache.hash(path, st)
 
+    def file_hashes(self, entries, pool=None) -> list:
+        # (see FsSigCache.hash_many)
+        return self._cache.hash_many(entries, pool)
+
+    def cached_file_hash(self, path, st):
+        # (None if it would have to be hashed)
+        return self._cache.lookup(path, st)
+
+    def dir_info(self, path, st):
+        return self._cache.dir_info(path, st)
+
+    def put_dir_info(self, path, st, info):
+        self._cache.put_dir_info(path, st, info)
+
 
 class Sig:
     """
     The content hash of some object.
     """
 
-    __slots__ = ("hash",)
+    __slots__ = ("hash", "_chunked")
 
-    def __init__(self, *, hash):
+    def __init__(self, *, hash, chunked=None):
         assert type(hash) is bytes
         assert len(hash) >= 1 and len(hash) <= HASH_SIZE
         assert (hash[0] & HFLAG_LONG) or (hash[0] & HFLAG_MASK) == len(hash)
         self.hash = hash
+        self._chunked = chunked  # for compound hashes, if known; see is_chunked
 
     def __repr__(self):
         return "{" + self.hash.hex()[:12] + "}"
@@ -264,15 +781,25 @@ class Sig:
     def __hash__(self):
         return self.hash.__hash__()
 
-    def object(self):
+    def object(self, lazy=False):
         """
         Find an object from its hash
+
+        If `lazy` is True, lists, tuples and dicts are returned as read-only
+        proxies (`LazyList`, `LazyDict`) which fetch and decode their elements
+        only when accessed. Instances are created right away, but their fields
+        are decoded lazily in the same way.
         """
         bits = self._get_bits()
         if self.is_bytes():
             return bits
+        parts = hsplit(bits)
+        if lazy:
+            return _deser_lazy(self, parts)
 
-        sub_objs = [h.object() for h in hsplit(bits)]
+        if parts[0] == _DICT_SUM:
+            _check_dict_sum(self, *parts[1:])
+        sub_objs = [h.object() for h in parts]
         first = sub_objs[0]
         if type(first) is bytes:
             return deserializers[first](*sub_objs[1:])
@@ -284,6 +811,20 @@ class Sig:
     def is_bytes(self):
         return (self.hash[0] & HFLAG_COMPOUND) == 0
 
+    def is_chunked(self):
+        """
+        True if this is the sig of a chunked blob. False for other compound
+        objects, and for chunked blobs that were never stored, unless the sig
+        was made knowing what it's of.
+        """
+        if self.is_bytes():
+            return False
+        if self._chunked is None:
+            if self.hash not in _cas_db:
+                return False
+            self._chunked = self._get_bits().startswith(_CHUNKED_PREFIX)
+        return self._chunked
+
     def is_short(self):
         """
         Return true for 'short' hashes, where the full serialization of
@@ -296,18 +837,31 @@ class Sig:
         """
         Get the uparsed bit string corresponding to a hash
         """
-        try:
-            return _cas_db[self.hash]
-        except KeyError:
-            # maybe it's in a file?
-            if self.is_bytes():
-                p = self.get_fspath(kind="blob")
-                if not os.path.exists(p):
-                    p = self.get_fspath(kind="xblob")
-                if os.path.exists(p):
-                    with open(p, "rb") as f:
-                        return f.read()
-            raise
+        return _cas_db[self.hash]
+
+    def buffer(self):
+        """
+        Return the contents of this bytes object or chunked blob as a
+        read-only memoryview, without copying them if they're in a CAS file.
+        """
+        if self.is_bytes():
+            return _cas_db.buffer(self.hash)
+        if not self.is_chunked():
+            raise TypeError(f"{self} is not a blob")
+        # chunked blobs only have a file of their own once materialized
+        for kind in ("blob", "xblob"):
+            try:
+                return _map_file(self.get_fspath(kind=kind))
+            except FileNotFoundError:
+                pass
+        return memoryview(b"".join(iter_bytes(self)))
+
+    def stored_fspath(self):
+        """
+        Return the path of a file in the CAS with the contents of this bytes
+        object, or None if it's only stored in the db (or not at all).
+        """
+        return _cas_db.blob_fspath(self.hash)
 
     # return path where blob or tree with the given sig should be materialized,
     # relative to cas root
@@ -331,13 +885,11 @@ class Sig:
                 )
             kind = mkind
 
-        if (kind == "tree") == (self.is_bytes()):
+        if (kind == "tree") == (self.is_bytes() or self.is_chunked()):
             raise ValueError(
                 f"wrong kind {kind} for {self} (is_bytes={self.is_bytes()})"
             )
-
-        s = self.hash.hex()
-        return "/".join((kind, s[:2], s[2:]))
+        return _relpath(self.hash, kind)
 
     def get_fspath(self, *, kind=None, st_mode=None):
         """
@@ -370,10 +922,78 @@ class WithSig:
         self.__sig__ = sig
 
 
+def _relpath(h, kind):
+    # path of a file of the given kind for h, relative to cas_root
+    s = h.hex()
+    return "/".join((kind, s[:2], s[2:]))
+
+
 def store(x):
     return sig(x, store=True)
 
 
+def store_stream(f) -> Sig:
+    """
+    Store the contents of a binary file object, hashing it as it's copied.
+
+    Equivalent to `store(f.read())`, except that large contents never have to
+    fit in memory.
+    """
+    data = f.read(_cas_db.blob_threshold + 1)
+    if len(data) <= _cas_db.blob_threshold:
+        return store(data)
+    if _chunk_threshold:
+        data += f.read(_chunk_threshold + 1 - len(data))
+        if len(data) > _chunk_threshold:
+            return _sig_chunks(_iter_chunks(f, data), store=True)
+
+    tmp = os.path.join(_cas_root, "tmp", secrets.token_hex(8))
+    os.makedirs(os.path.dirname(tmp), exist_ok=True)
+    hasher = _new_hash()
+    try:
+        with open(tmp, "wb") as out:
+            while data:
+                hasher.update(data)
+                out.write(data)
+                data = f.read(BLOCKSIZE)
+        s = _digest_sig(hasher.digest())
+        if not _cas_db.stored(s.hash):
+            _cas_db.add_file(s.hash, tmp, move=True)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return s
+
+
+def copy_file(s: Sig, dst) -> bool:
+    """
+    Copy the file holding the contents of bytes object `s` to new file `dst`,
+    as a reflink if possible. Returns False if the contents aren't in a plain
+    file (they're in the db, compressed, or chunked).
+    """
+    return _cas_db.copy_file(s.hash, os.fspath(dst))
+
+
+def file_backed(size):
+    """
+    True if bytes of the given size are stored in a file rather than the db.
+    """
+    return size > _cas_db.blob_threshold
+
+
+def write_batch():
+    """
+    Context manager which commits everything stored inside it at once:
+
+        with cas.write_batch() as batch:
+            s = cas.store(x)
+            batch.after_commit(publish, s)
+
+    See `CasDB.batch()`.
+    """
+    return _cas_db.batch()
+
+
 # @util.trace
 def sig(x, store=False):
     """
@@ -381,21 +1001,41 @@ def sig(x, store=False):
 
     If store is True, then the object will be retrievable from
     its signature later.
+
+    The result is remembered in `x.__sig__` for immutable types (see
+    `_remember_sig`), so hashing the same object again is O(1).
     """
 
     # reuse existing sig if possible
     s = getattr(x, "__sig__", None)
-    if s is not None and (not store or s.hash in _cas_db):
+    if type(s) is not Sig:
+        s = None  # e.g. the `__sig__` slot descriptor when x is a class
+    if s is not None and (not store or _cas_db.stored(s.hash)):
         return s
-
-    if type(x) is bytes:
+    if type(x) is types.FunctionType:
+        fn_sig = _cached_fn_sig(x)
+        if fn_sig is not None and (not store or _cas_db.stored(fn_sig.hash)):
+            return fn_sig
+
+    if type(x) is bytes or type(x) is memoryview:
+        # buffers hash (and store) the same as the bytes they hold
+        if _chunk_threshold and len(x) > _chunk_threshold:
+            return _sig_chunks(_buffer_chunks(memoryview(x).cast("B")), store)
         b, h = x, hash_bytes(x)
+    elif (type(x) is list or type(x) is tuple) and len(x) > ROPE_THRESHOLD:
+        b, h = _rope(x, store)
+    elif (type(x) is dict or type(x) is util.imdict) and len(x) > SUM_THRESHOLD:
+        b, h = _sum_dict(x, store)
     else:
         key, parts = _ser(x)
         if type(parts) is bytes:
             parts = (parts,)
         assert type(parts) is tuple
         b, h = _hcat(sig(key, store), *[sig(p, store) for p in parts])
+        if s is None:
+            _remember_sig(x, parts, h)
+        if key == b"F":
+            _cache_fn_sig(x, h)
 
     if store:
         _cas_db[h.hash] = b
@@ -404,6 +1044,49 @@ def sig(x, store=False):
     return h
 
 
+"""
+Caching signatures on objects
+
+Types can opt in to having their sig cached in a `__sig__` attribute by
+setting `_cache_sig = True` on the class (`imdict` is opted in here, since
+util can't depend on cas). Such types promise not to change once hashed, or
+to delete `__sig__` when they do (see `util.Struct`).
+
+Even then, an object is only as immutable as the things it refers to, so we
+only cache if every part it serialized to is itself frozen: a primitive, a
+tuple of frozen things, a type or module, or something that already has a
+cached sig. Lists and dicts returned by serializers (e.g. the key and value
+lists from `ser_dict`) are temporaries, so we look through them at their
+elements.
+"""
+
+_frozen_types = {bytes, str, int, bool, type(None), Sig}
+
+
+def _is_frozen(v):
+    ty = type(v)
+    if ty in _frozen_types:
+        return True
+    if ty is tuple:
+        return all(_is_frozen(e) for e in v)
+    if isinstance(v, (type, types.ModuleType, enum.Enum)):
+        return True
+    return getattr(v, "__sig__", None) is not None
+
+
+def _remember_sig(x, parts, h):
+    ty = type(x)
+    if ty is not util.imdict and not getattr(ty, "_cache_sig", False):
+        return
+    for p in parts:
+        if type(p) is list or type(p) is tuple:
+            if not all(_is_frozen(e) for e in p):
+                return
+        elif not _is_frozen(p):
+            return
+    x.__sig__ = h
+
+
 def _ser(x):
     # return key, parts
     assert type(x) is not bytes
@@ -440,25 +1123,29 @@ def _hcat(*sigs: Sig) -> bytes:
     for sig in sigs:
         assert isinstance(sig, Sig)
     b = b"".join(sig.hash for sig in sigs)
-    return b, hash_bytes(b, HFLAG_COMPOUND)
+    h = hash_bytes(b, HFLAG_COMPOUND)
+    h._chunked = b.startswith(_CHUNKED_PREFIX)
+    return b, h
 
 
 # inverse of _hcat
 def hsplit(b: bytes) -> List[Sig]:
+    return list(ihsplit(b))
+
+
+def ihsplit(b: bytes) -> Iterator[Sig]:
     i = 0
-    out = []
     while i < len(b):
         b0 = b[i]
         if b0 == 0:
+            i += 1
             continue  # pad byte
         if b0 & 128:
             n = HASH_SIZE
         else:
             n = b0 & HFLAG_MASK
-        h = b[i : i + n]
-        out.append(Sig(hash=h))
+        yield Sig(hash=b[i : i + n])
         i += n
-    return out
 
 
 def ser_unit(_):
@@ -493,8 +1180,7 @@ def deser_str(b):
 
 
 def ser_list(x):
-    # this format is arbitrarily large; better to use some
-    # kind of tree? or rely on the underlying bytes for that optimization?
+    # only for short lists; long ones are stored as ropes, see below
     return tuple(x)
 
 
@@ -509,6 +1195,221 @@ def deser_tuple(*xs):
     return xs
 
 
+"""
+Large lists
+
+Lists and tuples with more than ROPE_THRESHOLD elements are stored as a
+balanced tree of hashes (a "rope") rather than one flat record, so that a
+small edit only changes the records along one path to the root. Records are:
+
+    (b"RL", elem, elem, ...)            leaf: a run of elements
+    (b"RN", counts, node, node, ...)    inner node
+    (b"LR" or b"TR", counts, node, ...) root of a list or tuple
+
+`counts` is a bytes object of little-endian uint64s: the number of elements
+under each node. It lets a lazy list find element i without loading the
+whole thing.
+
+Runs are cut at content-defined points: after any element whose hash (crc32
+of its sig) is 0 mod ROPE_FANOUT, as long as the run has at least ROPE_MIN
+entries, and always at ROPE_MAX. Since each cut only depends on nearby
+elements, inserting or removing elements only changes the runs around the
+edit. Levels are built the same way until there are at most ROPE_MAX nodes,
+which go in the root.
+
+Node sigs are remembered in memory by the sigs of their children (up to
+ROPE_CACHE_MAX children in all), so rehashing a list after a small edit only
+hashes and stores the nodes on the path to it. Getting there still takes a
+sig for every element, which is free for elements that keep theirs (e.g.
+Trees) but a hash of each one otherwise: lists are mutable, so there's
+nothing else to tell us which elements changed.
+"""
+
+ROPE_THRESHOLD = 256
+ROPE_FANOUT = 32
+ROPE_MIN = 8
+ROPE_MAX = 128
+ROPE_CACHE_MAX = 1 << 18
+
+_rope_nodes = {}  # (key, child sigs...) -> node sig
+_rope_nodes_size = 0  # children in _rope_nodes
+
+
+def _rope(x, store):
+    # return (bits, sig) for the root record of a rope for list or tuple x
+    if not store:
+        return _build_rope(x, False)
+    # one commit for the whole thing; the caller writes the root after
+    with write_batch():
+        return _build_rope(x, True)
+
+
+def _build_rope(x, store):
+    sigs = [sig(e, store) for e in x]
+    counts = None  # elements under each of `sigs`; None while they're elements
+    while True:
+        nodes, node_counts = [], []
+        for (i, j) in _rope_runs(sigs):
+            if counts is None:
+                nodes.append(_rope_node(store, _ROPE_LEAF, sigs[i:j]))
+                node_counts.append(j - i)
+            else:
+                nodes.append(_rope_node(store, _ROPE_NODE, sigs[i:j], counts[i:j]))
+                node_counts.append(sum(counts[i:j]))
+        sigs, counts = nodes, node_counts
+        if len(sigs) <= ROPE_MAX:
+            break
+    key = _LIST_ROPE if type(x) is list else _TUPLE_ROPE
+    return _hcat(key, sig(_pack_counts(counts), store), *sigs)
+
+
+def _rope_runs(sigs):
+    # yield (start, end) of each run
+    start = 0
+    for (i, s) in enumerate(sigs):
+        n = i + 1 - start
+        if n >= ROPE_MAX or (
+            n >= ROPE_MIN and zlib.crc32(s.hash) % ROPE_FANOUT == 0
+        ):
+            yield start, i + 1
+            start = i + 1
+    if start < len(sigs):
+        yield start, len(sigs)
+
+
+def _rope_node(store, key, sigs, counts=None):
+    # sig of a leaf, or of an inner node with the given counts (which are
+    # determined by its children, so aren't part of the cache key)
+    global _rope_nodes_size
+    k = (key, *sigs)
+    h = _rope_nodes.get(k)
+    if h is not None and (not store or _cas_db.stored(h.hash)):
+        return h
+    if counts is not None:
+        k = (key, sig(_pack_counts(counts), store), *sigs)
+    b = b"".join(s.hash for s in k)
+    h = hash_bytes(b, HFLAG_COMPOUND)
+    if store:
+        _cas_db[h.hash] = b
+    if _rope_nodes_size + len(sigs) > ROPE_CACHE_MAX:
+        _rope_nodes.clear()
+        _rope_nodes_size = 0
+    _rope_nodes[(key, *sigs)] = h
+    _rope_nodes_size += len(sigs)
+    return h
+
+
+def _pack_counts(counts):
+    return struct.pack(f"<{len(counts)}Q", *counts)
+
+
+def _unpack_counts(b):
+    return struct.unpack(f"<{len(b) // 8}Q", b)
+
+
+def deser_rope_node(counts, *runs):
+    return [x for run in runs for x in run]
+
+
+def deser_list_rope(counts, *runs):
+    return deser_rope_node(counts, *runs)
+
+
+def deser_tuple_rope(counts, *runs):
+    return tuple(deser_rope_node(counts, *runs))
+
+
+"""
+Large dicts
+
+Dicts with more than SUM_THRESHOLD entries are hashed as an unordered set of
+entries, so an imdict made from another by changing a few entries can get
+its sig without rehashing the rest. Each entry (k, v) maps to a SUM_SIZE-byte
+digest, shake_256(sig(k) + sig(v)), and the dict's hash covers just the sum
+of those mod 2**(8 * SUM_SIZE). The record is:
+
+    (b"DS", sum, keys, values)
+
+where keys are sorted as for small dicts. Unlike other records, the hash
+only covers the first two parts; the rest is the content, which is
+determined by the sum. So the sum is recomputed from the entries whenever
+the record is decoded, and a record whose entries don't add up is refused.
+
+Entries are rehashed through shake_256 rather than summing their sigs
+directly, since short sigs are just inline data and would make it easy to
+find another set of entries with the same sum. The digest is wide enough
+that finding a collision by combining many entries isn't practical either.
+
+imdict keeps the sum in `__sum__` once computed. `imdict.updated()` etc.
+record the dict they were made from and which keys changed in `__base__`,
+and `_dict_sum` uses that to update the sum incrementally.
+"""
+
+SUM_THRESHOLD = 256
+SUM_SIZE = 256
+_SUM_MOD = 1 << (8 * SUM_SIZE)
+
+
+def _sum_dict(x, store):
+    # return (bits, sig) for a large dict; bits only has content if storing
+    total = _dict_sum(x)
+    b, h = _hcat(_DICT_SUM, sig(total.to_bytes(SUM_SIZE, "little"), store))
+    if store:
+        keys = sorted(x.keys())
+        b += sig(keys, True).hash + sig([x[k] for k in keys], True).hash
+    if getattr(x, "__sum__", None) is not None:
+        x.__sig__ = h
+    return b, h
+
+
+def _dict_sum(x):
+    # sum of entry digests of x, cached (and derived) for imdicts with frozen
+    # values
+    if type(x) is not util.imdict:
+        return _sum_entries(x, x.keys()) % _SUM_MOD
+    total = getattr(x, "__sum__", None)
+    if total is not None:
+        return total
+    base = getattr(x, "__base__", None)
+    if base is not None:
+        x.__base__ = None
+        d, ks = base
+        total = d.__sum__ - _sum_entries(d, ks) + _sum_entries(x, ks)
+        ok = all(_is_frozen(x[k]) for k in ks if k in x)
+    else:
+        total = _sum_entries(x, x.keys())
+        ok = all(_is_frozen(v) for v in x.values())
+    total %= _SUM_MOD
+    if ok:
+        x.__sum__ = total
+    return total
+
+
+def _sum_entries(d, ks):
+    return sum(_entry_digest(sig(k), sig(d[k])) for k in ks if k in d)
+
+
+def _entry_digest(k, v):
+    digest = hashlib.shake_256(k.hash + v.hash)
+    return int.from_bytes(digest.digest(SUM_SIZE), "little")
+
+
+def _check_dict_sum(s, total, ks, vs):
+    # raise unless the entries of the large dict stored as s add up to its
+    # sum (which is all its hash covers)
+    ks, vs = list(_list_sigs(ks)), list(_list_sigs(vs))
+    got = sum(map(_entry_digest, ks, vs)) % _SUM_MOD
+    if len(ks) != len(vs) or got.to_bytes(SUM_SIZE, "little") != total.object():
+        raise RuntimeError(f"hash mismatch in {s}")
+
+
+def deser_dict_sum(total, ks, vs):
+    d = deser_dict(ks, vs)
+    if all(_is_frozen(v) for v in vs):
+        d.__sum__ = int.from_bytes(total, "little")
+    return d
+
+
 def ser_dict(x):
     # must sort so insertion order doesn't affect hash
     keys = sorted(x.keys())
@@ -528,6 +1429,10 @@ def deser_sig(hash):
     return Sig(hash=hash)
 
 
+def deser_chunked(*chunks):
+    return b"".join(chunks)
+
+
 """
 Class instances serialize as (type, dict-keys, dict-values).
 
@@ -539,7 +1444,10 @@ def ser_instance(v):
     assert not isinstance(v, types.ModuleType)
     fields = getattr(v, "_ser_fields", None)
     if fields is Ellipsis:
-        return ser_dict(v.__dict__)
+        d = v.__dict__
+        if "__sig__" in d:
+            d = {k: x for (k, x) in d.items() if k != "__sig__"}
+        return ser_dict(d)
     elif fields is not None:
         return ser_dict({k: getattr(v, k) for k in fields})
     raise RuntimeError(f"no ser instance for {type(v)}")
@@ -572,8 +1480,10 @@ The implementation is:
   a global. We don't look everywhere; currently we require it to match by
   module and name.
 
-- Better: import an explicit list of modules and generate a reverse mapping
-  that doesn't need __module__ or __name__)
+- Found globals go in a reverse index, `_global_index`, from object id to
+  Global. When a module first turns up, all of its globals are indexed.
+  Entries are checked against the module on use, since names can be rebound
+  and ids reused; a miss falls back to looking at the module.
 
 - Instances of Global represents found globals; it serializes as an
   object instance, and deserializes by looking up the name.
@@ -603,22 +1513,42 @@ class Global:
         return sys.modules[str(module, "utf8")].__dict__[str(name, "utf8")]
 
 
+# id(obj) -> Global; see above
+_global_index = {}
+_indexed_modules = set()
+
+# types whose instances are never found as globals
+_never_global = {int, str, bytes, list, tuple, dict, util.imdict, Sig, type(None)}
+
+
 def find_global(obj):
     # if the given object is a global in its module,
     # serialize it by name instead of value
-    module = getattr(obj, "__module__", None)
-    if module is None:
-        return None
-    if module not in all_globals.valid_globals and not sys.modules[module].__dict__.get(
-        "__ALLOW_GLOBAL_REFS__", False
-    ):
+    if type(obj) in _never_global:
         return None
+    g = _global_index.get(id(obj))
+    if g is not None and sys.modules[g.module].__dict__.get(g.name) is obj:
+        return g
     name = getattr(obj, "__name__", None)
     if name is None:
         return None
-    if sys.modules[module].__dict__.get(name, None) is not obj:
+    module = getattr(obj, "__module__", None)
+    if module is None or module not in sys.modules:
+        return None
+    globals = sys.modules[module].__dict__
+    if globals.get(name, None) is not obj:
         return None
-    return Global(module, name)
+    if module not in all_globals.valid_globals and not globals.get(
+        "__ALLOW_GLOBAL_REFS__", False
+    ):
+        return None
+    if module not in _indexed_modules:
+        _indexed_modules.add(module)
+        for (k, v) in list(globals.items()):
+            if getattr(v, "__name__", None) == k and getattr(v, "__module__", None) == module:
+                _global_index[id(v)] = Global(module, k)
+    g = _global_index[id(obj)] = Global(module, name)
+    return g
 
 
 def ser_module(obj):
@@ -652,6 +1582,79 @@ def ser_code(code):
     )
 
 
+"""
+Function sig cache
+
+Hashing a function hashes its code, closure cells and every global it refers
+to, recursively, and functions get hashed a lot: every memoized call hashes
+the functions passed to it. So function sigs are cached in `_fn_sigs`, keyed
+by code object, globals and closure cells (by identity), and checked on use:
+each cell and referenced global must still be bound to the same object, and
+referenced functions must still have the same sig (which is cached too).
+
+That's only enough if the things referred to can't change, so functions that
+refer to mutable things (see `_is_frozen`) aren't cached.
+"""
+
+_fn_sigs = {}  # (code, id(globals), cell ids) -> (globals, cells, deps, sig)
+_FN_SIGS_MAX = 10000
+_UNBOUND = object()
+
+
+def _fn_key(f):
+    cells = f.__closure__ or ()
+    return (f.__code__, id(f.__globals__), tuple(id(c) for c in cells))
+
+
+def _cached_fn_sig(f):
+    e = _fn_sigs.get(_fn_key(f))
+    if e is None:
+        return None
+    globals, cells, deps, h = e
+    # deps: (cell index or global name, value, sig for functions or None)
+    for (name, old, old_sig) in deps:
+        if type(name) is int:
+            try:
+                v = cells[name].cell_contents
+            except ValueError:
+                return None  # cell was emptied
+        else:
+            v = globals.get(name, _UNBOUND)
+        if v is not old or (old_sig is not None and sig(v) != old_sig):
+            return None
+    return h
+
+
+def _cache_fn_sig(f, h):
+    # remember h as the sig of function f, if that's safe
+    cells = f.__closure__ or ()
+    globals = f.__globals__
+    deps = [(i, c.cell_contents, None) for (i, c) in enumerate(cells)]
+    deps.extend(
+        (name, globals.get(name, _UNBOUND), None)
+        for name in dict.fromkeys(_code_names(f.__code__))
+    )
+    for (i, (name, v, _)) in enumerate(deps):
+        if type(v) is types.FunctionType and find_global(v) is None:
+            deps[i] = (name, v, sig(v))  # hashed by value; check it's unchanged
+        elif not _fixed_sig(v):
+            return
+    if len(_fn_sigs) >= _FN_SIGS_MAX:
+        _fn_sigs.clear()
+    # keeping globals and cells alive keeps their ids from being reused
+    _fn_sigs[_fn_key(f)] = (globals, cells, deps, h)
+
+
+def _fixed_sig(v):
+    # true if v's sig can't change without it being rebound
+    return (
+        v is _UNBOUND
+        or _is_frozen(v)
+        or find_global(v) is not None
+        or serializers.get(type(v)) == (b"", ser_unit)  # e.g. loggers
+    )
+
+
 # Used when `name` was used in some function with env `globals`.
 def _lookup_global(name, globals):
     assert type(name) is str
@@ -718,9 +1721,258 @@ deserializers = {
     b"D": deser_dict,
     b"S": deser_sig,
     b"C": deser_instance,
+    b"B": deser_chunked,
+    b"RL": deser_list,
+    b"RN": deser_rope_node,
+    b"LR": deser_list_rope,
+    b"TR": deser_tuple_rope,
+    b"DS": deser_dict_sum,
+}
+
+
+"""
+Lazy deserialization
+
+Compound objects are stored as a list of hashes of their parts, so we can
+decode the outer layer of an object without touching anything else. With
+`Sig.object(lazy=True)`:
+
+- lists and tuples become `LazyList`, which keeps the element sigs and decodes
+  (and caches) each element on first access.
+- dicts become `LazyDict`, which fetches its keys on first use and decodes
+  values as they're looked up.
+- instances are created immediately, with their fields decoded lazily. So a
+  `Tree` gets a `LazyDict` for its entries, and a `Struct` holding a Tree only
+  reads the Tree's top level.
+- everything else decodes as normal.
+
+The proxies carry the `__sig__` they were loaded from, so hashing them again
+is free and doesn't force them to load.
+
+`iter_list()` streams the elements of a stored list without keeping them.
+"""
+
+_missing = object()
+
+
+def _deser_lazy(s, parts):
+    key = parts[0].object()
+    args = parts[1:]
+    if type(key) is bytes:
+        lazy_deser = lazy_deserializers.get(key)
+        if lazy_deser is not None:
+            return lazy_deser(s, args)
+        return deserializers[key](*[p.object(lazy=True) for p in args])
+
+    if hasattr(key, "__deser__"):
+        obj = key.__deser__(*[p.object(lazy=True) for p in args])
+    else:
+        ks, vs = args
+        obj = deser_instance(key, ks.object(), vs.object(lazy=True))
+    if getattr(type(obj), "_cache_sig", False):
+        obj.__sig__ = s
+    return obj
+
+
+class LazyList(collections.abc.Sequence):
+    """
+    Read-only stand-in for a stored list or tuple. Elements are fetched from
+    the CAS when first accessed.
+    """
+
+    __slots__ = ("__sig__", "_kind", "_sigs", "_items")
+
+    def __init__(self, sig, kind, sigs):
+        self.__sig__ = sig
+        self._kind = kind  # list or tuple: what we compare equal to
+        self._sigs = sigs
+        self._items = [_missing] * len(sigs)
+
+    def __len__(self):
+        return len(self._sigs)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self._kind(self[j] for j in range(*i.indices(len(self))))
+        v = self._items[i]
+        if v is _missing:
+            v = self._items[i] = self._sigs[i].object(lazy=True)
+        return v
+
+    def __eq__(self, other):
+        if type(other) is LazyList:
+            return self.__sig__ == other.__sig__
+        if not isinstance(other, self._kind):
+            return NotImplemented
+        return len(other) == len(self) and all(a == b for (a, b) in zip(self, other))
+
+    def __hash__(self):
+        return hash(self.__sig__)
+
+    def __repr__(self):
+        return f"Lazy{self._kind(self)!r}"
+
+
+class LazyDict(collections.abc.Mapping):
+    """
+    Read-only stand-in for a stored dict. The keys are fetched on first use;
+    values are fetched when looked up.
+    """
+
+    __slots__ = ("__sig__", "_ks", "_vs", "_index", "_sum")
+
+    def __init__(self, sig, ks, vs, total=None):
+        self.__sig__ = sig
+        self._ks = ks
+        self._vs = vs
+        self._index = None
+        self._sum = total  # for large dicts, to check the entries against
+
+    def _keys(self):
+        if self._index is None:
+            if self._sum is not None:
+                _check_dict_sum(self.__sig__, self._sum, self._ks, self._vs)
+            ks = self._ks.object()
+            self._vs = self._vs.object(lazy=True)
+            assert len(ks) == len(self._vs)
+            self._index = {k: i for (i, k) in enumerate(ks)}
+        return self._index
+
+    def __getitem__(self, k):
+        i = self._keys()[k]
+        return self._vs[i]
+
+    def __contains__(self, k):
+        return k in self._keys()
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._keys())
+
+    def __eq__(self, other):
+        if type(other) is LazyDict:
+            return self.__sig__ == other.__sig__
+        return super().__eq__(other)
+
+    def __hash__(self):
+        return hash(self.__sig__)
+
+    def __repr__(self):
+        return f"Lazy{dict(self.items())!r}"
+
+
+def _lazy_list(kind):
+    def deser(s, parts):
+        return LazyList(s, kind, parts)
+
+    return deser
+
+
+def _lazy_dict(s, parts):
+    ks, vs = parts
+    return LazyDict(s, ks, vs)
+
+
+def _lazy_dict_sum(s, parts):
+    total, ks, vs = parts
+    return LazyDict(s, ks, vs, total)
+
+
+class _RopeSigs:
+    """
+    The element sigs of a rope, as a read-only sequence. Looking up an
+    element loads the nodes on the path to it, and no others.
+    """
+
+    def __init__(self, parts):
+        self._root = self._parse_inner(parts)
+        self._len = self._root[0][-1] if self._root[0] else 0
+        self._nodes = {}
+
+    @staticmethod
+    def _parse_inner(parts):
+        counts, *children = parts
+        return list(itertools.accumulate(_unpack_counts(counts.object()))), children
+
+    def _node(self, s):
+        node = self._nodes.get(s)
+        if node is None:
+            parts = hsplit(s._get_bits())
+            if parts[0] == _ROPE_LEAF:
+                node = None, parts[1:]
+            else:
+                node = self._parse_inner(parts[1:])
+            self._nodes[s] = node
+        return node
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError(i)
+        ends, children = self._root
+        while ends is not None:
+            k = bisect.bisect_right(ends, i)
+            if k:
+                i -= ends[k - 1]
+            ends, children = self._node(children[k])
+        return children[i]
+
+
+def _lazy_rope(kind):
+    def deser(s, parts):
+        return LazyList(s, kind, _RopeSigs(parts))
+
+    return deser
+
+
+lazy_deserializers = {
+    b"L": _lazy_list(list),
+    b"T": _lazy_list(tuple),
+    b"LR": _lazy_rope(list),
+    b"TR": _lazy_rope(tuple),
+    b"D": _lazy_dict,
+    b"DS": _lazy_dict_sum,
 }
 
 
+def iter_list(s: Sig, lazy=True):
+    """
+    Yield the elements of the list or tuple stored as `s` one at a time,
+    without holding on to them.
+    """
+    for p in _list_sigs(s):
+        yield p.object(lazy=lazy)
+
+
+def _list_sigs(s):
+    # iterate over the element sigs of the list or tuple stored as s
+    parts = ihsplit(s._get_bits())
+    key = next(parts).object()
+    if key in (b"LR", b"TR"):
+        next(parts)  # counts
+        return _iter_rope(parts)
+    elif key not in (b"L", b"T"):
+        raise TypeError(f"{s} is not a list or tuple")
+    return parts
+
+
+def _iter_rope(nodes):
+    # yield element sigs under the given rope nodes
+    for n in nodes:
+        parts = ihsplit(n._get_bits())
+        if next(parts) == _ROPE_LEAF:
+            yield from parts
+        else:
+            next(parts)  # counts
+            yield from _iter_rope(parts)
+
+
 def _byte_length(i: int):
     if i == 0:
         return 0
@@ -732,47 +1984,549 @@ def _byte_length(i: int):
 
 def hash_bytes(data: bytes, flags: int = 0) -> Sig:
     if len(data) <= 31:
-        h = bytes([len(data) + 1 | flags]) + data
-    else:
-        h = bytearray(hashlib.sha256(data).digest())
-        h[0] = HFLAG_LONG | flags | (h[0] & 63)
-        h = bytes(h)
-    return Sig(hash=h)
+        return Sig(hash=bytes([len(data) + 1 | flags]) + data)
+    return _digest_sig(_new_hash(data).digest(), flags)
 
 
 def hash_byte_stream(f, flags: int = 0) -> Sig:
-    BLOCKSIZE = 65536
     data = f.read(BLOCKSIZE)
     if len(data) < BLOCKSIZE:
         return hash_bytes(data, flags)
-    hasher = hashlib.sha256()
+    hasher = _new_hash()
     while data:
         hasher.update(data)
         data = f.read(BLOCKSIZE)
-    h = bytearray(hasher.digest())
+    return _digest_sig(hasher.digest(), flags)
+
+
+class _TreeHash:
+    """
+    Hashlib-style hasher for "blake2b-tree" (see "Hash algorithms"). Leaves
+    are hashed on the hash pool as soon as they're complete, straight from
+    the data passed to `update`, so that mustn't change until `digest()`.
+    """
+
+    def __init__(self, data=b""):
+        self._buf = bytearray()
+        self._digests = []
+        self._pending = collections.deque()  # futures of leaf digests
+        self.update(data)
+
+    def update(self, data):
+        data = memoryview(data).cast("B")
+        i = 0
+        if self._buf:
+            i = TREE_LEAF - len(self._buf)
+            self._buf += data[:i]
+            if len(data) <= i:
+                return
+            self._leaf(bytes(self._buf))
+            self._buf.clear()
+        # whole leaves straight from data, keeping a partial last leaf (and
+        # so at least one byte) for later
+        while len(data) - i > TREE_LEAF:
+            self._leaf(data[i : i + TREE_LEAF])
+            i += TREE_LEAF
+        self._buf += data[i:]
+
+    def _leaf(self, leaf):
+        n = len(self._digests) + len(self._pending)
+        self._pending.append(_pool().submit(_tree_node, leaf, n, 0, False))
+        if len(self._pending) > 2 * (os.cpu_count() or 1):
+            self._digests.append(self._pending.popleft().result())
+
+    def digest(self):
+        if not self._digests and not self._pending:
+            return hashlib.blake2b(self._buf, digest_size=HASH_SIZE).digest()
+        digests = self._digests + [f.result() for f in self._pending]
+        digests.append(_tree_node(bytes(self._buf), len(digests), 0, True))
+        return _tree_node(b"".join(digests), 0, 1, True)
+
+
+def _tree_node(data, offset, depth, last):
+    return hashlib.blake2b(
+        data,
+        digest_size=HASH_SIZE,
+        fanout=0,
+        depth=2,
+        leaf_size=TREE_LEAF,
+        inner_size=HASH_SIZE,
+        node_offset=offset,
+        node_depth=depth,
+        last_node=last,
+    ).digest()
+
+
+HASH_ALGORITHMS = {
+    "sha256": hashlib.sha256,
+    "blake2b": lambda data=b"": hashlib.blake2b(data, digest_size=HASH_SIZE),
+    "blake2s": hashlib.blake2s,
+    "blake2b-tree": _TreeHash,
+}
+_hash_algorithm = "sha256"
+_new_hash = hashlib.sha256
+
+
+def use_hash_algorithm(name):
+    """
+    Hash with algorithm `name` from now on (see "Hash algorithms"); `init`
+    does this from the config.
+    """
+    global _hash_algorithm, _new_hash
+    try:
+        _new_hash = HASH_ALGORITHMS[name]
+    except KeyError:
+        raise ValueError(f"unknown hash algorithm {name!r}") from None
+    if name != _hash_algorithm:
+        _fn_sigs.clear()
+        _rope_nodes.clear()
+    _hash_algorithm = name
+
+
+def hash_algorithm():
+    return _hash_algorithm
+
+
+def check_hash_algorithm(root, name):
+    """
+    Record `name` as the hash algorithm of the store at `root` if it's new,
+    else raise ValueError unless it's the one recorded.
+    """
+    if name not in HASH_ALGORITHMS:
+        raise ValueError(f"unknown hash algorithm {name!r}")
+    path = os.path.join(root, "hash_algorithm")
+    if not os.path.exists(path):
+        # a store from before this was recorded is SHA-256
+        used = any(
+            e.name != "tmp" and not e.name.startswith("hash_algorithm")
+            for e in os.scandir(root)
+        )
+        tmp = f"{path}.{secrets.token_hex(4)}.tmp"
+        with open(tmp, "w") as f:
+            f.write("sha256" if used else name)
+        try:
+            os.link(tmp, path)  # (if another process got there first, use theirs)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+    with open(path) as f:
+        recorded = f.read().strip()
+    if recorded != name:
+        raise ValueError(f"{root} uses {recorded} hashes, not {name}")
+
+
+# make a long hash from a raw digest
+def _digest_sig(digest, flags: int = 0) -> Sig:
+    h = bytearray(digest)
     h[0] = HFLAG_LONG | flags | (h[0] & HFLAG_MASK)
     return Sig(hash=bytes(h))
 
 
+# write a file that is supposed to be new. Files in the CAS are read-only.
+def _write_new_file(path, data, mode=0o444):
+    tmp = f"{path}.{secrets.token_hex(4)}.tmp"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(tmp, "wb") as f:
+        f.write(data)
+    _publish_file(tmp, path, mode)
+
+
+# for copies of files hashed earlier: raise if `src` changed since stat
+# result `st`, deleting the copy at `tmp`
+def _check_unchanged(src, st, tmp):
+    if st is None:
+        return
+    if not fs_sig_cache._st_key_match(os.stat(src), fs_sig_cache._st_key(st)):
+        os.remove(tmp)
+        raise RuntimeError(f"{src} changed while it was being stored")
+
+
+# atomically move a finished file into place. If someone else got there
+# first, theirs has the same contents, so keep it (Windows can't replace a
+# read-only file anyway).
+def _publish_file(tmp, path, mode=0o444):
+    os.chmod(tmp, mode)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        os.replace(tmp, path)
+    except PermissionError:
+        if not os.path.exists(path):
+            raise
+        os.chmod(tmp, stat.S_IWUSR | stat.S_IRUSR)
+        os.remove(tmp)
+
+
+# compression methods (see "Compression"):
+#   id -> (compress, decompress, compress for files, open)
+# where `open(f, mode)` wraps a file object positioned after the method byte
+_Z_METHODS = {
+    1: (
+        zlib.compress,
+        zlib.decompress,
+        lambda data: gzip.compress(data, compresslevel=6, mtime=0),
+        lambda f, mode: gzip.GzipFile(fileobj=f, mode=mode, compresslevel=6, mtime=0),
+    ),
+    2: (
+        lzma.compress,
+        lzma.decompress,
+        lzma.compress,
+        lambda f, mode: lzma.LZMAFile(f, mode),
+    ),
+}
+_Z_NAMES = {"": 0, "zlib": 1, "lzma": 2}
+COMPRESS_RATIO = 0.9
+
+
+def _decode_record(h, v):
+    # data for db value v, which starts with a 0 byte
+    method = v[1] if len(v) > 1 else None
+    try:
+        data = v[2:] if method == 0 else _Z_METHODS[method][1](v[2:])
+    except (KeyError, zlib.error, lzma.LZMAError):
+        return v  # raw record from before compression
+    if hash_bytes(data).hash != h:
+        return v
+    return data
+
+
+# ioctl to make a copy-on-write clone of a file (Linux: btrfs, xfs, ...)
+_FICLONE = 0x40049409
+
+
+def _copy_file(src, dst):
+    # copy to new file `dst`: as a reflink if the filesystem can do that,
+    # else with copy_file_range (no copying through user space), else by
+    # reading and writing
+    with open(src, "rb", buffering=0) as fin, open(dst, "xb", buffering=0) as fout:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fout.fileno(), _FICLONE, fin.fileno())
+                return
+            except OSError:
+                pass
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(fin.fileno(), fout.fileno(), 1 << 30):
+                    pass
+                return
+            except OSError:
+                pass  # e.g. across filesystems on old kernels; carry on below
+        shutil.copyfileobj(fin, fout, BLOCKSIZE)
+
+
+def _map_file(path):
+    # read-only memoryview of a whole file; the mapping is released along
+    # with the last view of it
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(b"")  # can't mmap an empty file
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def _open_zblob(path):
+    f = open(path, "rb")
+    try:
+        return _Z_METHODS[f.read(1)[0]][3](f, "rb")
+    except BaseException:
+        f.close()
+        raise
+
+
+def _compress_file(src, dst, method):
+    # compress file src to dst; return False (writing nothing) if it doesn't
+    # compress well, judging by the first few blocks
+    with open(src, "rb") as f:
+        data = f.read(16 * BLOCKSIZE)
+        z = _Z_METHODS[method][0](data)
+        if len(z) > COMPRESS_RATIO * len(data):
+            return False
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        with open(dst, "wb") as raw:
+            raw.write(bytes([method]))
+            with _Z_METHODS[method][3](raw, "wb") as out:
+                out.write(data)
+                shutil.copyfileobj(f, out)
+    return True
+
+
+"""
+Chunking
+
+Cut points are found with a "gear" rolling hash: each byte shifts the hash left
+one bit and adds a random 64-bit value for that byte. So the top bits of the
+hash only depend on the last 64 bytes, and after an insertion or deletion the
+cut points fall back in step with the old ones within one chunk.
+
+Chunks are at least CHUNK_MIN bytes (we don't look for cut points before
+that), at most CHUNK_MAX, and average about 64 KiB.
+
+The rolling hash runs in Python and is the slow part; hashing the chunks is
+done on a thread pool while the next cut is being found.
+"""
+
+CHUNK_MIN = 16 * 1024
+CHUNK_MAX = 256 * 1024
+_CHUNK_MASK = 0xFFFF << 48
+_GEAR = [
+    int.from_bytes(hashlib.sha256(b"gear%d" % i).digest()[:8], "little")
+    for i in range(256)
+]
+_CHUNKED_PREFIX = hash_bytes(b"B").hash
+
+# record keys for ropes (see "Large lists")
+_ROPE_LEAF = hash_bytes(b"RL")
+_ROPE_NODE = hash_bytes(b"RN")
+_LIST_ROPE = hash_bytes(b"LR")
+_TUPLE_ROPE = hash_bytes(b"TR")
+_DICT_SUM = hash_bytes(b"DS")
+
+_hash_pool = None
+
+
+def _chunk_end(buf, i, n):
+    # return the end of the chunk starting at buf[i], not looking past n
+    end = min(n, i + CHUNK_MAX)
+    p = i + CHUNK_MIN
+    if p >= end:
+        return end
+    h = 0
+    gear, mask = _GEAR, _CHUNK_MASK
+    for b in buf[p:end]:
+        h = ((h << 1) + gear[b]) & 0xFFFFFFFFFFFFFFFF
+        p += 1
+        if not h & mask:
+            return p
+    return end
+
+
+def _iter_chunks(f, buf=b""):
+    # split a stream into chunks; `buf` is data already read from f
+    i = 0
+    eof = False
+    while True:
+        if not eof and len(buf) - i < CHUNK_MAX:
+            more = f.read(4 * CHUNK_MAX)
+            eof = not more
+            buf = buf[i:] + more
+            i = 0
+            continue
+        if i >= len(buf):
+            return
+        end = _chunk_end(buf, i, len(buf))
+        yield buf[i:end]
+        i = end
+
+
+def _buffer_chunks(buf):
+    # split a buffer into chunks, as `_iter_chunks` would, without copying
+    i = 0
+    while i < len(buf):
+        end = _chunk_end(buf, i, len(buf))
+        yield buf[i:end]
+        i = end
+
+
+def _pool():
+    global _hash_pool
+    if _hash_pool is None:
+        _hash_pool = concurrent.futures.ThreadPoolExecutor(
+            thread_name_prefix="cas-hash"
+        )
+    return _hash_pool
+
+
+def _sig_chunks(chunks, store) -> Sig:
+    # hash chunks in parallel (hashlib releases the GIL), storing new ones
+    pool = _pool()
+    window = 2 * (os.cpu_count() or 1)
+    pending = collections.deque()
+    sigs = []
+
+    def finish():
+        data, fut = pending.popleft()
+        s = fut.result()
+        if store:
+            _cas_db[s.hash] = data
+        sigs.append(s)
+
+    for data in chunks:
+        pending.append((data, pool.submit(hash_bytes, data)))
+        if len(pending) > window:
+            finish()
+    while pending:
+        finish()
+
+    b, h = _hcat(Sig(hash=_CHUNKED_PREFIX), *sigs)
+    if store:
+        _cas_db[h.hash] = b
+    return h
+
+
+def iter_bytes(s: Sig):
+    """
+    Yield the contents of a bytes or chunked blob object in pieces, without
+    loading all of it at once. Pieces are bytes-like; an uncompressed CAS file
+    comes as a single mapped memoryview.
+    """
+    if not s.is_bytes():
+        parts = ihsplit(s._get_bits())
+        if next(parts).hash != _CHUNKED_PREFIX:
+            raise TypeError(f"{s} is not a blob")
+        for p in parts:
+            yield _cas_db.buffer(p.hash)
+        return
+    v = _cas_db.map_file(s.hash)
+    if v is not None:
+        yield v
+        return
+    f = _cas_db.open_file(s.hash)
+    if f is None:
+        yield s._get_bits()
+        return
+    with f:
+        while True:
+            data = f.read(BLOCKSIZE)
+            if not data:
+                return
+            yield data
+
+
 # raw hasher
-def _hash_file(fspath) -> bytes:
+def _hash_file(fspath, store=True) -> bytes:
     with open(fspath, "rb") as f:
+        if _chunk_threshold and os.fstat(f.fileno()).st_size > _chunk_threshold:
+            # this is the one time we read the file, so store chunks as we go
+            return _sig_chunks(_iter_chunks(f), store=store).hash
         return hash_byte_stream(f).hash
 
 
+def file_sig(fspath) -> Sig:
+    """
+    Return the sig the contents of a file would be stored under, without
+    storing anything or using the fs sig cache.
+    """
+    return Sig(hash=_hash_file(fspath, store=False), chunked=True)
+
+
+def verify_record(h, bits, *, shallow=False) -> bool:
+    """
+    Check that `bits` are the right contents for the db record of long hash `h`.
+
+    A large dict's hash only covers its sum (see "Large dicts"), so its keys
+    and values lists are read from the CAS to check its entries against it,
+    and must be there. `shallow` skips that, checking just what's hashed.
+    """
+    if not h[0] & HFLAG_COMPOUND:
+        return hash_bytes(bits).hash == h
+    if not bits.startswith(_DICT_SUM.hash):
+        return hash_bytes(bits, HFLAG_COMPOUND).hash == h
+    parts = hsplit(bits)
+    if len(parts) != 4:
+        return False
+    if hash_bytes(parts[0].hash + parts[1].hash, HFLAG_COMPOUND).hash != h:
+        return False
+    if shallow:
+        return True
+    try:
+        _check_dict_sum(Sig(hash=h), *parts[1:])
+    except (KeyError, TypeError, RuntimeError):
+        return False
+    return True
+
+
+def verify_file(h, fspath, *, compressed=False) -> bool:
+    """
+    Check that the file at `fspath` has the contents for long hash `h`.
+    `compressed` is for files from `zblob/`.
+    """
+    f = _open_zblob(fspath) if compressed else open(fspath, "rb")
+    with f:
+        if h[0] & HFLAG_COMPOUND:
+            # a materialized chunked blob
+            return _sig_chunks(_iter_chunks(f), store=False).hash == h
+        return hash_byte_stream(f).hash == h
+
+
 # equivalent to store(read(file)), but does a copy instead of read/write
-def store_file(path, st=None) -> Sig:
+def store_file(path, st=None, *, lazy=False) -> Sig:
+    """
+    Store the contents of the file at `path`. If `lazy`, the file is only
+    recorded, and copied when a CAS path is needed (see "Source files").
+    """
     path = os.fspath(path)
     if st is None:
         st = os.stat(path)
-    sig = Sig(hash=_cas_db.file_hash(path, st=st))
-    dst = sig.get_fspath(st_mode=st.st_mode)
-    if not os.path.exists(dst):
-        os.makedirs(os.path.dirname(dst), exist_ok=True)
-        shutil.copyfile(path, dst)
+    # (file contents are bytes or a chunked blob)
+    s = Sig(hash=_cas_db.file_hash(path, st=st), chunked=True)
+    return _store_hashed(path, st, s, lazy)
+
+
+def store_files(entries, *, lazy=False, pool=None) -> list:
+    """
+    `store_file` for each (path, stat result) in `entries`, hashing them
+    together (see `FsSigCache.hash_many`) and doing the work on `pool` (an
+    Executor) if given. Returns a list with the Sig for each entry, or the
+    exception we got for it.
+    """
+    entries = [(os.fspath(p), st) for (p, st) in entries]
+    hashes = _cas_db.file_hashes(entries, pool)
+
+    def store(i):
+        h = hashes[i]
+        if isinstance(h, Exception):
+            return h
+        (path, st) = entries[i]
+        try:
+            return _store_hashed(path, st, Sig(hash=h, chunked=True), lazy)
+        except (OSError, RuntimeError) as e:
+            return e
+
+    return list((pool.map if pool is not None else map)(store, range(len(entries))))
+
+
+def _store_hashed(path, st, sig, lazy):
+    if not sig.is_bytes():
+        # chunked: chunks were stored when the file was hashed, unless the
+        # hash came from the cache and they've gone since
+        if not _cas_db.stored(sig.hash):
+            with open(path, "rb") as f:
+                _sig_chunks(_iter_chunks(f), store=True)
+        return sig
+    if not sig.hash[0] & HFLAG_LONG:
+        return sig  # contents are in the hash
+    kind = sig.get_relpath(st_mode=st.st_mode).split("/")[0]
+    if not os.path.exists(sig.get_fspath(kind=kind)) and not os.path.exists(
+        sig.get_fspath(kind="zblob")
+    ):
+        if lazy:
+            _cas_db.add_source(sig.hash, path, st)
+        else:
+            _cas_db.add_file(sig.hash, path, kind, st=st)
     return sig
 
 
+def cached_file_sig(path, st):
+    """
+    Return the sig of the file at `path` from the fs sig cache if its stat
+    result is still `st`, else None. Doesn't hash or store anything.
+    """
+    h = _cas_db.cached_file_hash(os.fspath(path), st)
+    return Sig(hash=h, chunked=True) if h is not None else None
+
+
+def dir_info(path, st):
+    """
+    Return what `put_dir_info` recorded for directory `path`, if its stat
+    result is still `st`, else None.
+    """
+    return _cas_db.dir_info(os.fspath(path), st)
+
+
+def put_dir_info(path, st, info: bytes):
+    _cas_db.put_dir_info(os.fspath(path), st, info)
+
+
 def checkFileSig(path, expected):
     h = _hash_file(path)
     if h != expected.hash:
@@ -781,11 +2535,33 @@ def checkFileSig(path, expected):
 
 
 @config.oninit
-def init(cas_root, **_):
+def init(
+    cas_root,
+    db_engine="sqlite",
+    blob_file_threshold=BLOCKSIZE,
+    chunked_blob_threshold=0,
+    compression="",
+    compress_threshold=256,
+    hash_algorithm="sha256",
+    **_,
+):
     global _cas_root
     global _cas_db
+    global _chunk_threshold
 
     os.makedirs(cas_root, exist_ok=True)
+    # (refuse the store before switching algorithms, so a failed init leaves
+    # the old one in place)
+    check_hash_algorithm(cas_root, hash_algorithm)
     _cas_root = cas_root
-    _cas_db = CasDB(cas_root)
+    _chunk_threshold = int(chunked_blob_threshold)
+    use_hash_algorithm(hash_algorithm)
+    _cas_db = CasDB(
+        cas_root,
+        db_engine,
+        int(blob_file_threshold),
+        compression,
+        int(compress_threshold),
+        hash_algorithm,
+    )
     return _cas_db
@@ -0,0 +1,271 @@
+"""
+Garbage collection for the CAS.
+
+Nothing is deleted from cas_root in normal operation. `collect()` frees space
+by deleting everything that can't be reached from a memo entry:
+
+1. Mark: starting from the result of each memo entry, follow references.
+   Compound records are just lists of hashes (see `cas.hsplit`), so this never
+   has to decode anything. Bytes records are leaves, except that a record of
+   exactly one long hash is also followed, since that's how `Sig`s and Blob
+   contents are serialized. (Conservatively: it may just be some bytes that
+   look like a hash.)
+
+2. Sweep: delete unmarked db records (rewriting packs without them, see
+   pack.py) and source file entries (see "Source files" in cas.py), then
+   unmarked files under `blob/`, `xblob/`, `zblob/` and `tree/`, and
+   leftovers in `tmp/`.
+
+Marking is incremental. The marked set and the stack of objects still to be
+scanned live in `gc_db`, and are checkpointed every `checkpoint` objects, so
+a run that's interrupted (or limited with `mark(limit=...)`) carries on from
+the last checkpoint next time. The sweep is resumable too: dead record hashes
+are listed in `gc_db` before anything is deleted.
+
+Eviction: with a size `budget` (in bytes), memo entries are marked newest
+first, by last access time (see `memo.ATIME_INTERVAL`), adding up the size of
+the db records and files they reach. Objects shared between entries only
+count once. Once the total passes the budget, the remaining (older) memo
+entries are deleted along with anything only they referred to. So the cache
+ends up a little over the budget, never under it by more than one entry.
+
+GC must not run at the same time as a build using the same cas_root: records
+written during a run aren't marked, and would be deleted. (Files newer than
+the start of the run are left alone, but that's just a precaution.)
+"""
+import logging, os, shutil, stat, struct, time
+import cas, fs, kvstore, memo
+
+logger = logging.getLogger(__name__)
+
+# keys in gc_db; marked hashes are the other keys
+_ROOTS = b"gc:roots"  # (arg hash, result hash) per memo entry, newest first
+_STATE = b"gc:state"  # see _pack_state
+_DEAD = b"x"  # prefix for hashes found dead by the sweep
+_STATE_FORMAT = "<dqqq"  # start time, budget, cursor, size
+_NO_BUDGET = -1
+
+_ENTRY_SIZE = 2 * cas.HASH_SIZE
+
+
+def _pack_state(start, budget, cursor, size, stack):
+    return struct.pack(_STATE_FORMAT, start, budget, cursor, size) + b"".join(stack)
+
+
+def _unpack_state(b):
+    n = struct.calcsize(_STATE_FORMAT)
+    start, budget, cursor, size = struct.unpack(_STATE_FORMAT, b[:n])
+    stack = [b[i : i + cas.HASH_SIZE] for i in range(n, len(b), cas.HASH_SIZE)]
+    return start, budget, cursor, size, stack
+
+
+def _open_state():
+    return kvstore.open_store(os.path.join(cas._cas_root, "gc_db"))
+
+
+def collect(budget=None, *, checkpoint=10000):
+    """
+    Run (or finish) a full collection. Returns the number of bytes of live
+    data kept.
+    """
+    mark(budget, checkpoint=checkpoint)
+    return sweep()
+
+
+def mark(budget=None, *, checkpoint=10000, limit=None):
+    """
+    Mark reachable objects, starting a new run unless one is in progress.
+    The budget of a run in progress can't be changed.
+
+    Stops after scanning about `limit` objects, if given. Returns True once
+    marking is complete.
+    """
+    st = _open_state()
+    try:
+        return _mark(st, budget, checkpoint, limit)
+    finally:
+        st.close()
+
+
+def _mark(st, budget, checkpoint, limit):
+    roots = st.get(_ROOTS)
+    if roots is None:
+        roots = _list_roots()
+        state = _pack_state(
+            time.time(), _NO_BUDGET if budget is None else budget, 0, 0, []
+        )
+        st.put_many([(_ROOTS, roots), (_STATE, state)])
+    start, budget, cursor, size, stack = _unpack_state(st[_STATE])
+    n_roots = len(roots) // _ENTRY_SIZE
+
+    new = set()  # marked since the last checkpoint
+
+    def push(h):
+        if h[0] & cas.HFLAG_LONG and h not in new and h not in st:
+            new.add(h)
+            stack.append(h)
+
+    def save():
+        state = _pack_state(start, budget, cursor, size, stack)
+        st.put_many([*((h, b"") for h in new), (_STATE, state)])
+        new.clear()
+
+    scanned = 0
+    while True:
+        if not stack:
+            if cursor >= n_roots or 0 <= budget < size:
+                break
+            i = cursor * _ENTRY_SIZE + cas.HASH_SIZE
+            push(_unpad(roots[i : i + cas.HASH_SIZE]))
+            cursor += 1
+            continue
+        h = stack.pop()
+        n, refs = _scan(h)
+        size += n
+        for r in refs:
+            push(r)
+        scanned += 1
+        if scanned % checkpoint == 0:
+            save()
+            if limit is not None and scanned >= limit:
+                return False
+    save()
+    return True
+
+
+def _list_roots():
+    # memo entries, packed as (arg hash, result hash zero-padded), newest first
+    entries = sorted(memo.iter_memos(), key=lambda e: e[2], reverse=True)
+    return b"".join(
+        a.ljust(cas.HASH_SIZE, b"\0") + r.hash.ljust(cas.HASH_SIZE, b"\0")
+        for (a, r, _) in entries
+    )
+
+
+def _unpad(h):
+    if h[0] & cas.HFLAG_LONG:
+        return h
+    return h[: h[0] & cas.HFLAG_MASK]
+
+
+def _scan(h):
+    # return (stored size, referenced hashes) of the object for long hash h
+    size = 0
+    refs = ()
+    bits = cas._cas_db.record(h)
+    if bits is not None:
+        size += len(bits)
+        refs = references(h, bits)
+    for kind in ("blob", "xblob", "zblob"):
+        try:
+            size += os.stat(_fspath(h.hex(), kind)).st_size
+        except FileNotFoundError:
+            pass
+    return size, refs
+
+
+def references(h, bits):
+    """
+    Return the hashes the db record `bits` for `h` may refer to.
+    """
+    if h[0] & cas.HFLAG_COMPOUND:
+        return [s.hash for s in cas.ihsplit(bits)]
+    if len(bits) == cas.HASH_SIZE and bits[0] & cas.HFLAG_LONG:
+        return [bits]  # maybe a hash
+    return []
+
+
+def _fspath(hex, kind):
+    return os.path.join(cas._cas_root, kind, hex[:2], hex[2:])
+
+
+def sweep():
+    """
+    Delete everything not marked by a finished `mark()`, and end the run.
+    Returns the size of the live data.
+    """
+    st = _open_state()
+    try:
+        return _sweep(st)
+    finally:
+        st.close()
+
+
+def _sweep(st, batch_size=10000):
+    roots = st[_ROOTS]
+    start, budget, cursor, size, stack = _unpack_state(st[_STATE])
+    assert not stack, "marking isn't finished"
+
+    # memo entries that didn't fit in the budget
+    n_roots = len(roots) // _ENTRY_SIZE
+    if cursor < n_roots:
+        logger.info("evicting %d of %d memo entries", n_roots - cursor, n_roots)
+        evicted = [
+            _unpad(roots[i : i + cas.HASH_SIZE])
+            for i in range(cursor * _ENTRY_SIZE, len(roots), _ENTRY_SIZE)
+        ]
+        for i in range(0, len(evicted), batch_size):
+            memo.forget(evicted[i : i + batch_size])
+
+    # db records: list the dead ones first, so we aren't deleting from the
+    # table we're iterating over
+    dead = []
+    for h in cas._cas_db.record_hashes():
+        if h not in st:
+            dead.append((_DEAD + h, b""))
+            if len(dead) >= batch_size:
+                st.put_many(dead)
+                dead.clear()
+    st.put_many(dead)
+    dead = []
+    for k in st.keys():
+        if k.startswith(_DEAD):
+            dead.append(k[len(_DEAD) :])
+            if len(dead) >= batch_size:
+                cas._cas_db.discard_records(dead)
+                dead.clear()
+    cas._cas_db.discard_records(dead)
+    # and the ones in packs; this also packs the live loose records
+    cas._cas_db.repack(keep=lambda h: h in st)
+    cas._cas_db.discard_sources([h for h in cas._cas_db.source_hashes() if h not in st])
+    logger.info("deleted unreferenced db records")
+
+    for kind in ("blob", "xblob", "zblob", "tree"):
+        _sweep_files(st, os.path.join(cas._cas_root, kind), start)
+    cas._cas_db.forget_present()
+    fs.forget_scanned()
+    _sweep_tmp(os.path.join(cas._cas_root, "tmp"), start)
+
+    st.clear()
+    return size
+
+
+def _sweep_files(st, top, start):
+    # files and dirs are named by hash: <top>/<hex[:2]>/<hex[2:]>
+    if not os.path.isdir(top):
+        return
+    for d in os.scandir(top):
+        if not d.is_dir(follow_symlinks=False):
+            continue
+        for e in os.scandir(d.path):
+            try:
+                h = bytes.fromhex(d.name + e.name)
+            except ValueError:
+                continue  # not ours
+            if h in st or not h[0] & cas.HFLAG_LONG:
+                continue  # live, or short hash contents that are always live
+            est = e.stat(follow_symlinks=False)
+            if est.st_mtime >= start:
+                continue
+            if stat.S_ISDIR(est.st_mode):
+                shutil.rmtree(e.path)
+            else:
+                os.unlink(e.path)
+
+
+def _sweep_tmp(top, start):
+    if not os.path.isdir(top):
+        return
+    for e in os.scandir(top):
+        if e.stat(follow_symlinks=False).st_mtime < start:
+            os.unlink(e.path)
@@ -4,7 +4,8 @@ import memo, fs, util, sys
 logger = logging.getLogger(__name__)
 
 
-@memo.memoize
+# lazy: callers usually only look at a few files of the output tree
+@memo.memoize(lazy=True)
 def run_tool(*args, stdin=os.devnull):
     strargs = [os.fspath(arg) for arg in args]
 
@@ -11,6 +11,17 @@ _default_config = {
     "out_root": "{db_root}/out",
     "gen_root": "{db_root}/gen",
     "src_root": os.path.abspath(os.path.join(__file__, "../test_data")),
+    "db_engine": "sqlite",  # see kvstore.engines
+    "blob_file_threshold": 65536,  # bytes larger than this are stored as files
+    "chunked_blob_threshold": 0,  # if nonzero, chunk bytes larger than this
+    "scan_workers": 0,  # threads for hashing files in Path.contents; 0 = auto
+    "hash_algorithm": "sha256",  # see "Hash algorithms" in cas.py; fixed per cas_root
+    "compression": "",  # "", "zlib" or "lzma"; see cas.py
+    "compress_threshold": 256,  # don't compress bytes smaller than this
+    "lazy_src_files": False,  # don't copy source files into the cas until needed
+    "watch_files": False,  # watch src_root for changes with inotify; see watcher.py
+    "remote_cache": "",  # URL of a remote memo/CAS cache; see remote_cache.py
+    "remote_cache_connections": 4,  # keep-alive connections to the remote cache
 }
 config = {}
 
@@ -38,7 +49,8 @@ def init(**cfg):
     config.update(_default_config)
     config.update(cfg)
     for k in config:
-        config[k] = config[k].format(**config)
+        if isinstance(config[k], str):
+            config[k] = config[k].format(**config)
     for f in _on_init:
         _on_uninit.append(f(**config))
 
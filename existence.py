@@ -0,0 +1,194 @@
+"""
+In-memory index of which hashes are in the CAS, so most membership checks
+don't touch disk.
+
+While storing a large object, nearly every record is checked for before it's
+written, and nearly all of those checks hit. And when a record is new, the
+check is a wasted lookup. So `ExistenceIndex` keeps:
+
+- a set of hashes recently seen to be present: a hit there is definite
+- a Bloom filter of every hash stored: a miss there means definitely absent
+
+Both are only as good as this process's view: other processes may have
+stored things since (so "absent" may be wrong), and deleting things behind
+the index's back (gc) makes "present" wrong. So "absent" is only used where
+being wrong costs a redundant write, and anything that deletes must tell the
+index (`discard`, `clear_recent`).
+
+The Bloom filter is saved to a snapshot file on close, and loaded on
+startup. Without a snapshot, it's rebuilt from a full listing of the CAS. It
+grows by adding filters twice the size of the last one as it fills up (a
+"scalable" Bloom filter), so it never has to be rebuilt to grow.
+
+Processes sharing a cas_root share the snapshot. Saving merges into what's
+on disk under a lock file, OR-ing the bits, so no process's additions are
+lost.
+"""
+import os, secrets, struct
+import util
+
+MAGIC = b"CASBLOOM"
+_HEADER = struct.Struct("<8sI")  # magic, number of filters
+_FILTER = struct.Struct("<QQ")  # capacity, count; then capacity*BITS_PER_KEY bits
+
+# ~1% false positives when a filter is at capacity
+BITS_PER_KEY = 10
+NUM_PROBES = 7
+FIRST_CAPACITY = 1 << 16
+RECENT_MAX = 1 << 20  # hashes remembered as present
+_PROBE_RANGE = range(NUM_PROBES)
+
+
+class BloomFilter:
+    """
+    A Bloom filter of `capacity` keys, which should be hash digests (they're
+    used as their own hash functions).
+    """
+
+    def __init__(self, capacity, count=0, bits=None):
+        self.capacity = capacity
+        self.count = count
+        self._nbits = capacity * BITS_PER_KEY
+        self._bits = bits if bits is not None else bytearray(self._nbits // 8 + 1)
+
+    def _probes(self, key):
+        # double hashing, from two 64-bit slices of the key
+        h1 = int.from_bytes(key[-8:], "little")
+        h2 = int.from_bytes(key[-16:-8], "little") | 1
+        n = self._nbits
+        return [(h1 + i * h2) % n for i in _PROBE_RANGE]
+
+    def add(self, key):
+        bits = self._bits
+        for p in self._probes(key):
+            bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self._bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._probes(key))
+
+    def full(self):
+        return self.count >= self.capacity
+
+    def merge(self, other, base):
+        """
+        Add the keys in `other`, a filter of the same capacity which had
+        `base` of our keys in it.
+        """
+        n = len(self._bits)
+        bits = int.from_bytes(self._bits, "little") | int.from_bytes(other._bits, "little")
+        self._bits[:] = bits.to_bytes(n, "little")
+        self.count = other.count + self.count - base
+
+
+class ExistenceIndex:
+    """
+    Which hashes are present (see the module docstring). `listing()` returns
+    every hash in the CAS, and is only called if there's no snapshot at
+    `path`.
+    """
+
+    def __init__(self, path, listing):
+        self._path = path
+        self._recent = set()
+        self._filters = _load(path)
+        self._base = []  # counts of the filters when last loaded or saved
+        if self._filters is None:
+            self._filters = [BloomFilter(FIRST_CAPACITY)]
+            for h in listing():
+                self._add_filter(h)
+            self.save()
+        self._base = [bf.count for bf in self._filters]
+
+    def close(self):
+        self.save()
+
+    def save(self):
+        with util.file_lock(self._path + ".lock"):
+            self._merge(_load(self._path) or [])
+            tmp = f"{self._path}.{secrets.token_hex(4)}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(_HEADER.pack(MAGIC, len(self._filters)))
+                for bf in self._filters:
+                    f.write(_FILTER.pack(bf.capacity, bf.count))
+                    f.write(bf._bits)
+            os.replace(tmp, self._path)
+        self._base = [bf.count for bf in self._filters]
+
+    def _merge(self, disk):
+        # add what other processes saved since we loaded or saved; filters
+        # we don't have go on the end (an extra filter only makes more
+        # things "maybe present", which is safe)
+        extra = []
+        for (i, d) in enumerate(disk):
+            if i < len(self._filters) and self._filters[i].capacity == d.capacity:
+                self._filters[i].merge(d, self._base[i] if i < len(self._base) else 0)
+            else:
+                extra.append(d)
+        self._filters += extra
+
+    def _add_filter(self, h):
+        bf = self._filters[-1]
+        if bf.full():
+            bf = BloomFilter(2 * bf.capacity)
+            self._filters.append(bf)
+        bf.add(h)
+
+    def add(self, h, new=False):
+        """
+        Note that `h` is present. `new` means `absent(h)` was just true, so
+        there's no need to check the filter again.
+        """
+        if h in self._recent:
+            return
+        if len(self._recent) >= RECENT_MAX:
+            self._recent.clear()
+        self._recent.add(h)
+        if new or self.absent(h):
+            self._add_filter(h)
+
+    def present(self, h):
+        """
+        True if `h` is definitely present.
+        """
+        return h in self._recent
+
+    def absent(self, h):
+        """
+        True if `h` is definitely absent, as far as this index knows.
+        """
+        return not any(h in bf for bf in self._filters)
+
+    def discard(self, hs):
+        # (Bloom filters can't forget, so deleted hashes just become "maybe")
+        self._recent.difference_update(hs)
+
+    def clear_recent(self):
+        self._recent.clear()
+
+
+def _load(path):
+    # list of BloomFilters from a snapshot, or None
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    try:
+        magic, n = _HEADER.unpack_from(data)
+        if magic != MAGIC:
+            return None
+        filters = []
+        pos = _HEADER.size
+        for _ in range(n):
+            capacity, count = _FILTER.unpack_from(data, pos)
+            pos += _FILTER.size
+            size = capacity * BITS_PER_KEY // 8 + 1
+            if pos + size > len(data):
+                return None
+            filters.append(BloomFilter(capacity, count, bytearray(data[pos : pos + size])))
+            pos += size
+    except struct.error:
+        return None
+    return filters or None
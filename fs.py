@@ -112,8 +112,8 @@ it might not be that expensive anyway, since only blobs we've never seen before
 copied. So the mutable-fs case is just disabling one optimization we might be doing.]
 
 """
-import enum, logging, os, posixpath, secrets, shutil, stat
-import cas, config, util
+import concurrent.futures, enum, logging, os, posixpath, secrets, shutil, stat, struct, time
+import cas, config, util, watcher
 from util import imdict
 
 
@@ -157,6 +157,8 @@ class Path:
     - a Tree object
     """
 
+    _cache_sig = True
+
     def __init__(self, root: Root, rel=""):
         assert isinstance(root, Root) or isinstance(root, Tree)
         if rel == ".":
@@ -222,18 +224,9 @@ class Path:
         if st is None:
             st = os.stat(self)
         if stat.S_ISDIR(st.st_mode):
-            entries = sorted(os.scandir(self), key=lambda p: p.name)
-            return Tree(
-                {e.name: (self / e.name).contents(st=e.stat()) for e in entries}
-            )
+            return _scan_tree(self, st)
         else:
-            # this path points to a blob
-            # todo: should not need to store the file if it's under src
-            sig = cas.store_file(self, st)
-            if st.st_mode & stat.S_IXUSR:
-                return XBlob(content_sig=sig)
-            else:
-                return Blob(content_sig=sig)
+            return _file_contents(self, st)
 
     def exists(self):
         return os.path.exists(self)
@@ -306,11 +299,13 @@ class Blob:
 
     The derived class XBlob is a blob that sets the x-bit on write.
 
-    TODO: currently this always stores the data in memory as `bytes`.
-    Should avoid doing that for large files.
+    Small blobs keep their data in memory as `bytes`. Large ones (see
+    `cas.file_backed`) only hold the content sig, and read the CAS file when
+    the data is needed.
     """
 
     _mode = 0o444
+    _cache_sig = True
 
     def __init__(self, *, bytes=None, content_sig=None):
         if bytes is not None:
@@ -318,39 +313,86 @@ class Blob:
                 assert content_sig == cas.sig(bytes)
             else:
                 content_sig = cas.store(bytes)
-        assert content_sig.is_bytes()
+                if cas.file_backed(len(bytes)):
+                    bytes = None  # it's in a file now
+        assert content_sig.is_bytes() or content_sig.is_chunked()
         self._bytes = bytes
         self.content_sig = content_sig
 
     def __ser__(self):
-        return (self.content_sig.hash,)  # TODO: should use WithSig to quote for gc
+        # a bare hash; cas_gc follows these conservatively
+        return (self.content_sig.hash,)
 
     @classmethod
     def __deser__(cls, cshash):
-        return cls(content_sig=cas.Sig(hash=cshash))
+        return cls(content_sig=cas.Sig(hash=cshash, chunked=True))  # (if compound)
 
     @util.lazy_attr("_path", None)
     def path(self):
         path = Path(Root.CAS, self.content_sig.get_relpath(st_mode=self._mode))
         if not path.exists():
-            self.write_copy(path, False)
+            try:
+                self.write_copy(path, False)
+            except FileExistsError:
+                pass  # another thread or process just made it
         return path
 
     def __fspath__(self):
         return self.path().__fspath__()
 
     def write_copy(self, path, clobber=True):
-        data = self._bytes or self.content_sig.object()
-        if clobber:
+        """
+        Write the contents to a new file at `path`. They go to a temp file
+        which is renamed into place, so nobody ever sees a partial file. If
+        not `clobber`, raises FileExistsError if there's already a file.
+        """
+        fspath = os.fspath(path)
+        if clobber and os.path.isdir(fspath) and not os.path.islink(fspath):
             path.remove()
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, "xb") as f:
-            os.chmod(path, self._mode)
-            f.write(data)
+        elif not clobber and os.path.lexists(fspath):
+            raise FileExistsError(fspath)
+        os.makedirs(os.path.dirname(fspath), exist_ok=True)
+        tmp = f"{fspath}.{secrets.token_hex(4)}.tmp"
+        try:
+            if self._bytes is not None or not cas.copy_file(self.content_sig, tmp):
+                with open(tmp, "xb") as f:
+                    if self._bytes is not None:
+                        f.write(self._bytes)
+                    else:
+                        for data in cas.iter_bytes(self.content_sig):
+                            f.write(data)
+            os.chmod(tmp, self._mode)
+            if clobber:
+                os.replace(tmp, fspath)
+            else:
+                os.link(tmp, fspath)  # (fails if someone got there first)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def buffer(self):
+        """
+        The contents as a read-only memoryview. Large blobs map their CAS file
+        instead of reading it.
+        """
+        if self._bytes is not None:
+            return memoryview(self._bytes)
+        return self.content_sig.buffer()
 
-    @util.lazy_attr("_bytes", None)
     def bytes(self):
-        return self.content_sig.object()
+        data = self._bytes
+        if data is None:
+            data = self.content_sig.object()
+            if not cas.file_backed(len(data)):
+                self._bytes = data
+        return data
+
+    @classmethod
+    def from_stream(cls, f):
+        """
+        Make a blob from the contents of a binary file object.
+        """
+        return cls(content_sig=cas.store_stream(f))
 
     def __eq__(self, other):
         if self is other:
@@ -387,6 +429,7 @@ class Tree:
     a tree).
     """
     _ser_fields = ("_entries",)
+    _cache_sig = True
 
     def __init__(self, entries):
         # entries: dict of (name, Blob|Tree)
@@ -410,14 +453,22 @@ class Tree:
         if os.path.exists(fspath):
             # assume it's valid
             return fspath
-        else:
-            os.makedirs(fspath)
-            fsentries = {k: v.__fspath__() for (k, v) in self.items()}
-            for k in self._entries:
-                util.makelink(
-                    fsentries[k], os.path.join(fspath, k),
-                )
-            return fspath
+        # build it under a temp name and rename it into place, so other
+        # processes never see a half-built tree
+        fsentries = {k: v.__fspath__() for (k, v) in self.items()}
+        tmp = f"{fspath}.{secrets.token_hex(4)}.tmp"
+        os.makedirs(tmp)
+        for k in self._entries:
+            util.makelink(
+                fsentries[k], os.path.join(tmp, k),
+            )
+        try:
+            os.rename(tmp, fspath)
+        except OSError:
+            if not os.path.isdir(fspath):
+                raise
+            _rmtree(tmp)  # someone else made it first
+        return fspath
 
     def write_copy(self, path, *, clobber=True, makedirs=False):
         """
@@ -503,6 +554,209 @@ def _rmtree(path):
         os.rmdir(path)
 
 
+def _file_contents(path, st):
+    # source files are only copied into the cas if they're needed; see
+    # "Source files" in cas.py
+    sig = cas.store_file(path, st, lazy=_lazy_src and path.root == Root.SRC)
+    return _file_blob(st, sig)
+
+
+def _file_blob(st, sig):
+    if st.st_mode & stat.S_IXUSR:
+        return XBlob(content_sig=sig)
+    else:
+        return Blob(content_sig=sig)
+
+
+class _Scanner:
+    """
+    Thread pool for hashing files while scanning directories.
+    """
+
+    def __init__(self, workers):
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers or None, thread_name_prefix="fs-scan"
+        )
+
+    def close(self):
+        self.pool.shutdown()
+
+
+# With a watcher (see watcher.py): directory path -> (generation, Tree) for
+# directories scanned in this process
+_scanned = {}
+
+
+def forget_scanned():
+    """
+    Forget the Trees scanned in this process; for after deleting things from
+    the CAS (see cas_gc).
+    """
+    _scanned.clear()
+
+
+_scanner = None
+
+
+@config.oninit
+def init(scan_workers=0, lazy_src_files=False, **_):
+    global _scanner, _lazy_src
+    _scanner = _Scanner(int(scan_workers))
+    _lazy_src = lazy_src_files
+    forget_scanned()
+    return _scanner
+
+
+def _scan_tree(top, st):
+    """
+    Return a Tree of the contents of directory `top`, whose stat result is
+    `st`.
+
+    Directories are listed on this thread from a work queue. The files found
+    are then stored and hashed together (see `cas.store_files`), on the
+    scanner's thread pool (hashlib releases the GIL). The Trees are assembled
+    afterwards, children before parents, so the result is the same as a plain
+    recursive walk.
+
+    Directories whose own stat result hasn't changed since they were last
+    scanned have the same entries, so they aren't listed again: we just check
+    the files we found last time (see `cas.dir_info`). Unchanged Trees are
+    rebuilt from what was recorded without hashing anything. (Directories
+    modified within RACY_NS of the scan aren't recorded: an entry added in
+    the same timestamp tick wouldn't change their stat result.)
+
+    With a watcher running, directories it says haven't changed since we last
+    scanned them in this process aren't looked at at all.
+    """
+    pool = _scanner.pool
+    racy = time.time_ns() - RACY_NS  # directories modified after this aren't recorded
+    w = watcher.current()
+    gen = w.generation() if w is not None else None
+    reused = {}  # dir -> Tree from last time
+    order = []  # directories, parents before children
+    listing = {}  # dir -> [(name, subdir Path, Blob or index in files)]
+    files = []  # (Path, stat result) of files to store
+    old_info = {}  # dir -> (stat result, recorded info or None)
+    queue = [(top, st)]
+    while queue:
+        d, st = queue.pop()
+        order.append(d)
+        if gen is not None:
+            last = _scanned.get(d)
+            if last is not None and not w.changed(os.fspath(d), last[0]):
+                reused[d] = last[1]
+                continue
+        info = cas.dir_info(d, st)
+        items = _check_files(d, info, files) if info is not None else None
+        if items is None:
+            info = None
+            items = []
+            for e in sorted(os.scandir(d), key=lambda e: e.name):
+                p = d / e.name
+                est = e.stat()
+                if stat.S_ISDIR(est.st_mode):
+                    queue.append((p, est))
+                    items.append((e.name, p))
+                else:
+                    items.append((e.name, len(files)))
+                    files.append((p, est))
+        else:
+            queue.extend((x, os.stat(x)) for (_, x) in items if isinstance(x, Path))
+        old_info[d] = (st, info)
+        listing[d] = items
+
+    lazy = _lazy_src and top.root == Root.SRC
+    sigs = cas.store_files(files, lazy=lazy, pool=pool) if files else []
+    trees = {}
+    for d in reversed(order):
+        if d in reused:
+            trees[d] = reused.pop(d)
+            _scanned[d] = (gen, trees[d])
+            continue
+        entries = {}
+        for (name, x) in listing.pop(d):
+            if isinstance(x, Path):
+                x = trees.pop(x)
+            elif isinstance(x, int):
+                sig = sigs[x]
+                if isinstance(sig, Exception):
+                    raise sig
+                x = _file_blob(files[x][1], sig)
+            entries[name] = x
+        tree = trees[d] = Tree(entries)
+        st, info = old_info.pop(d)
+        new_info = _dir_info(entries)
+        if info is not None and info[cas.HASH_SIZE :] == new_info:
+            # same as last time
+            tree.__sig__ = cas.Sig(hash=info[: cas.HASH_SIZE], chunked=False)
+        elif st.st_mtime_ns < racy:
+            cas.put_dir_info(d, st, cas.sig(tree).hash + new_info)
+        if gen is not None:
+            _scanned[d] = (gen, tree)
+    return trees[top]
+
+
+# how close a directory's mtime can be to a scan for us to record its info
+# (see `_scan_tree`), allowing for coarse timestamps
+RACY_NS = 2 * 10**9
+
+# Directory info (see `cas.dir_info`): the hash of the Tree, then for each
+# entry its kind, name and the hash of its contents (for a Blob) or Tree
+_DIR_ENTRY = struct.Struct("<cHB")  # kind, name length, hash length
+_KINDS = {Blob: b"b", XBlob: b"x", Tree: b"t"}
+
+
+def _dir_info(entries):
+    out = []
+    for (name, v) in entries.items():
+        h = cas.sig(v).hash if type(v) is Tree else v.content_sig.hash
+        name = os.fsencode(name)
+        out += [_DIR_ENTRY.pack(_KINDS[type(v)], len(name), len(h)), name, h]
+    return b"".join(out)
+
+
+def _iter_dir_info(b):
+    # yield (kind, name, hash) from the entries part of dir info
+    i = 0
+    while i < len(b):
+        kind, n, m = _DIR_ENTRY.unpack_from(b, i)
+        i += _DIR_ENTRY.size
+        yield kind, os.fsdecode(b[i : i + n]), b[i + n : i + n + m]
+        i += n + m
+
+
+def _check_files(d, info, files):
+    # [(name, subdir Path, Blob or index in files)] for directory d from its
+    # recorded info, adding just the files that changed to files; or None if
+    # its entries don't match the recorded ones after all
+    items = []
+    changed = []
+    dpath = os.path.abspath(d)
+    for (kind, name, h) in _iter_dir_info(info[cas.HASH_SIZE :]):
+        if kind == b"t":
+            items.append((name, d / name))
+            continue
+        p = os.path.join(dpath, name)  # (cheaper than a Path)
+        try:
+            st = os.stat(p)
+        except FileNotFoundError:
+            return None
+        if stat.S_ISDIR(st.st_mode):
+            return None
+        s = cas.Sig(hash=h)
+        if (
+            (kind == b"x") != bool(st.st_mode & stat.S_IXUSR)
+            or cas.cached_file_sig(p, st) != s
+            or not (s.is_bytes() or s.is_chunked())  # chunks gone
+        ):
+            items.append((name, len(files) + len(changed)))
+            changed.append((d / name, st))
+        else:
+            items.append((name, (XBlob if kind == b"x" else Blob)(content_sig=s)))
+    files += changed
+    return items
+
+
 def src_tree_for(buildfile):
     dir, name = os.path.split(os.path.abspath(buildfile))
     assert name == "BUILD.py"
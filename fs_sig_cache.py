@@ -1,14 +1,45 @@
 """
 Get hash of contents of files, with caching so we don't spend too much time
 re-hashing large files over and over.
+
+The cache is a dict in memory, keyed by absolute path. It also remembers the
+Tree last scanned from each directory (see `FsSigCache.dir_info`). It's loaded
+in bulk at startup from two files next to `dbpath`:
+
+- `<dbpath>.snap`: every entry, sorted by path, with a checksum
+- `<dbpath>.journal`: entries added (or deleted, with an empty value) since,
+  appended as checksummed records
+
+New entries are written behind: they're appended to the journal a few seconds
+later (see FLUSH_INTERVAL), or on `flush()` / `close()`. When the journal gets
+big it's compacted into a new snapshot. Both files stay valid after a crash:
+the snapshot is replaced by rename, and a torn record at the end of the
+journal fails its checksum and is dropped. At worst we lose entries, which
+only means hashing those files again.
+
+Several processes can share the files. Appends and compaction happen under a
+lock file (`<dbpath>.lock`), and compaction reloads what's on disk first, so
+it keeps other processes' entries.
 """
-import dbm, os, stat, struct
+import os, stat, struct, threading, zlib
+import util
 
 
 class RaceError(RuntimeError):
     ...
 
 
+SNAP_MAGIC = b"FSSIGS02"
+JOURNAL_MAGIC = b"FSSIGJ02"
+_SNAP_HEADER = struct.Struct("<8sQ")  # magic, count; entries; crc32 of all that
+_ENTRY = struct.Struct("<HI")  # path length, value length; then path, value
+_RECORD = struct.Struct("<IHI")  # crc32 of the rest, then an entry
+_CRC = struct.Struct("<I")
+
+FLUSH_INTERVAL = 5.0  # seconds new entries wait before going to the journal
+COMPACT_MIN = 1 << 20  # don't compact journals smaller than this
+
+
 class FsSigCache:
     """
     Maintain a cache of the content hashes of filesystem files
@@ -19,11 +50,15 @@ class FsSigCache:
     """
 
     def __init__(self, dbpath, hasher):
-        # dbm only has "dumbdbm" on Windows which is *really* slow,
-        # single-process exclusive, and just generally bad.
-        # TODO: use a better dbm module; semidbm?
-        self._db = dbm.open(dbpath, "c")
+        self._snap_path = dbpath + ".snap"
+        self._journal_path = dbpath + ".journal"
+        self._lock_path = dbpath + ".lock"
         self._hasher = hasher
+        self._lock = threading.Lock()
+        self._dirty = {}  # entries not in the journal yet
+        self._timer = None
+        with util.file_lock(self._lock_path):
+            self._entries = self._load()
 
     # Return a hash of the contents of the file at the given path.
     # Will try to re-use a cached value of the hash if possible.
@@ -42,32 +77,268 @@ class FsSigCache:
     # But we really want to support scandir because it's *much*
     # faster for checking that a large tree is unchanged.
     def hash(self, path, st=None) -> bytes:
-        path = bytes(os.path.abspath(path), "utf8")
-        if st is None:
-            st = os.stat(path)
-        assert isinstance(st, os.stat_result)
-        if stat.S_ISDIR(st.st_mode):
-            raise IsADirectoryError("attempt to hash contents of a directory")
-
-        key = _st_key(st)
-        old = self._db.get(path, None)
-        if old and old[:_ST_KEY_SIZE] == key:
-            return old[_ST_KEY_SIZE:]
-
-        # have to do heavier work now so get a real stat
-        if not st.st_ino:
-            st = os.stat(path)
-        h = self._hasher(path)
-        st2 = os.stat(path)
-
-        # check that file wasn't modified while we hashed it
-        if not _st_key_match(st2, key):
-            raise RaceError(f"file was modified while hashing: {st} -> {st2} or {key} -> {_st_key(st2)}")
-        self._db[path] = _st_key(st) + h
+        (h,) = self.hash_many([(path, st)])
+        if isinstance(h, Exception):
+            raise h
         return h
 
+    def hash_many(self, entries, pool=None) -> list:
+        """
+        `hash` for each (path, st) in `entries`, looking them all up at once
+        and hashing the misses on `pool` (an Executor) if given. New hashes
+        are written back together.
+
+        Returns a list with, for each entry, its hash or the exception we got
+        for it: an OSError, or a RaceError if it was modified while hashing.
+        """
+        out = []
+        misses = []  # (index, path, stat key, st)
+        for (path, st) in entries:
+            path = bytes(os.path.abspath(path), "utf8")
+            try:
+                if st is None:
+                    st = os.stat(path)
+                assert isinstance(st, os.stat_result)
+                if stat.S_ISDIR(st.st_mode):
+                    raise IsADirectoryError("attempt to hash contents of a directory")
+            except OSError as e:
+                out.append(e)
+                continue
+            key = _st_key(st)
+            h = self._get(path, key)
+            if h is None:
+                misses.append((len(out), path, key, st))
+            out.append(h)
+        if not misses:
+            return out
+
+        # have to do heavier work now so get real stats
+        todo = []
+        for (i, path, key, st) in misses:
+            try:
+                todo.append((i, path, key, st if st.st_ino else os.stat(path)))
+            except OSError as e:
+                out[i] = e
+        hashes = (pool.map if pool is not None else map)(self._try_hash, [t[1] for t in todo])
+
+        # check that files weren't modified while we hashed them
+        new = {}
+        for ((i, path, key, st), h) in zip(todo, hashes):
+            if not isinstance(h, Exception):
+                try:
+                    st2 = os.stat(path)
+                except OSError as e:
+                    h = e
+                else:
+                    if _st_key_match(st2, key):
+                        new[path] = _st_key(st) + h
+                    else:
+                        h = RaceError(
+                            f"file was modified while hashing: {st} -> {st2} or {key} -> {_st_key(st2)}"
+                        )
+            out[i] = h
+        if new:
+            self._put_many(new)
+        return out
+
+    def _try_hash(self, path):
+        try:
+            return self._hasher(path)
+        except OSError as e:
+            return e
+
+    def lookup(self, path, st):
+        """
+        Return the cached hash of the file at `path` if its stat result is
+        still `st`, else None. Never hashes anything.
+        """
+        return self._get(bytes(os.path.abspath(path), "utf8"), _st_key(st))
+
+    # Directories: a description of the fs.Tree last scanned from a directory
+    # (see `fs._scan_tree`), keyed by the directory's own stat result. That
+    # only changes when entries are added, removed or renamed, so the caller
+    # still has to check the files in it. Their keys end in "/", so they
+    # can't clash with files.
+
+    def dir_info(self, path, st):
+        """
+        Return what `put_dir_info` recorded for directory `path`, if its stat
+        result is still `st`, else None.
+        """
+        return self._get(_dir_key(path), _st_key(st))
+
+    def put_dir_info(self, path, st, info):
+        self._put(_dir_key(path), _st_key(st) + info)
+
+    def forget_dirs(self):
+        """
+        Drop all the directory entries.
+        """
+        self._put_many({k: b"" for k in self._entries if k.endswith(b"/")})
+
+    def _get(self, path, key):
+        v = self._entries.get(path)
+        if v and v[:_ST_KEY_SIZE] == key:
+            return v[_ST_KEY_SIZE:]
+        return None
+
+    def _put(self, path, v):
+        self._put_many({path: v})
+
+    def _put_many(self, items):
+        # (an empty value deletes the entry)
+        with self._lock:
+            for (path, v) in items.items():
+                if v:
+                    self._entries[path] = v
+                else:
+                    self._entries.pop(path, None)
+            self._dirty.update(items)
+            if self._timer is None:
+                self._timer = threading.Timer(FLUSH_INTERVAL, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """
+        Append new entries to the journal, compacting it if it's big.
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not dirty:
+            return
+        data = b"".join(_record(p, v) for (p, v) in dirty.items())
+        with util.file_lock(self._lock_path):
+            with open(self._journal_path, "ab") as f:
+                if f.tell() == 0:
+                    f.write(JOURNAL_MAGIC)
+                f.write(data)
+                size = f.tell()
+            try:
+                snap_size = os.stat(self._snap_path).st_size
+            except FileNotFoundError:
+                snap_size = 0
+            if size > max(COMPACT_MIN, snap_size):
+                self._compact()
+
+    def compact(self):
+        """
+        Write everything to a new snapshot and empty the journal.
+        """
+        self.flush()
+        with util.file_lock(self._lock_path):
+            self._compact()
+
+    def _compact(self):
+        # (holding the lock file) start from what's on disk, which has all
+        # our flushed entries and maybe other processes' too
+        entries = self._load()
+        with self._lock:
+            for (p, v) in self._dirty.items():
+                if v:
+                    entries[p] = v
+                else:
+                    entries.pop(p, None)
+            self._entries = entries
+            items = sorted(entries.items())
+        tmp = self._snap_path + ".tmp"
+        with open(tmp, "wb") as f:
+            crc = _write_crc(f, 0, _SNAP_HEADER.pack(SNAP_MAGIC, len(items)))
+            for (p, v) in items:
+                crc = _write_crc(f, crc, _ENTRY.pack(len(p), len(v)) + p + v)
+            f.write(_CRC.pack(crc))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._snap_path)
+        # a crash here just leaves entries in the journal which are already
+        # in the snapshot
+        with open(tmp, "wb") as f:
+            f.write(JOURNAL_MAGIC)
+        os.replace(tmp, self._journal_path)
+
+    def _load(self):
+        # (holding the lock file) the snapshot plus the journal
+        entries = _read_snapshot(self._snap_path)
+        self._snap_ok = entries is not None
+        entries = entries or {}
+        try:
+            with open(self._journal_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return entries
+        good = _replay(data, entries)
+        if good < len(data):
+            # a torn or garbled tail: cut it off, or appends would go after it
+            with open(self._journal_path, "r+b") as f:
+                f.truncate(good)
+        return entries
+
     def close(self):
-        self._db.close()
+        self.flush()
+        if not self._snap_ok:
+            with util.file_lock(self._lock_path):
+                self._compact()
+
+
+def _dir_key(path):
+    return bytes(os.path.join(os.path.abspath(path), ""), "utf8")
+
+
+def _record(path, v):
+    body = _ENTRY.pack(len(path), len(v)) + path + v
+    return _CRC.pack(zlib.crc32(body)) + body
+
+
+def _write_crc(f, crc, data):
+    f.write(data)
+    return zlib.crc32(data, crc)
+
+
+def _read_snapshot(path):
+    # dict of entries from a snapshot; None if it's missing or damaged
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    if len(data) < _SNAP_HEADER.size + _CRC.size:
+        return None
+    (crc,) = _CRC.unpack_from(data, len(data) - _CRC.size)
+    magic, n = _SNAP_HEADER.unpack_from(data)
+    if magic != SNAP_MAGIC or zlib.crc32(memoryview(data)[: -_CRC.size]) != crc:
+        return None
+    entries = {}
+    pos = _SNAP_HEADER.size
+    unpack = _ENTRY.unpack_from
+    for _ in range(n):
+        lp, lv = unpack(data, pos)
+        pos += _ENTRY.size
+        entries[data[pos : pos + lp]] = data[pos + lp : pos + lp + lv]
+        pos += lp + lv
+    return entries
+
+
+def _replay(data, entries):
+    # apply journal records to entries; return the length of the good part
+    if data[: len(JOURNAL_MAGIC)] != JOURNAL_MAGIC:
+        return 0
+    pos = len(JOURNAL_MAGIC)
+    while pos + _RECORD.size <= len(data):
+        crc, lp, lv = _RECORD.unpack_from(data, pos)
+        start = pos + _CRC.size
+        end = pos + _RECORD.size + lp + lv
+        if end > len(data) or zlib.crc32(data[start:end]) != crc:
+            break
+        p = pos + _RECORD.size
+        if lv:
+            entries[data[p : p + lp]] = data[p + lp : end]
+        else:
+            entries.pop(data[p : p + lp], None)  # deleted
+        pos = end
+    return pos
 
 
 # return bytes containing parts of st that we consider relevant. Note
@@ -0,0 +1,176 @@
+"""
+Git object databases as backing stores for the CAS.
+
+Sources usually live in git already, so rather than hash and copy a checkout
+into cas_root, `GitRepo(path).tree(rev)` builds the `fs.Tree` of a commit
+straight from git's objects (loose or packed, read through `git cat-file`),
+without looking at the working tree.
+
+Git names objects by a SHA-1 of a header plus the contents, so we still have
+to hash each blob once to get its CAS sig. Results are kept in `git_db`,
+under cas_root:
+
+- b"o" + git oid -> CAS hash: for blobs the content sig, for trees the sig
+  of the (stored) fs.Tree, so an unchanged subtree costs one lookup
+- b"c" + CAS hash -> len(oid) + oid + git dir: where to read the contents
+
+Blob contents aren't copied into the CAS. This module adds itself to
+`cas.backing_stores`, and reads them from the repo when they're needed, like
+lazy source files (see "Source files" in cas.py). Contents are gone if the
+repo is, or the object was gc'd out of it.
+
+Symlinks and submodules have no fs equivalent, and are skipped.
+"""
+import io, logging, os, subprocess, threading
+import cas, config, fs, kvstore
+
+logger = logging.getLogger(__name__)
+
+# tree entry modes
+_TREE = b"40000"
+_BLOB = b"100644"
+_XBLOB = b"100755"
+
+_db = None
+_repos = {}  # git dir -> GitRepo, for reading contents; closed on uninit
+
+
+class GitRepo:
+    """
+    A git repository, read through a `git cat-file --batch` process.
+    """
+
+    def __init__(self, path):
+        self.git_dir = _git(path, "rev-parse", "--absolute-git-dir").decode().strip()
+        self._proc = None
+        self._lock = threading.Lock()
+        _repos.setdefault(self.git_dir, self)
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.stdin.close()
+            self._proc.wait()
+            self._proc = None
+
+    def tree(self, rev="HEAD"):
+        """
+        Return the fs.Tree of the files in `rev` (a commit or tree).
+        """
+        try:
+            oid = _git(self.git_dir, "rev-parse", "--verify", f"{rev}^{{tree}}")
+        except subprocess.CalledProcessError:
+            raise ValueError(f"{self.git_dir}: unknown revision {rev!r}") from None
+        return self._tree(bytes.fromhex(oid.decode().strip()))
+
+    def _tree(self, oid):
+        h = _db.get(b"o" + oid)
+        if h is not None:
+            try:
+                return cas.Sig(hash=h).object(lazy=True)
+            except KeyError:
+                pass  # gc'd; build it again
+        entries = {}
+        for (mode, name, eoid) in _parse_tree(self.read(oid, b"tree"), len(oid)):
+            name = os.fsdecode(name)
+            if mode == _TREE:
+                entries[name] = self._tree(eoid)
+            elif mode in (_BLOB, _XBLOB):
+                cls = fs.XBlob if mode == _XBLOB else fs.Blob
+                entries[name] = cls(content_sig=self._blob_sig(eoid))
+            else:
+                logger.warning("%s: skipping %s (mode %s)", self.git_dir, name, mode)
+        tree = fs.Tree(entries)
+        _db[b"o" + oid] = cas.store(tree).hash
+        return tree
+
+    def _blob_sig(self, oid):
+        h = _db.get(b"o" + oid)
+        if h is not None:
+            return cas.Sig(hash=h)
+        data = self.read(oid, b"blob")
+        s = cas.sig(data)
+        if not s.is_bytes():
+            cas.store(data)  # chunked: the chunks have to be in the CAS
+        elif s.hash[0] & cas.HFLAG_LONG:
+            _db[b"c" + s.hash] = bytes([len(oid)]) + oid + os.fsencode(self.git_dir)
+        _db[b"o" + oid] = s.hash
+        return s
+
+    def read(self, oid, kind):
+        """
+        Return the contents of object `oid` (raw bytes), which must be of
+        type `kind` (b"blob", b"tree", ...). Raises KeyError if it's missing.
+        """
+        with self._lock:
+            if self._proc is None:
+                self._proc = subprocess.Popen(
+                    ["git", "--git-dir", self.git_dir, "cat-file", "--batch"],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                )
+            p = self._proc
+            p.stdin.write(oid.hex().encode() + b"\n")
+            p.stdin.flush()
+            header = p.stdout.readline().split()
+            if header[1:2] == [b"missing"]:
+                raise KeyError(oid.hex())
+            size = int(header[2])
+            data = p.stdout.read(size)
+            p.stdout.read(1)  # newline
+        if header[1] != kind:
+            raise ValueError(f"{oid.hex()} is a {header[1].decode()}, not a {kind.decode()}")
+        return data
+
+
+def _git(path, *args):
+    return subprocess.run(
+        ["git", "-C", path, *args], check=True, capture_output=True
+    ).stdout
+
+
+def _parse_tree(data, oid_size):
+    # yield (mode, name, oid) for entries of a raw tree object:
+    # "<mode> <name>\0<oid>" back to back
+    i = 0
+    while i < len(data):
+        sp = data.index(b" ", i)
+        nul = data.index(b"\0", sp)
+        yield data[i:sp], data[sp + 1 : nul], data[nul + 1 : nul + 1 + oid_size]
+        i = nul + 1 + oid_size
+
+
+class _Backing:
+    # the `cas.backing_stores` entry; see "Source files" in cas.py
+
+    def has(self, h):
+        return _db.get(b"c" + h) is not None
+
+    def open(self, h):
+        v = _db.get(b"c" + h)
+        if v is None:
+            return None
+        oid, git_dir = v[1 : 1 + v[0]], os.fsdecode(v[1 + v[0] :])
+        try:
+            repo = _repos.get(git_dir) or GitRepo(git_dir)
+            return io.BytesIO(repo.read(oid, b"blob"))
+        except (KeyError, subprocess.CalledProcessError):
+            return None  # repo or object is gone
+
+    def close(self):
+        global _db
+        cas.backing_stores.remove(self)
+        for repo in _repos.values():
+            repo.close()
+        _repos.clear()
+        _db.close()
+        _db = None
+
+
+@config.oninit
+def init(cas_root, db_engine="sqlite", **_):
+    global _db
+    os.makedirs(cas_root, exist_ok=True)
+    _db = kvstore.open_store(os.path.join(cas_root, "git_db"), db_engine)
+    b = _Backing()
+    cas.backing_stores.append(b)
+    return b
@@ -0,0 +1,274 @@
+"""
+Key-value storage engines.
+
+`cas.CasDB` and the memo table just need a persistent map from `bytes` keys
+to `bytes` values. This module gives them a small common interface so the
+engine underneath can be swapped:
+
+- `get(k, default)`, `put(k, v)`, `k in store`: single-key operations
+- `put_many(items)`: write a batch of `(k, v)` pairs in one commit
+- `delete_many(keys)`, `clear()`: remove entries (missing keys are ignored)
+- `items()`: iterate over everything stored
+- `store[k]`, `store[k] = v`: dict-style sugar over `get`/`put`
+
+Two engines are provided:
+
+- "sqlite": a single table in an SQLite database in WAL mode. Any number of
+  processes can read while one writes, and batches commit atomically. This is
+  the default.
+- "dbm": whatever the `dbm` module picks. No transactions. Processes can
+  share it through a lock file, but every write reopens the file, and on
+  some hosts only "dumbdbm" is available, where that means rewriting its
+  whole index. Use sqlite for anything write-heavy or multi-process; dbm is
+  kept for compatibility with existing caches.
+"""
+import contextlib, dbm, os, sqlite3, threading
+import util
+
+
+class KVStore:
+    """
+    Interface for key-value stores. Keys and values are always `bytes`.
+    """
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def put(self, key, value):
+        raise NotImplementedError
+
+    def put_many(self, items):
+        """
+        Store an iterable of (key, value) pairs. Engines that support
+        transactions commit these all at once.
+        """
+        for (k, v) in items:
+            self.put(k, v)
+
+    def delete_many(self, keys):
+        raise NotImplementedError
+
+    def clear(self):
+        self.delete_many(list(self.keys()))
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def items(self):
+        raise NotImplementedError
+
+    def keys(self):
+        return (k for (k, _) in self.items())
+
+    def close(self):
+        ...
+
+    def __getitem__(self, key):
+        v = self.get(key)
+        if v is None:
+            raise KeyError(key)
+        return v
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+
+class DbmStore(KVStore):
+    """
+    A dbm database. dbm files can't be written by several processes at
+    once, so operations run under a lock file (`<path>.lock`): shared for
+    reads, exclusive for writes. Each write opens the database, and closes it
+    before releasing the lock, so everything is on disk. It also bumps a
+    counter in `<path>.gen`. Reads use a handle that stays open, and that is
+    only reopened when the counter has changed. Without fcntl (Windows) the
+    database just stays open, and only one process can use it.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._gen_path = path + ".gen"
+        self._lock = threading.Lock()  # dbm modules aren't thread-safe
+        self._db = None  # for reading; or the only handle, without fcntl
+        self._gen = None  # what the counter was when _db was opened
+        self._nolock = ""
+        with self._open(write=True):
+            pass  # create it
+        if util.fcntl is None:
+            self._db = dbm.open(path, "c")
+        elif dbm.whichdb(path) == "dbm.gnu":
+            self._nolock = "u"  # gdbm's own locks would block other processes
+
+    @contextlib.contextmanager
+    def _open(self, write=False):
+        with self._lock:
+            if util.fcntl is None and self._db is not None:
+                yield self._db
+                return
+            with util.file_lock(self._path + ".lock", shared=not write):
+                gen = self._generation()
+                if write:
+                    db = dbm.open(self._path, "c" + self._nolock)
+                    try:
+                        yield db
+                    finally:
+                        db.close()
+                        with open(self._gen_path, "wb") as f:
+                            f.write((int.from_bytes(gen, "little") + 1).to_bytes(8, "little"))
+                    return
+                if self._db is None or gen != self._gen:
+                    if self._db is not None:
+                        self._db.close()
+                    self._db = dbm.open(self._path, "r" + self._nolock)
+                    self._gen = gen
+                yield self._db
+
+    def _generation(self):
+        try:
+            with open(self._gen_path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return b""
+
+    def get(self, key, default=None):
+        with self._open() as db:
+            return db.get(key, default)
+
+    def put(self, key, value):
+        with self._open(write=True) as db:
+            db[key] = value
+
+    def put_many(self, items):
+        with self._open(write=True) as db:
+            for (k, v) in items:
+                db[k] = v
+
+    def delete_many(self, keys):
+        with self._open(write=True) as db:
+            for k in keys:
+                try:
+                    del db[k]
+                except KeyError:
+                    pass
+
+    def __contains__(self, key):
+        with self._open() as db:
+            return key in db
+
+    def items(self):
+        for k in self.keys():
+            v = self.get(k)
+            if v is not None:
+                yield k, v
+
+    def keys(self):
+        with self._open() as db:
+            return iter(list(db.keys()))
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class SqliteStore(KVStore):
+    """
+    Key-value table in an SQLite database.
+
+    The database runs in WAL mode so readers in other processes never block on
+    (or see partial results from) a writer. Single puts commit immediately;
+    `put_many` commits its whole batch as one transaction.
+
+    Statements are kept as fixed strings so the sqlite3 module's statement
+    cache reuses the prepared forms.
+    """
+
+    _GET = "SELECT v FROM kv WHERE k = ?"
+    _HAS = "SELECT 1 FROM kv WHERE k = ?"
+    _PUT = "INSERT OR REPLACE INTO kv (k, v) VALUES (?, ?)"
+    _DEL = "DELETE FROM kv WHERE k = ?"
+    _ITEMS = "SELECT k, v FROM kv"
+    _KEYS = "SELECT k FROM kv"
+
+    def __init__(self, path, timeout=60.0):
+        # isolation_level=None: we issue BEGIN/COMMIT ourselves
+        self._conn = sqlite3.connect(
+            path, timeout=timeout, isolation_level=None, check_same_thread=False
+        )
+        self._lock = threading.RLock()
+        c = self._conn
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute("PRAGMA synchronous=NORMAL")
+        c.execute(
+            "CREATE TABLE IF NOT EXISTS kv (k BLOB PRIMARY KEY, v BLOB NOT NULL)"
+            " WITHOUT ROWID"
+        )
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute(self._GET, (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._conn.execute(self._PUT, (key, value))
+
+    def put_many(self, items):
+        self._write_many(self._PUT, items)
+
+    def delete_many(self, keys):
+        self._write_many(self._DEL, ((k,) for k in keys))
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM kv")
+
+    def _write_many(self, statement, rows):
+        with self._lock:
+            c = self._conn
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                c.executemany(statement, rows)
+            except BaseException:
+                c.execute("ROLLBACK")
+                raise
+            c.execute("COMMIT")
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._conn.execute(self._HAS, (key,)).fetchone() is not None
+
+    def items(self):
+        # separate cursor so callers can interleave other operations
+        with self._lock:
+            rows = self._conn.execute(self._ITEMS)
+        yield from rows
+
+    def keys(self):
+        with self._lock:
+            rows = self._conn.execute(self._KEYS)
+        return (k for (k,) in rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+engines = {
+    "sqlite": (SqliteStore, ".sqlite"),
+    "dbm": (DbmStore, ""),
+}
+
+
+def open_store(path, engine="sqlite") -> KVStore:
+    """
+    Open (creating if needed) a store of the given engine type.
+
+    `path` is a base name; each engine adds its own suffix so stores of
+    different types can sit next to each other.
+    """
+    try:
+        cls, suffix = engines[engine]
+    except KeyError:
+        raise ValueError(f"unknown db engine {engine!r}") from None
+    return cls(os.fspath(path) + suffix)
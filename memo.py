@@ -46,8 +46,8 @@ do we name types? What does it mean for a type to be the "same"?
 - At least for v1: like pickle, have a limited set of primitives with fixed
   encoding.
 """
-import dbm, logging, os
-import cas, config, context, util
+import logging, os, struct, time
+import cas, config, context, kvstore, util
 
 
 logger = logging.getLogger(__name__)
@@ -56,6 +56,17 @@ logger = logging.getLogger(__name__)
 _memo_store = None
 _trace = None  # list of memo checks for unit tests
 
+# a remote cache to check on local misses and share new entries with; set by
+# remote_cache.py when one is configured
+remote = None
+
+# Memo entries map arg sig -> result sig + last access time (a little-endian
+# double, for `cas_gc` eviction). Entries from before access times were
+# recorded are just the result sig, and count as never accessed.
+#
+# Like relatime, hits only rewrite the access time if it's older than this:
+ATIME_INTERVAL = 3600
+
 
 def set_trace(obj=None):
     global _trace
@@ -63,10 +74,10 @@ def set_trace(obj=None):
 
 
 @config.oninit
-def init(cas_root, **_):
+def init(cas_root, db_engine="sqlite", **_):
     global _memo_store
     os.makedirs(cas_root, exist_ok=True)
-    _memo_store = dbm.open(os.path.join(cas_root, "memo_db"), "c")
+    _memo_store = kvstore.open_store(os.path.join(cas_root, "memo_db"), db_engine)
     return _memo_store
 
 
@@ -74,14 +85,48 @@ def put_memo(arg_sig, v_sig):
     assert isinstance(arg_sig, cas.Sig)
     assert isinstance(v_sig, cas.Sig)
     logger.debug("_memo_store[%s] = %s", arg_sig, v_sig)
-    _memo_store[arg_sig.hash] = v_sig.hash
+    _memo_store[arg_sig.hash] = v_sig.hash + struct.pack("<d", time.time())
+    if remote is not None:
+        remote.put_memo(arg_sig, v_sig)
 
 
 def get_memo(arg_sig):
-    h = _memo_store.get(arg_sig.hash)
-    if h is None:
-        return None
-    return cas.Sig(hash=h)
+    v = _memo_store.get(arg_sig.hash)
+    if v is None:
+        if remote is None:
+            return None
+        # (the remote fetches the result's objects into the local CAS)
+        v_sig = remote.get_memo(arg_sig)
+        if v_sig is not None:
+            _memo_store[arg_sig.hash] = v_sig.hash + struct.pack("<d", time.time())
+        return v_sig
+    v_sig, atime = _unpack_memo(v)
+    now = time.time()
+    if now - atime > ATIME_INTERVAL:
+        _memo_store[arg_sig.hash] = v_sig.hash + struct.pack("<d", now)
+    return v_sig
+
+
+def _unpack_memo(v):
+    # return (result sig, access time) from a memo db value
+    n = v[0] & cas.HFLAG_MASK if not v[0] & cas.HFLAG_LONG else cas.HASH_SIZE
+    atime = struct.unpack("<d", v[n:])[0] if len(v) > n else 0.0
+    return cas.Sig(hash=v[:n]), atime
+
+
+def iter_memos():
+    """
+    Yield `(arg hash, result sig, last access time)` for every memo entry.
+    """
+    for (k, v) in _memo_store.items():
+        yield (k, *_unpack_memo(v))
+
+
+def forget(arg_hashes):
+    """
+    Delete the memo entries for the given arg hashes.
+    """
+    _memo_store.delete_many(arg_hashes)
 
 
 # get memoized value without calling f
@@ -97,14 +142,19 @@ def record_access(*key):
 
 @util.decorator
 class memoize:
-    def __init__(self, func, sig_value=None):
+    def __init__(self, func, sig_value=None, lazy=False):
         """
         Mark a function as part of the heavyweight memo system
 
         sig_value, if not None, is a fixed Sig to use for f itself.
+
+        If lazy is True, memo hits return the result decoded lazily (see
+        `cas.Sig.object`), so large results are only read as far as the
+        caller looks into them.
         """
         self._func = func
         self._sig = sig_value
+        self._lazy = lazy
 
     @property
     @util.lazy_attr("_sig", None)
@@ -132,15 +182,18 @@ class memoize:
                     f"memo calling {f}: no memo for sig {arg_sig} of {(self, args, kwargs)}"
                 )
                 res = f(*args, **kwargs)
-            res_sig = cas.store(res)
-            put_memo(arg_sig, res_sig)
+            # The memo entry is only written once the result's objects are
+            # committed, so it can never point at objects that don't exist.
+            with cas.write_batch() as batch:
+                res_sig = cas.store(res)
+                batch.after_commit(put_memo, arg_sig, res_sig)
             if _trace is not None:
                 _trace.append(("store", f.__name__, arg_sig, res_sig))
             return res
         else:
             if _trace is not None:
                 _trace.append(("hit", f.__name__, arg_sig, res_sig))
-            return res_sig.object()
+            return res_sig.object(lazy=self._lazy)
 
         assert sig_value is None or isinstance(sig_value, cas.Sig)
         wrapper.__sig__ = sig_value or cas.sig(f)
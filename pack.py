@@ -0,0 +1,248 @@
+"""
+Pack files for CAS records.
+
+Records in the db each cost a B-tree entry, and lookups in a large, cold db
+are random reads. Packs keep records in big append-only files instead, in the
+style of git:
+
+- `pack-<id>.pack`: a header, then the record values back to back
+- `pack-<id>.idx`: a header with the entry count, then fixed-width entries
+  (hash, offset, length), sorted by hash
+
+The index is mmap'd and binary searched, so a lookup touches a handful of
+pages and nothing is loaded up front. Packs are never modified: `repack()`
+writes a new pack and then deletes the records and packs it replaces, so
+readers never see a partial pack. (The .idx is renamed into place last, and a
+pack doesn't exist until its .idx does.) Repacks take a lock file, so only
+one process merges packs at a time.
+
+Values are stored exactly as they were in the db, compression headers and
+all; this module doesn't care what's in them.
+"""
+import bisect, mmap, os, secrets, struct
+import util
+
+PACK_MAGIC = b"CASPACK1"
+INDEX_MAGIC = b"CASIDX01"
+_HEADER = struct.Struct("<8sQ")  # magic, count (for .idx)
+_ENTRY = struct.Struct("<32sQI")  # hash, offset, length
+KEY_SIZE = 32
+
+# `Packs.repack` merges everything into one pack once there are this many
+MAX_PACKS = 8
+
+
+class Pack:
+    """
+    One pack file and its index, opened read-only.
+    """
+
+    def __init__(self, path):
+        # path: without the .pack/.idx extension
+        self.path = path
+        self.mtime = os.stat(path + ".idx").st_mtime_ns
+        self._idx = _map(path + ".idx")
+        magic, self._n = _HEADER.unpack_from(self._idx)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{path}.idx is not a pack index")
+        self._data = _map(path + ".pack")
+        if self._data[: len(PACK_MAGIC)] != PACK_MAGIC:
+            raise ValueError(f"{path}.pack is not a pack")
+        self._keys = _Keys(self._idx, self._n)
+
+    def close(self):
+        self._idx.close()
+        self._data.close()
+
+    def __len__(self):
+        return self._n
+
+    def _find(self, key):
+        # index of the entry for key, or -1
+        i = bisect.bisect_left(self._keys, key)
+        if i < self._n and self._keys[i] == key:
+            return i
+        return -1
+
+    def get(self, key, default=None):
+        i = self._find(key)
+        if i < 0:
+            return default
+        _, off, n = _ENTRY.unpack_from(self._idx, _HEADER.size + i * _ENTRY.size)
+        return self._data[off : off + n]
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def keys(self):
+        return iter(self._keys)
+
+    def items(self):
+        for i in range(self._n):
+            k, off, n = _ENTRY.unpack_from(self._idx, _HEADER.size + i * _ENTRY.size)
+            yield k, self._data[off : off + n]
+
+
+class _Keys:
+    # the sorted hashes in an index, as a sequence for bisect
+
+    def __init__(self, idx, n):
+        self._idx = idx
+        self._n = n
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, i):
+        if not 0 <= i < self._n:
+            raise IndexError(i)
+        p = _HEADER.size + i * _ENTRY.size
+        return self._idx[p : p + KEY_SIZE]
+
+
+def _map(path):
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def write_pack(dir, items):
+    """
+    Write (key, value) pairs to a new pack in `dir`, and return its path, or
+    None if there were no items. Keys must be unique and KEY_SIZE bytes.
+    """
+    os.makedirs(dir, exist_ok=True)
+    path = os.path.join(dir, f"pack-{secrets.token_hex(8)}")
+    entries = []
+    with open(path + ".pack.tmp", "wb") as f:
+        f.write(PACK_MAGIC)
+        off = len(PACK_MAGIC)
+        for (k, v) in items:
+            assert len(k) == KEY_SIZE
+            f.write(v)
+            entries.append((k, off, len(v)))
+            off += len(v)
+    if not entries:
+        os.remove(path + ".pack.tmp")
+        return None
+    entries.sort()
+    with open(path + ".idx.tmp", "wb") as f:
+        f.write(_HEADER.pack(INDEX_MAGIC, len(entries)))
+        for e in entries:
+            f.write(_ENTRY.pack(*e))
+    os.replace(path + ".pack.tmp", path + ".pack")
+    os.replace(path + ".idx.tmp", path + ".idx")
+    return path
+
+
+def remove_pack(path):
+    # index first, so nobody opens a pack that's half gone
+    for ext in (".idx", ".pack"):
+        try:
+            os.remove(path + ext)
+        except FileNotFoundError:
+            pass
+
+
+class Packs:
+    """
+    All the packs in a directory. Lookups check the newest packs first.
+    """
+
+    def __init__(self, dir):
+        self._dir = dir
+        self._packs = []
+        self._mtime = None
+        self.refresh()
+
+    def refresh(self):
+        """
+        Pick up packs added or removed by other processes. Returns True if
+        anything changed.
+        """
+        try:
+            mtime = os.stat(self._dir).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        names = []
+        if mtime is not None:
+            names = [n[:-4] for n in os.listdir(self._dir) if n.endswith(".idx")]
+        old = {p.path: p for p in self._packs}
+        packs = []
+        for name in names:
+            path = os.path.join(self._dir, name)
+            p = old.pop(path, None)
+            if p is None:
+                try:
+                    p = Pack(path)
+                except FileNotFoundError:
+                    continue  # removed while we looked
+            packs.append(p)
+        for p in old.values():
+            p.close()
+        packs.sort(key=lambda p: p.mtime, reverse=True)
+        self._packs = packs
+        return True
+
+    def close(self):
+        for p in self._packs:
+            p.close()
+        self._packs = []
+
+    def __len__(self):
+        return len(self._packs)
+
+    def get(self, key, default=None):
+        for p in self._packs:
+            v = p.get(key)
+            if v is not None:
+                return v
+        return default
+
+    def __contains__(self, key):
+        return any(key in p for p in self._packs)
+
+    def keys(self):
+        for p in self._packs:
+            yield from p.keys()
+
+    def repack(self, loose, *, keep=None, merge=None):
+        """
+        Write the (key, value) pairs from `loose` to a new pack, and return
+        the keys read from `loose`; the caller can then delete them. If
+        `merge` (default: when there are MAX_PACKS or more packs, or `keep` is
+        given), the existing packs are merged into it and removed. Keys for
+        which `keep(key)` is false are dropped.
+        """
+        # one repack at a time, or concurrent ones would merge the same packs
+        os.makedirs(self._dir, exist_ok=True)
+        with util.file_lock(os.path.join(self._dir, "repack.lock")):
+            self.refresh()
+            return self._repack(loose, keep, merge)
+
+    def _repack(self, loose, keep, merge):
+        if merge is None:
+            merge = keep is not None or len(self._packs) + 1 >= MAX_PACKS
+        merged = list(self._packs) if merge else []
+        taken = []
+
+        def items():
+            for (k, v) in loose:
+                taken.append(k)
+                if keep is None or keep(k):
+                    yield k, v
+            # loose records shadow packed ones; duplicates between packs
+            # are harmless, so don't keep track of those
+            loose_keys = set(taken)
+            for p in merged:
+                for (k, v) in p.items():
+                    if k not in loose_keys and (keep is None or keep(k)):
+                        yield k, v
+
+        write_pack(self._dir, items())
+        for p in merged:
+            remove_pack(p.path)
+        self.refresh()
+        return taken
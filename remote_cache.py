@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+"""
+A remote memo/CAS cache shared between machines, over HTTP.
+
+With `remote_cache` set to a URL in the config, local memo misses are looked
+up in the remote cache before calling the function, and new memo entries are
+uploaded to it. Running this module starts a reference server:
+
+    python remote_cache.py DIR --port 8470
+
+Protocol
+--------
+Hashes in request and response bodies are sent back to back, each as a length
+byte and the hash (so short hashes work too). A length of 0 is "none".
+
+- `POST /memo/get`: body is arg hashes; response is the result hash for each
+- `PUT /memo/<arg hex>`: body is the result hash. The result object must
+  already be on the server
+- `POST /cas/has`: body is hashes; response is a 0 or 1 byte for each
+- `POST /cas/get`: body is hashes; response is, for each, a little-endian u32
+  length (0xffffffff if missing) and the object's bytes (record bits for
+  compound objects)
+- `PUT /cas/<hex>`: body is the object's bytes; checked against the hash
+
+Every request has an `X-Hash-Algorithm` header with the client's hash
+algorithm (see "Hash algorithms" in cas.py), and the server refuses requests
+for another one with a 400.
+
+Objects go up before the memo entries that refer to them, and children before
+parents, so an object on the server always has everything it refers to. A
+client can then stop walking as soon as it finds an object already there.
+
+Client
+------
+- Lookups are batched: a hit fetches the result's missing objects a level of
+  the object graph at a time, and uploads check which objects the server
+  needs in the same way.
+- Requests share a small pool of keep-alive connections.
+- Uploads happen in background threads; `close()` waits for them.
+- Objects missing from the local CAS are fetched on demand
+  (`cas.fetch_missing`).
+- Everything fetched is checked against its hash before it's stored.
+
+Network errors are logged and count as misses; they never fail a build. Hit
+and miss latencies are kept for the build summary (`summary()`).
+"""
+import argparse, collections, concurrent.futures, http.client, http.server
+import logging, os, secrets, struct, threading, time, urllib.parse
+import cas, cas_gc, config, memo
+
+logger = logging.getLogger(__name__)
+
+_LEN = struct.Struct("<I")
+_MISSING = 0xFFFFFFFF
+BATCH_SIZE = 1000  # hashes per request
+UPLOAD_WORKERS = 2
+
+client = None  # the Client for the configured remote cache, if any
+
+
+def _pack_hashes(hs):
+    return b"".join(bytes([len(h)]) + h for h in hs)
+
+
+def _unpack_hashes(b):
+    # (None for "none" entries)
+    hs = []
+    i = 0
+    while i < len(b):
+        n = b[i]
+        hs.append(b[i + 1 : i + 1 + n] if n else None)
+        i += 1 + n
+    return hs
+
+
+def _batches(xs):
+    for i in range(0, len(xs), BATCH_SIZE):
+        yield xs[i : i + BATCH_SIZE]
+
+
+class Stats:
+    """
+    Counts, total times and sizes for remote cache operations.
+    """
+
+    def __init__(self):
+        self.count = collections.Counter()
+        self.seconds = collections.Counter()
+        self.bytes = collections.Counter()
+        self._lock = threading.Lock()
+
+    def add(self, kind, seconds=0.0, nbytes=0, n=1):
+        with self._lock:
+            self.count[kind] += n
+            self.seconds[kind] += seconds
+            self.bytes[kind] += nbytes
+
+    def mean_ms(self, kind):
+        n = self.count[kind]
+        return 1000 * self.seconds[kind] / n if n else 0.0
+
+    def summary(self):
+        c, b = self.count, self.bytes
+        return (
+            f"remote cache: {c['hit']} hits (mean {self.mean_ms('hit'):.1f} ms), "
+            f"{c['miss']} misses (mean {self.mean_ms('miss'):.1f} ms); "
+            f"fetched {c['fetch']} objects ({b['fetch']} bytes), "
+            f"uploaded {c['upload']} objects ({b['upload']} bytes); "
+            f"{c['error']} errors"
+        )
+
+
+class _Pool:
+    # keep-alive HTTP connections to one server
+
+    def __init__(self, url, size, timeout):
+        u = urllib.parse.urlsplit(url)
+        if u.scheme != "http":
+            raise ValueError(f"unsupported remote cache URL {url!r}")
+        self._host, self._port = u.hostname, u.port
+        self._prefix = u.path.rstrip("/")
+        self._size = size
+        self._timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
+
+    def request(self, method, path, body=b""):
+        """
+        Return (status, response body).
+        """
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = http.client.HTTPConnection(self._host, self._port, timeout=self._timeout)
+        try:
+            try:
+                res = self._send(conn, method, path, body)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # the server dropped an idle connection; every request here
+                # is idempotent, so just try again on a new one
+                conn.close()
+                res = self._send(conn, method, path, body)
+        except BaseException:
+            conn.close()
+            raise
+        with self._lock:
+            if len(self._idle) < self._size:
+                self._idle.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+        return res
+
+    def _send(self, conn, method, path, body):
+        headers = {"X-Hash-Algorithm": cas.hash_algorithm()}
+        conn.request(method, self._prefix + path, body=body, headers=headers)
+        r = conn.getresponse()
+        return r.status, r.read()
+
+
+class Client:
+    """
+    A remote cache at `url` (see the module docstring).
+    """
+
+    def __init__(self, url, connections=4, timeout=30.0):
+        self.stats = Stats()
+        self._pool = _Pool(url, connections, timeout)
+        self._uploads = concurrent.futures.ThreadPoolExecutor(
+            max_workers=UPLOAD_WORKERS, thread_name_prefix="remote-cache"
+        )
+        self._pending = {}  # (arg hash, result hash) -> upload future
+        self._lock = threading.Lock()
+
+    def close(self):
+        self.flush()
+        self._uploads.shutdown()
+        self._pool.close()
+
+    def _request(self, method, path, body=b""):
+        status, data = self._pool.request(method, path, body)
+        if status != 200:
+            raise http.client.HTTPException(f"{method} {path}: HTTP {status}")
+        return data
+
+    def get_memos(self, arg_hashes):
+        """
+        Return the remote result hash (or None) for each of `arg_hashes`.
+        """
+        res = []
+        for hs in _batches(list(arg_hashes)):
+            res.extend(_unpack_hashes(self._request("POST", "/memo/get", _pack_hashes(hs))))
+        return res
+
+    def has(self, hs):
+        """
+        Return whether the server has each of the (long) hashes `hs`.
+        """
+        res = []
+        for batch in _batches(list(hs)):
+            res.extend(b == 1 for b in self._request("POST", "/cas/has", _pack_hashes(batch)))
+        return res
+
+    def get_objects(self, hs):
+        """
+        Return the bytes (or None) of each of the (long) hashes `hs`, unchecked.
+        """
+        res = []
+        for batch in _batches(list(hs)):
+            data = memoryview(self._request("POST", "/cas/get", _pack_hashes(batch)))
+            i = 0
+            for _ in batch:
+                (n,) = _LEN.unpack_from(data, i)
+                i += _LEN.size
+                if n == _MISSING:
+                    res.append(None)
+                else:
+                    res.append(bytes(data[i : i + n]))
+                    i += n
+        return res
+
+    def get_memo(self, arg_sig):
+        """
+        Return the remote result Sig for `arg_sig`, with all its objects
+        fetched into the local CAS; or None.
+        """
+        t = time.perf_counter()
+        try:
+            [h] = self.get_memos([arg_sig.hash])
+            if h is not None:
+                with cas.write_batch():
+                    if not self._fetch_closure(h):
+                        logger.warning("remote cache: result %s is incomplete", h.hex())
+                        h = None
+        except (OSError, http.client.HTTPException) as e:
+            logger.warning("remote cache: %s", e)
+            self.stats.add("error")
+            h = None
+        self.stats.add("miss" if h is None else "hit", time.perf_counter() - t)
+        return None if h is None else cas.Sig(hash=h)
+
+    def _fetch_closure(self, h):
+        # fetch everything reachable from h that isn't in the local CAS, a
+        # level at a time. Local objects are taken to be complete. Returns
+        # False if the server is missing something that's needed.
+        level = [(h, True)]
+        seen = set()
+        dicts = []  # large dicts, checked once their entries are here
+        while level:
+            want = []
+            for (x, sure) in level:
+                if x[0] & cas.HFLAG_LONG and x not in seen:
+                    seen.add(x)
+                    if not cas._cas_db.stored(x):
+                        want.append((x, sure))
+            level = []
+            for ((x, sure), data) in zip(want, self.get_objects(x for (x, _) in want)):
+                if data is None or not cas.verify_record(x, data, shallow=True):
+                    if sure:
+                        return False
+                    continue  # bytes that only looked like a hash
+                self.stats.add("fetch", nbytes=len(data))
+                compound = bool(x[0] & cas.HFLAG_COMPOUND)
+                if compound and data.startswith(cas._DICT_SUM.hash):
+                    dicts.append((x, data))
+                else:
+                    cas._cas_db[x] = data
+                level.extend((r, compound) for r in cas_gc.references(x, data))
+        for (x, data) in dicts:
+            if not cas.verify_record(x, data):
+                return False
+            cas._cas_db[x] = data
+        return True
+
+    def fetch(self, h):
+        """
+        Fetch one object into the local CAS and return its bytes, or None if
+        the server doesn't have it (the `cas.fetch_missing` hook).
+        """
+        try:
+            [data] = self.get_objects([h])
+        except (OSError, http.client.HTTPException) as e:
+            logger.warning("remote cache: %s", e)
+            self.stats.add("error")
+            return None
+        if data is None or not cas.verify_record(h, data):
+            return None
+        self.stats.add("fetch", nbytes=len(data))
+        cas._cas_db[h] = data
+        return data
+
+    def put_memo(self, arg_sig, v_sig):
+        """
+        Upload a memo entry and its result's objects, in the background.
+        """
+        key = (arg_sig.hash, v_sig.hash)
+        with self._lock:
+            if key not in self._pending:
+                self._pending[key] = self._uploads.submit(self._upload, *key)
+
+    def flush(self):
+        """
+        Wait for the uploads queued so far.
+        """
+        with self._lock:
+            futures = list(self._pending.values())
+        concurrent.futures.wait(futures)
+
+    def _upload(self, arg_hash, res_hash):
+        try:
+            self._upload_memo(arg_hash, res_hash)
+        except (OSError, http.client.HTTPException) as e:
+            logger.warning("remote cache: upload failed: %s", e)
+            self.stats.add("error")
+        except Exception:
+            logger.exception("remote cache: upload failed")
+            self.stats.add("error")
+        finally:
+            with self._lock:
+                del self._pending[(arg_hash, res_hash)]
+
+    def _upload_memo(self, arg_hash, res_hash):
+        # find the objects the server needs, a level at a time, then send
+        # them children first, then the memo entry
+        needed = []
+        level = [(res_hash, True)]
+        seen = set()
+        while level:
+            hs = {}
+            for (x, sure) in level:
+                if x[0] & cas.HFLAG_LONG and x not in seen:
+                    seen.add(x)
+                    hs[x] = sure
+            level = []
+            for ((x, sure), there) in zip(hs.items(), self.has(hs)):
+                if there:
+                    continue
+                try:
+                    data = cas._cas_db[x] if x in cas._cas_db else None
+                except KeyError:
+                    data = None  # (a source file that just changed)
+                if data is None:
+                    if sure:
+                        logger.warning("remote cache: not uploading %s: missing %s",
+                                       res_hash.hex(), x.hex())
+                        return
+                    continue
+                needed.append((x, data))
+                compound = bool(x[0] & cas.HFLAG_COMPOUND)
+                level.extend((r, compound) for r in cas_gc.references(x, data))
+        for (x, data) in reversed(needed):
+            t = time.perf_counter()
+            self._request("PUT", f"/cas/{x.hex()}", data)
+            self.stats.add("upload", time.perf_counter() - t, len(data))
+        self._request("PUT", f"/memo/{arg_hash.hex()}", res_hash)
+
+
+class _Hooks:
+    # what `init` returns: unhooks the client and closes it on uninit
+
+    def __init__(self, c):
+        self.client = c
+
+    def close(self):
+        global client
+        if self.client is None:
+            return
+        memo.remote = None
+        cas.fetch_missing = None
+        client = None
+        self.client.close()
+        logger.info("%s", self.client.stats.summary())
+
+
+@config.oninit
+def init(remote_cache="", remote_cache_connections=4, **_):
+    global client
+    if remote_cache:
+        client = Client(remote_cache, remote_cache_connections)
+        memo.remote = client
+        cas.fetch_missing = client.fetch
+    return _Hooks(client)
+
+
+def summary():
+    """
+    One line of remote cache statistics for the build summary, or None if
+    there's no remote cache.
+    """
+    return client.stats.summary() if client is not None else None
+
+
+# Reference server
+
+
+class Server(http.server.ThreadingHTTPServer):
+    """
+    A remote cache server storing everything in files under `root`:
+    `memo/<arg hex>` and `cas/<xx>/<rest of hex>`. Objects are checked with
+    the current hash algorithm (`cas.use_hash_algorithm`).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, root, address=("127.0.0.1", 0)):
+        self.root = root
+        self.hash_algorithm = cas.hash_algorithm()
+        os.makedirs(root, exist_ok=True)
+        cas.check_hash_algorithm(root, self.hash_algorithm)
+        os.makedirs(os.path.join(root, "memo"), exist_ok=True)
+        os.makedirs(os.path.join(root, "cas"), exist_ok=True)
+        super().__init__(address, _Handler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def object_path(self, h):
+        hex = h.hex()
+        return os.path.join(self.root, "cas", hex[:2], hex[2:])
+
+    def memo_path(self, h):
+        return os.path.join(self.root, "memo", h.hex())
+
+    def has(self, h):
+        return not h[0] & cas.HFLAG_LONG or os.path.exists(self.object_path(h))
+
+    def read(self, path):
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, path, data, *, replace=True):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{secrets.token_hex(4)}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        if replace:
+            os.replace(tmp, path)
+            return
+        try:
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _reply(self, status, body=b""):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _hash_arg(self, prefix):
+        try:
+            h = bytes.fromhex(self.path[len(prefix) :])
+        except ValueError:
+            return None
+        return h if 0 < len(h) <= cas.HASH_SIZE else None
+
+    def _wrong_algorithm(self):
+        return self.headers.get("X-Hash-Algorithm", "sha256") != self.server.hash_algorithm
+
+    def do_POST(self):
+        server = self.server
+        hs = _unpack_hashes(self._body())
+        if None in hs or self._wrong_algorithm():
+            return self._reply(400)
+        if self.path == "/memo/get":
+            res = [server.read(server.memo_path(h)) for h in hs]
+            self._reply(200, b"".join(bytes([len(r or b"")]) + (r or b"") for r in res))
+        elif self.path == "/cas/has":
+            self._reply(200, bytes(server.has(h) for h in hs))
+        elif self.path == "/cas/get":
+            out = []
+            for h in hs:
+                data = server.read(server.object_path(h)) if h[0] & cas.HFLAG_LONG else None
+                if data is None:
+                    out.append(_LEN.pack(_MISSING))
+                else:
+                    out += [_LEN.pack(len(data)), data]
+            self._reply(200, b"".join(out))
+        else:
+            self._reply(404)
+
+    def do_PUT(self):
+        server = self.server
+        body = self._body()
+        if self._wrong_algorithm():
+            return self._reply(400)
+        if self.path.startswith("/cas/"):
+            h = self._hash_arg("/cas/")
+            if h is None or len(h) != cas.HASH_SIZE:
+                return self._reply(400)
+            if not cas.verify_record(h, body, shallow=True):
+                return self._reply(400)
+            # (a large dict's entries can't be checked here, so the first
+            # upload of an object wins)
+            server.write(server.object_path(h), body, replace=False)
+            self._reply(200)
+        elif self.path.startswith("/memo/"):
+            h = self._hash_arg("/memo/")
+            if h is None or not body or len(body) > cas.HASH_SIZE:
+                return self._reply(400)
+            if not server.has(body):
+                return self._reply(409)  # objects go up first
+            server.write(server.memo_path(h), body)
+            self._reply(200)
+        else:
+            self._reply(404)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a remote cache server.")
+    parser.add_argument("root", help="directory to store the cache in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8470)
+    parser.add_argument("--hash-algorithm", default="sha256", choices=cas.HASH_ALGORITHMS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    cas.use_hash_algorithm(args.hash_algorithm)
+    server = Server(args.root, (args.host, args.port))
+    logger.info("serving %s at %s", args.root, server.url)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
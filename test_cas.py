@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
-import unittest
-import cas, config
+import io, mmap, os, random, tempfile, unittest, unittest.mock
+import cas, config, util
 
 __ALLOW_GLOBAL_REFS__ = True
 
@@ -47,6 +47,9 @@ del hidden2
 del hidden3
 del hidden4
 
+# rebound by test_fn_sig_cache
+_fn_dep = _fn_const = None
+
 
 class Thing:
     _ser_fields = ...
@@ -111,7 +114,12 @@ cases = [
 
 class SigTest(unittest.TestCase):
     def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        config.init(db_root=self.dir.name)
+
+    def tearDown(self):
         config.init()
+        self.dir.cleanup()
 
     def test_prims(self):
         self.assertEqual(cas.sig(b"").hash, b"\x01")
@@ -136,6 +144,49 @@ class SigTest(unittest.TestCase):
         self.assertNotEqual(cas.sig(get_hidden1()), cas.sig(get_hidden3()))
         cas.sig(get_hidden4())
 
+    def test_fn_sig_cache(self):
+        global _fn_dep, _fn_const
+
+        def g():
+            return _fn_const
+
+        def f(x):
+            return _fn_dep() + x
+
+        _fn_dep, _fn_const = g, 1
+        h = cas.sig(f)
+        self.assertIs(cas._cached_fn_sig(f), h)
+        self.assertEqual(cas.sig(f), h)
+
+        # rebinding a global that f refers to, even indirectly, changes its sig
+        _fn_const = 2
+        self.assertIsNone(cas._cached_fn_sig(f))
+        h2 = cas.sig(f)
+        self.assertNotEqual(h2, h)
+        _fn_const = 1
+        self.assertEqual(cas.sig(f), h)
+
+        # so does rebinding a closure cell
+        n = 1
+        c = lambda: n
+        h = cas.sig(c)
+        n = 2
+        self.assertNotEqual(cas.sig(c), h)
+
+        # functions referring to mutable things aren't cached
+        _fn_const = [1]
+        h = cas.sig(f)
+        self.assertIsNone(cas._cached_fn_sig(g))
+        _fn_const.append(2)
+        self.assertNotEqual(cas.sig(f), h)
+
+    def test_find_global(self):
+        g = cas.find_global(global_fun)
+        self.assertEqual((g.module, g.name), (__name__, "global_fun"))
+        self.assertIs(cas.find_global(global_fun), g)
+        self.assertIsNone(cas.find_global(get_hidden1()))
+        self.assertIsNone(cas.find_global(1))
+
     def test_prim_from_sig(self):
         self.assertEqual(cas.Sig(hash=b"\x01").object(), b"")
         self.assertEqual(cas.Sig(hash=b"\x04Foo").object(), b"Foo")
@@ -146,12 +197,460 @@ class SigTest(unittest.TestCase):
         self.assertEqual(cas.sig(()).hash, b"\x43\x02T")
         self.assertEqual(cas.sig([None, True]).hash, b"\x48\x02L\x42\x01\x43\x02t")
 
+    def test_sig_cache(self):
+        d = util.imdict({"a": 1, "b": (2, "c")})
+        self.assertFalse(hasattr(d, "__sig__"))
+        h = cas.sig(d)
+        self.assertEqual(d.__sig__, h)
+        self.assertIs(cas.sig(d), h)
+
+        # refuse to cache if anything reachable is mutable
+        d = util.imdict({"a": [1]})
+        cas.sig(d)
+        self.assertFalse(hasattr(d, "__sig__"))
+
+        # mutable types never get a cached sig
+        t = Thing(x=1)
+        cas.sig(t)
+        self.assertNotIn("__sig__", t.__dict__)
+
+    def test_struct_sig_cache(self):
+        s = util.Struct(x=1, y="two")
+        h = cas.sig(s)
+        self.assertEqual(s.__sig__, h)
+        self.assertEqual(list(s.keys()), ["x", "y"])
+        self.assertEqual(cas.sig(s), cas.sig(util.Struct(y="two", x=1)))
+
+        s.x = 2
+        self.assertFalse(hasattr(s, "__sig__"))
+        self.assertNotEqual(cas.sig(s), h)
+        self.assertEqual(cas.sig(s), cas.sig(util.Struct(x=2, y="two")))
+
+    def test_write_batch(self):
+        x = ["a batched record, long enough to need storing", 12345]
+        db = cas._cas_db._db
+        committed = []
+        with cas.write_batch() as batch:
+            h = cas.store(x)
+            with cas.write_batch() as inner:
+                self.assertIs(inner, batch)
+            batch.after_commit(committed.append, h)
+            # visible through the CAS, but not yet written
+            self.assertEqual(h.object(), x)
+            self.assertNotIn(h.hash, db)
+            self.assertEqual(committed, [])
+        self.assertIn(h.hash, db)
+        self.assertEqual(committed, [h])
+
+    def test_write_batch_abort(self):
+        x = ["an abandoned record, long enough to need storing"]
+        committed = []
+        with self.assertRaises(ZeroDivisionError):
+            with cas.write_batch() as batch:
+                h = cas.store(x)
+                batch.after_commit(committed.append, h)
+                1 / 0
+        self.assertNotIn(h.hash, cas._cas_db)
+        self.assertEqual(committed, [])
+
     def test_roundtrip(self):
         for x in cases:
             with self.subTest(value=x):
                 h = cas.store(x)
                 self.assertEqual(h.object(), x)
 
+    def test_lazy_roundtrip(self):
+        for x in cases:
+            with self.subTest(value=x):
+                h = cas.store(x)
+                y = h.object(lazy=True)
+                self.assertEqual(y, x)
+                self.assertEqual(cas.sig(y), h)
+
+    def test_lazy_fetch(self):
+        long = "this string is longer than 31 bytes so it must be stored {}"
+        x = {"a": [long.format(i) for i in range(10)], "b": (long.format("b"),)}
+        h = cas.store(x)
+
+        fetched = []
+        get_bits = cas.Sig._get_bits
+
+        def tracing_get_bits(s):
+            fetched.append(s)
+            return get_bits(s)
+
+        cas.Sig._get_bits = tracing_get_bits
+        try:
+            y = h.object(lazy=True)
+            self.assertIsInstance(y, cas.LazyDict)
+            self.assertEqual(y["a"][3], long.format(3))
+            self.assertIn(cas.sig(x["a"][3]), fetched)
+            self.assertNotIn(cas.sig(x["b"]), fetched)
+            self.assertNotIn(cas.sig(x["a"][4]), fetched)
+
+            # hashing doesn't fetch anything (or need hashable values)
+            z = h.object(lazy=True)
+            n = len(fetched)
+            self.assertEqual(hash(z), hash(y))
+            self.assertEqual(len(fetched), n)
+            self.assertEqual(z, y)
+            self.assertEqual(y, x)
+        finally:
+            cas.Sig._get_bits = get_bits
+
+    def test_iter_list(self):
+        x = [str(i) * 40 for i in range(5)]
+        h = cas.store(x)
+        it = cas.iter_list(h)
+        self.assertEqual(next(it), x[0])
+        self.assertEqual(list(it), x[1:])
+        with self.assertRaises(TypeError):
+            list(cas.iter_list(cas.store({})))
+
+
+class ChunkTest(unittest.TestCase):
+    def setUp(self):
+        config.init(chunked_blob_threshold=cas.CHUNK_MAX)
+
+    def tearDown(self):
+        config.init()
+
+    def test_chunked(self):
+        data = random.Random(1).randbytes(1 << 20)
+        h = cas.store(data)
+        self.assertFalse(h.is_bytes())
+        self.assertTrue(h.is_chunked())
+        self.assertFalse(cas.store([1, 2]).is_chunked())
+        self.assertEqual(h.object(), data)
+        self.assertEqual(b"".join(cas.iter_bytes(h)), data)
+        self.assertEqual(cas.store_stream(io.BytesIO(data)), h)
+
+        # small blobs are unchanged
+        self.assertTrue(cas.sig(data[: cas.CHUNK_MAX]).is_bytes())
+
+        # what's chunked is known without looking it up
+        tree = cas.store(["not", "a", "blob"])
+        with unittest.mock.patch.object(cas.Sig, "_get_bits", side_effect=AssertionError):
+            self.assertTrue(cas.sig(data).is_chunked())
+            h.get_relpath(kind="blob")
+            cas.Sig(hash=h.hash, chunked=True).get_relpath(kind="xblob")
+            tree.get_relpath(kind="tree")
+        self.assertTrue(cas.Sig(hash=h.hash).is_chunked())
+        self.assertFalse(cas.Sig(hash=tree.hash).is_chunked())
+
+    def test_chunk_dedup(self):
+        data = random.Random(2).randbytes(1 << 20)
+        edited = data[:500000] + b"a small insertion" + data[500000:]
+        chunks = cas.hsplit(cas.store(data)._get_bits())[1:]
+        edited_chunks = cas.hsplit(cas.store(edited)._get_bits())[1:]
+        self.assertGreater(len(chunks), 4)
+        # all but a chunk or two are shared
+        self.assertLessEqual(len(set(edited_chunks) - set(chunks)), 2)
+
+
+class BufferTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        config.init(db_root=self.dir.name, compression="")
+
+    def tearDown(self):
+        config.init()
+        self.dir.cleanup()
+
+    def test_buffer(self):
+        data = random.Random(5).randbytes(200000)
+        h = cas.store(data)
+        buf = h.buffer()
+        self.assertIsInstance(buf.obj, mmap.mmap)
+        self.assertTrue(buf.readonly)
+        self.assertEqual(buf, data)
+        self.assertEqual([type(b) for b in cas.iter_bytes(h)], [memoryview])
+
+        # buffers hash like the bytes they hold
+        self.assertEqual(cas.sig(buf), h)
+        self.assertEqual(cas.sig(memoryview(data)[:10]), cas.sig(data[:10]))
+        small = cas.store(memoryview(data)[:1000])
+        self.assertEqual(small.object(), data[:1000])
+        self.assertEqual(small.buffer(), data[:1000])
+
+    def test_chunked_buffer(self):
+        config.init(
+            db_root=self.dir.name, compression="", chunked_blob_threshold=cas.CHUNK_MAX
+        )
+        data = random.Random(6).randbytes(1 << 20)
+        h = cas.sig(memoryview(data), store=True)
+        self.assertEqual(h, cas.sig(data))
+        self.assertEqual(h.buffer(), data)
+
+    def test_compressed_buffer(self):
+        config.init(db_root=self.dir.name, compression="zlib")
+        data = b"a large, compressible file. " * 10000
+        h = cas.store(data)
+        self.assertEqual(h.buffer(), data)
+
+
+    def test_store_twice(self):
+        # Windows won't replace a read-only file, and there's no need to
+        src = os.path.join(self.dir.name, "src")
+        with open(src, "wb") as f:
+            f.write(b"x" * 100000)
+        h = cas.file_sig(src).hash
+        replace = os.replace
+
+        def no_replace(tmp, path):
+            if os.path.exists(path):
+                raise PermissionError(13, "Access is denied", path)
+            replace(tmp, path)
+
+        with unittest.mock.patch("os.replace", no_replace):
+            cas._cas_db.add_file(h, src)
+            cas._cas_db.add_file(h, src)
+        path = cas._cas_db.blob_fspath(h)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"x" * 100000)
+        self.assertEqual(os.listdir(os.path.dirname(path)), [os.path.basename(path)])
+
+
+class CompressTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        config.init(db_root=self.dir.name, compression="zlib")
+
+    def tearDown(self):
+        config.init()
+        self.dir.cleanup()
+
+    def test_db_records(self):
+        db = cas._cas_db._db
+        text = b"some very compressible text. " * 100
+        noise = random.Random(3).randbytes(1000)
+        nul = b"\0" + noise
+        for data in (text, noise, nul):
+            h = cas.store(data)
+            self.assertEqual(h.object(), data)
+            self.assertEqual(cas._cas_db.record(h.hash), data)
+        self.assertEqual(db[cas.sig(text).hash][:2], b"\0\1")
+        self.assertLess(len(db[cas.sig(text).hash]), len(text) // 4)
+        self.assertEqual(db[cas.sig(noise).hash], noise)
+        self.assertEqual(db[cas.sig(nul).hash], b"\0\0" + nul)
+
+        # raw records from before compression still read back
+        legacy = b"\0\1" + noise
+        db[cas.sig(legacy).hash] = legacy
+        self.assertEqual(cas.sig(legacy).object(), legacy)
+
+    def test_blob_files(self):
+        data = b"a large, compressible file. " * 10000
+        h = cas.store(data)
+        zpath = h.get_fspath(kind="zblob")
+        self.assertTrue(os.path.exists(zpath))
+        self.assertLess(os.path.getsize(zpath), len(data) // 4)
+        self.assertFalse(os.path.exists(h.get_fspath(kind="blob")))
+        self.assertEqual(h.object(), data)
+        self.assertEqual(b"".join(cas.iter_bytes(h)), data)
+        self.assertTrue(cas.verify_file(h.hash, zpath, compressed=True))
+
+        # tools get a plain file
+        with open(h.stored_fspath(), "rb") as f:
+            self.assertEqual(f.read(), data)
+
+        self.assertEqual(cas.store_stream(io.BytesIO(data + b"!")).object(), data + b"!")
+        noise = random.Random(4).randbytes(200000)
+        self.assertTrue(os.path.exists(cas.store(noise).get_fspath(kind="blob")))
+
+    def test_lzma(self):
+        config.init(db_root=self.dir.name, compression="lzma")
+        data = b"a large, compressible file. " * 10000
+        self.assertEqual(cas.store(data).object(), data)
+        self.assertEqual(cas.store(data[:1000]).object(), data[:1000])
+
+
+class RopeTest(unittest.TestCase):
+    def setUp(self):
+        config.init()
+
+    def test_rope_roundtrip(self):
+        x = [f"element {i}" * 4 for i in range(5000)]
+        h = cas.store(x)
+        self.assertEqual(cas.hsplit(h._get_bits())[0].object(), b"LR")
+        self.assertEqual(h.object(), x)
+        self.assertEqual(cas.store(tuple(x)).object(), tuple(x))
+        self.assertNotEqual(cas.sig(tuple(x)), h)
+        self.assertEqual(list(cas.iter_list(h)), x)
+
+        lazy = h.object(lazy=True)
+        self.assertEqual(len(lazy), len(x))
+        for i in (0, 1, 127, 128, 2500, 4999, -1, -5000):
+            self.assertEqual(lazy[i], x[i])
+        self.assertEqual(lazy[10:20], x[10:20])
+        self.assertEqual(lazy, x)
+        with self.assertRaises(IndexError):
+            lazy[5000]
+
+    def test_rope_edit(self):
+        # small ints are inline, so only rope nodes get stored
+        x = list(range(20000))
+        h = cas.store(x)
+        db = cas._cas_db._db
+        before = set(db.keys())
+        x[12345] = -1
+        h2 = cas.store(x)
+        self.assertNotEqual(h2, h)
+        self.assertEqual(h2.object(), x)
+        # just the records along the path to the root
+        self.assertLessEqual(len(set(db.keys()) - before), 4)
+
+        # and only they are hashed again
+        x[54321 % len(x)] = -2
+        with unittest.mock.patch.object(cas, "_new_hash", wraps=cas._new_hash) as new_hash:
+            cas.sig(x)
+        self.assertLessEqual(new_hash.call_count, 6)
+
+        # insertions only disturb nearby runs too
+        x.insert(100, "inserted")
+        before = set(db.keys())
+        cas.store(x)
+        self.assertLessEqual(len(set(db.keys()) - before), 8)
+
+
+class DictSumTest(unittest.TestCase):
+    def setUp(self):
+        config.init()
+
+    def test_dict_sum(self):
+        x = {f"key {i}": i for i in range(1000)}
+        h = cas.store(x)
+        self.assertEqual(cas.hsplit(h._get_bits())[0].object(), b"DS")
+        self.assertEqual(cas.sig(util.imdict(x)), h)
+        self.assertEqual(h.object(), x)
+        self.assertEqual(type(h.object()), util.imdict)
+        lazy = h.object(lazy=True)
+        self.assertEqual(lazy["key 500"], 500)
+        self.assertEqual(dict(lazy), x)
+
+        y = dict(x)
+        y["key 500"] = -1
+        self.assertNotEqual(cas.sig(y), h)
+        # insertion order doesn't matter
+        self.assertEqual(cas.sig(dict(reversed(x.items()))), h)
+
+    def test_incremental(self):
+        d = util.imdict({f"key {i}": i for i in range(1000)})
+        cas.sig(d)
+        derived = [
+            d.updated({"key 3": "three", "new key": 1}),
+            d - ["key 3", "key 4"],
+            d & [f"key {i}" for i in range(900)],
+        ]
+        for d2 in derived:
+            self.assertIsNotNone(d2.__base__)
+            h = cas.sig(d2)
+            self.assertIsNone(d2.__base__)
+            self.assertEqual(h, cas.sig(dict(d2)))
+            self.assertEqual(cas.store(d2).object(), d2)
+        # derived dicts chain
+        d3 = derived[0].updated({"key 5": "five"})
+        self.assertEqual(cas.sig(d3), cas.sig(dict(d3)))
+
+        # mutable values can't be cached
+        m = util.imdict({f"key {i}": [i] for i in range(1000)})
+        h = cas.sig(m)
+        m["key 1"].append(1)
+        self.assertNotEqual(cas.sig(m), h)
+
+    def test_tampered(self):
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+        self.addCleanup(config.init)
+        config.init(db_root=d.name)
+        x = {f"key {i}": i for i in range(1000)}
+        h = cas.store(x)
+        # swap in other values: the record's hash doesn't cover them
+        total, ks, vs = cas.hsplit(h._get_bits())[1:]
+        other = cas.store([666] * 1000)
+        cas._cas_db._db.put(h.hash, cas._DICT_SUM.hash + total.hash + ks.hash + other.hash)
+        with self.assertRaises(RuntimeError):
+            h.object()
+        with self.assertRaises(RuntimeError):
+            h.object(lazy=True)["key 1"]
+
+
+class HashAlgorithmTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        config.init()
+        self.dir.cleanup()
+
+    def test_algorithms(self):
+        data = random.Random(7).randbytes(cas.TREE_LEAF * 2 + 12345)
+        sigs = set()
+        for name in cas.HASH_ALGORITHMS:
+            with self.subTest(name):
+                config.init(db_root=os.path.join(self.dir.name, name), hash_algorithm=name)
+                h = cas.store(data)
+                self.assertEqual(cas.hash_byte_stream(io.BytesIO(data)), h)
+                self.assertEqual(cas.store_stream(io.BytesIO(data)), h)
+                self.assertEqual(h.object(), data)
+                self.assertTrue(cas.verify_record(cas.sig(b"x" * 100).hash, b"x" * 100))
+
+                # the flag bits mean the same
+                self.assertEqual(h.hash[0] & ~cas.HFLAG_MASK, cas.HFLAG_LONG)
+                c = cas.store([1, 2, data])
+                self.assertEqual(c.hash[0] & ~cas.HFLAG_MASK, cas.HFLAG_LONG | cas.HFLAG_COMPOUND)
+                self.assertEqual(c.object(), [1, 2, data])
+                self.assertEqual(cas.sig(b"short").hash, b"\x06short")
+                sigs.add(h)
+        self.assertEqual(len(sigs), len(cas.HASH_ALGORITHMS))
+
+    def test_tree_hash(self):
+        import hashlib
+
+        def node(data, offset, depth, last):
+            return hashlib.blake2b(
+                data, digest_size=32, fanout=0, depth=2, leaf_size=cas.TREE_LEAF, inner_size=32,
+                node_offset=offset, node_depth=depth, last_node=last,
+            ).digest()
+
+        config.init(db_root=self.dir.name, hash_algorithm="blake2b-tree")
+        n = cas.TREE_LEAF
+        for size in (n, n + 1, 3 * n):
+            data = random.Random(size).randbytes(size)
+            leaves = [data[i : i + n] for i in range(0, size, n)]
+            if len(leaves) == 1:
+                expected = hashlib.blake2b(data, digest_size=32).digest()
+            else:
+                digests = [node(x, i, 0, i == len(leaves) - 1) for (i, x) in enumerate(leaves)]
+                expected = node(b"".join(digests), 0, 1, True)
+            self.assertEqual(cas.hash_bytes(data).hash[1:], expected[1:])
+            # fed in pieces that don't line up with the leaves
+            h = cas._TreeHash()
+            for i in range(0, size, 100000):
+                h.update(data[i : i + 100000])
+            self.assertEqual(h.digest(), expected)
+
+    def test_mixing_refused(self):
+        config.init(db_root=self.dir.name, hash_algorithm="blake2s")
+        h = cas.store(b"x" * 100)
+        with self.assertRaises(ValueError):
+            config.init(db_root=self.dir.name)
+        self.assertEqual(cas.hash_algorithm(), "blake2s")
+        with self.assertRaises(ValueError):
+            config.init(db_root=self.dir.name, hash_algorithm="md5")
+        self.assertEqual(cas.hash_algorithm(), "blake2s")
+        config.init(db_root=self.dir.name, hash_algorithm="blake2s")
+        self.assertEqual(h.object(), b"x" * 100)
+
+        # stores from before the algorithm was recorded are SHA-256
+        old = os.path.join(self.dir.name, "old")
+        config.init(db_root=old)
+        os.remove(os.path.join(old, "cas", "hash_algorithm"))
+        with self.assertRaises(ValueError):
+            config.init(db_root=old, hash_algorithm="blake2b")
+        self.assertEqual(cas.hash_algorithm(), "sha256")
+        config.init(db_root=old)
+
 
 if __name__ == "__main__":
     import logging
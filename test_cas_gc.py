@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import os, tempfile, unittest
+import cas, cas_gc, config, fs, memo
+
+
+class GcTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        config.init(db_root=self.dir.name, blob_file_threshold=64)
+
+    def tearDown(self):
+        config.init()
+        self.dir.cleanup()
+
+    def memoize(self, arg, res):
+        arg_sig = cas.sig(arg)
+        memo.put_memo(arg_sig, cas.store(res))
+        return arg_sig
+
+    def test_collect(self):
+        blob = fs.Blob(bytes=b"live file contents " * 10)
+        tree = fs.Tree({"a": blob})
+        live = ["a live record, long enough to be stored", tree]
+        self.memoize("live", live)
+        os.fspath(tree)
+
+        dead = cas.store(["a dead record, long enough to be stored"])
+        dead_blob = cas.store(b"dead file contents " * 10)
+        dead_tree = fs.Tree({"b": fs.Blob(bytes=b"another dead file" * 10)})
+        dead_path = os.fspath(dead_tree)
+        self.assertTrue(os.path.exists(dead_blob.stored_fspath()))
+
+        cas_gc.collect()
+        self.assertNotIn(dead.hash, cas._cas_db)
+        self.assertIsNone(dead_blob.stored_fspath())
+        self.assertFalse(os.path.exists(dead_path))
+        # blob contents are only referred to by hash bytes, but still kept
+        self.assertIsNotNone(blob.content_sig.stored_fspath())
+        self.assertTrue(os.path.exists(os.fspath(tree)))
+        res = memo.get_memo(cas.sig("live")).object()
+        self.assertEqual(cas.sig(res), cas.sig(live))
+        self.assertEqual(res[1]["a"].bytes(), blob.bytes())
+
+    def test_short_blobs(self):
+        # files for short hashes are never marked, since their contents are
+        # in the hash, but paths to them are handed out like any other
+        small = fs.Blob(bytes=b"tiny")
+        self.memoize("live", fs.Tree({"small": small}))
+        path = os.fspath(small)
+        cas_gc.collect()
+        self.assertTrue(os.path.exists(path))
+
+    def test_packed(self):
+        live = ["a live record, long enough to be stored"]
+        self.memoize("live", live)
+        dead = cas.store(["a dead record, long enough to be stored"])
+        cas._cas_db.repack()
+        self.assertIn(dead.hash, cas._cas_db)
+        cas_gc.collect()
+        self.assertNotIn(dead.hash, cas._cas_db)
+        self.assertEqual(memo.get_memo(cas.sig("live")).object(), live)
+
+    def test_resume(self):
+        live = [f"live record number {i}, long enough to be stored" for i in range(5)]
+        self.memoize("live", live)
+        dead = cas.store(["a dead record, long enough to be stored"])
+        self.assertFalse(cas_gc.mark(checkpoint=1, limit=2))
+        self.assertFalse(cas_gc.mark(checkpoint=1, limit=2))
+        cas_gc.collect()
+        self.assertNotIn(dead.hash, cas._cas_db)
+        self.assertEqual(memo.get_memo(cas.sig("live")).object(), live)
+
+    def test_budget(self):
+        old = ["an old record, long enough to be stored"]
+        new = ["a new record, long enough to be stored"]
+        old_arg = self.memoize("old", old)
+        new_arg = self.memoize("new", new)
+        size = cas_gc.collect(budget=1)
+        self.assertGreater(size, 0)
+        self.assertIsNone(memo.get_memo(old_arg))
+        self.assertNotIn(cas.sig(old).hash, cas._cas_db)
+        self.assertEqual(memo.get_memo(new_arg).object(), new)
+
+        # everything fits
+        self.assertEqual(cas_gc.collect(budget=1 << 30), size)
+        self.assertEqual(memo.get_memo(new_arg).object(), new)
+
+
+if __name__ == "__main__":
+    unittest.main()
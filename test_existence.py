@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import hashlib, os, tempfile, unittest
+import cas, config, existence
+
+
+def key(i):
+    return hashlib.sha256(b"%d" % i).digest()
+
+
+class ExistenceTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "exists.bloom")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_bloom(self):
+        bf = existence.BloomFilter(1000)
+        for i in range(1000):
+            bf.add(key(i))
+        self.assertTrue(bf.full())
+        self.assertTrue(all(key(i) in bf for i in range(1000)))
+        false_positives = sum(key(i) in bf for i in range(1000, 11000))
+        self.assertLess(false_positives, 300)
+
+    def test_index(self):
+        listed = []
+        ix = existence.ExistenceIndex(self.path, lambda: [key(0)])
+        n = existence.FIRST_CAPACITY * 3 // 2
+        for i in range(1, n):
+            ix.add(key(i))
+        self.assertEqual(len(ix._filters), 2)
+        self.assertTrue(ix.present(key(1)))
+        self.assertFalse(ix.present(key(0)))
+        self.assertFalse(ix.absent(key(0)))
+        ix.discard([key(1)])
+        self.assertFalse(ix.present(key(1)))
+        self.assertFalse(ix.absent(key(1)))
+        ix.close()
+
+        # a snapshot is loaded instead of listing everything
+        ix = existence.ExistenceIndex(self.path, lambda: listed.append(1) or [])
+        self.assertEqual(listed, [])
+        self.assertFalse(any(ix.absent(key(i)) for i in range(n)))
+        self.assertFalse(ix.present(key(1)))
+
+    def test_shared(self):
+        # two processes' indexes on one snapshot, one of which grows
+        a = existence.ExistenceIndex(self.path, lambda: [])
+        b = existence.ExistenceIndex(self.path, lambda: [])
+        a.add(key(0))
+        n = existence.FIRST_CAPACITY * 3 // 2
+        for i in range(1, n):
+            b.add(key(i))
+        added = sum(bf.count for bf in b._filters)
+        b.close()
+        a.add(key(n))
+        a.close()
+        ix = existence.ExistenceIndex(self.path, lambda: [])
+        self.assertFalse(any(ix.absent(key(i)) for i in range(n + 1)))
+        self.assertEqual([bf.capacity for bf in ix._filters], [bf.capacity for bf in b._filters])
+        self.assertEqual(sum(bf.count for bf in ix._filters), added + 2)
+
+    def test_cas(self):
+        config.init(db_root=self.dir.name)
+        try:
+            x = ["a record, long enough to be stored", 1]
+            h = cas.store(x)
+            self.assertTrue(cas._cas_db._exists.present(h.hash))
+            self.assertTrue(cas._cas_db._exists.absent(cas.sig(["not stored"]).hash))
+
+            config.init(db_root=self.dir.name)
+            self.assertFalse(cas._cas_db._exists.absent(h.hash))
+            self.assertIn(h.hash, cas._cas_db)
+            cas._cas_db.discard_records([h.hash])
+            self.assertNotIn(h.hash, cas._cas_db)
+            self.assertEqual(cas.store(x), h)
+            self.assertEqual(h.object(), x)
+        finally:
+            config.init()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,8 +3,8 @@
 import unittest
 import config
 import fs
-import cas
-import os
+import cas, cas_gc
+import io, os, subprocess, sys, tempfile, time, unittest.mock
 
 
 HELLO = b"hello world\n"
@@ -23,6 +23,14 @@ class PathTest(unittest.TestCase):
         self.assertEqual(str(p / "../../../w"), "{src_root}/w")
 
 
+class ImportTest(unittest.TestCase):
+    def test_import_after_init(self):
+        # oninit runs init right away if config is already initialized
+        code = "import config; config.init(); import fs, watcher"
+        here = os.path.dirname(os.path.abspath(__file__))
+        subprocess.run([sys.executable, "-c", code], cwd=here, check=True)
+
+
 class BlobTest(unittest.TestCase):
     def setUp(self):
         config.init()
@@ -34,6 +42,193 @@ class BlobTest(unittest.TestCase):
             self.assertEqual(f.read(), HELLO)
         self.assertEqual(b.path(), fs.cas_root / "blob/0d/68656c6c6f20776f726c640a")
 
+    def test_large_blob(self):
+        data = HELLO * 20000
+        b = fs.Blob(bytes=data)
+        self.assertIsNone(b._bytes)
+        self.assertNotIn(b.content_sig.hash, cas._cas_db._db)
+        self.assertEqual(
+            b.content_sig.stored_fspath(), b.content_sig.get_fspath(kind="blob")
+        )
+        self.assertEqual(b.bytes(), data)
+        self.assertIsNone(b._bytes)
+        self.assertEqual(b.buffer(), data)
+        self.assertEqual(fs.Blob(bytes=HELLO).buffer(), HELLO)
+        with open(b, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+        x = fs.XBlob(content_sig=b.content_sig)
+        with open(x, "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertTrue(os.stat(x).st_mode & 0o100)
+
+    def test_chunked_blob(self):
+        config.init(chunked_blob_threshold=100000)
+        try:
+            data = os.urandom(1 << 20)
+            b = fs.Blob(bytes=data)
+            self.assertTrue(b.content_sig.is_chunked())
+            with open(b, "rb") as f:
+                self.assertEqual(f.read(), data)
+
+            # a file with the same contents gets the same sig
+            p = fs.out_root / "chunked.bin"
+            p.remove()
+            os.makedirs(os.path.dirname(p), exist_ok=True)
+            with open(p, "wb") as f:
+                f.write(data)
+            self.assertEqual(p.contents(), b)
+        finally:
+            config.init()
+
+    def test_blob_from_stream(self):
+        for data in (HELLO, HELLO * 20000):
+            with self.subTest(size=len(data)):
+                b = fs.Blob.from_stream(io.BytesIO(data))
+                self.assertEqual(b.content_sig, cas.sig(data))
+                self.assertEqual(b.bytes(), data)
+
+
+class LazySrcTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        src = os.path.join(self.dir.name, "src")
+        os.makedirs(src)
+        config.init(db_root=self.dir.name, src_root=src, lazy_src_files=True)
+        for name in ("a", "b", "c"):
+            with open(os.path.join(src, name), "wb") as f:
+                f.write(name.encode() * 1000)
+
+    def tearDown(self):
+        config.init()
+        self.dir.cleanup()
+
+    def test_lazy_src(self):
+        t = fs.src_root.contents()
+        a, b, c = t["a"], t["b"], t["c"]
+        self.assertFalse(os.path.exists(os.path.join(fs.cas_root, "blob")))
+        self.assertIn(a.content_sig.hash, cas._cas_db)
+        self.assertEqual(a.bytes(), b"a" * 1000)
+
+        # a CAS file is made when a path is needed
+        with open(b, "rb") as f:
+            self.assertEqual(f.read(), b"b" * 1000)
+        self.assertNotEqual(os.path.realpath(b), os.path.realpath(fs.src_root / "b"))
+
+        # the contents of a changed source file are gone, unless copied
+        for name in ("a", "b"):
+            with open(fs.src_root / name, "ab") as f:
+                f.write(b"!")
+        self.assertNotIn(a.content_sig.hash, cas._cas_db)
+        self.assertEqual(b.content_sig.object(), b"b" * 1000)
+        self.assertEqual(c.content_sig.object(), b"c" * 1000)
+
+        out = fs.out_root / "c"
+        c.write_copy(out)
+        with open(out, "rb") as f:
+            self.assertEqual(f.read(), b"c" * 1000)
+
+
+    def test_same_as_source(self):
+        # output with the contents of a source file is stored for real,
+        # since the source may change
+        config.init(
+            db_root=self.dir.name,
+            src_root=os.path.join(self.dir.name, "src"),
+            lazy_src_files=True,
+            blob_file_threshold=64,
+        )
+        a = fs.src_root.contents()["a"]
+        s = cas.store_stream(io.BytesIO(b"a" * 1000))
+        self.assertEqual(s, a.content_sig)
+        with open(fs.src_root / "a", "ab") as f:
+            f.write(b"!")
+        self.assertEqual(s.object(), b"a" * 1000)
+
+
+class DirCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.dir.name, "src")
+        config.init(db_root=self.dir.name, src_root=self.src)
+        self.write("a", b"a" * 100)
+        self.write("sub/b", b"b" * 100)
+        self.write("sub/deeper/c", b"c" * 100)
+
+    def tearDown(self):
+        config.init()
+        self.dir.cleanup()
+
+    def write(self, rel, data):
+        p = os.path.join(self.src, rel)
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        with open(p, "wb") as f:
+            f.write(data)
+        # (as if done a while before the scan; see fs.RACY_NS)
+        mtime = time.time_ns() - 2 * fs.RACY_NS
+        for (d, _, _) in os.walk(self.src):
+            if os.stat(d).st_mtime_ns > mtime:
+                os.utime(d, ns=(mtime, mtime))
+
+    def scan(self):
+        # (contents, directories listed)
+        with unittest.mock.patch("os.scandir", wraps=os.scandir) as scandir:
+            t = fs.src_root.contents()
+        self.assertEqual(cas.sig(t), cas.sig(self.walk(fs.src_root)))
+        return t, scandir.call_count
+
+    def walk(self, path):
+        # plain recursive scan, for comparison
+        if os.path.isdir(path):
+            return fs.Tree({name: self.walk(path / name) for name in sorted(os.listdir(path))})
+        return fs._file_contents(path, os.stat(path))
+
+    def test_dir_cache(self):
+        t, n = self.scan()
+        self.assertEqual(n, 3)
+        t2, n = self.scan()
+        self.assertEqual(n, 0)
+        self.assertEqual(cas.sig(t2), cas.sig(t))
+
+        # a changed file is noticed without listing anything
+        self.write("sub/deeper/c", b"changed")
+        t3, n = self.scan()
+        self.assertEqual(n, 0)
+        self.assertEqual(t3["sub/deeper/c"].bytes(), b"changed")
+        self.assertEqual(cas.sig(t3["sub/b"]), cas.sig(t["sub/b"]))
+
+        # new files and mode changes
+        self.write("sub/new", b"new")
+        os.chmod(os.path.join(self.src, "a"), 0o755)
+        t4, n = self.scan()
+        self.assertEqual(n, 1)
+        self.assertIsInstance(t4["a"], fs.XBlob)
+        self.assertEqual(t4["sub/new"].bytes(), b"new")
+
+        # also across runs
+        config.init(db_root=self.dir.name, src_root=self.src)
+        t5, n = self.scan()
+        self.assertEqual(n, 0)
+        self.assertEqual(cas.sig(t5), cas.sig(t4))
+
+        # gc deletes the (unreferenced) contents, so everything is rescanned
+        cas_gc.collect()
+        t6, n = self.scan()
+        self.assertEqual(n, 3)
+        self.assertEqual(t6["sub/b"].bytes(), b"b" * 100)
+
+    def test_racy(self):
+        # a directory modified just now could change again without its stat
+        # result changing, so it isn't recorded
+        self.scan()
+        with open(os.path.join(self.src, "sub", "new"), "wb") as f:
+            f.write(b"new")
+        t, n = self.scan()
+        self.assertEqual(n, 1)
+        self.assertIsNone(cas.dir_info(fs.src_root / "sub", os.stat(fs.src_root / "sub")))
+        t, n = self.scan()
+        self.assertEqual(n, 1)
+
 
 class TreeTest(unittest.TestCase):
     def setUp(self):
@@ -59,6 +254,39 @@ class TreeTest(unittest.TestCase):
         t1 = fs.Tree({"world": b1, "sub1": t0, "sub2": t0})
         self.assertEqual(os.fspath(t1), os.path.normpath(fs.cas_root / "tree/ff/a9429c489720aada4c4d9ea2675b9b0c72f82bf1400ce424a34b04453a01eb"))
 
+    def test_scan_workers(self):
+        def walk(path):
+            # plain recursive scan, for comparison
+            if os.path.isdir(path):
+                return fs.Tree(
+                    {name: walk(path / name) for name in sorted(os.listdir(path))}
+                )
+            return path.contents()
+
+        expected = cas.sig(walk(fs.src_root))
+        for workers in (1, 4):
+            with self.subTest(workers=workers):
+                config.init(scan_workers=workers)
+                self.assertEqual(cas.sig(fs.src_root.contents()), expected)
+        config.init()
+
+    def test_tree_sig_cache(self):
+        t = fs.src_root.contents()
+        h = cas.sig(t)
+        self.assertEqual(t.__sig__, h)
+        self.assertEqual(t["lib1"].__sig__, cas.sig(t["lib1"]))
+        self.assertEqual(cas.sig(t), cas.sig(fs.src_root.contents()))
+
+    def test_lazy_tree(self):
+        t = fs.src_root.contents()
+        h = cas.store(t)
+        lt = h.object(lazy=True)
+        self.assertIsInstance(lt, fs.Tree)
+        self.assertIs(cas.sig(lt), h)
+        self.assertEqual(lt["lib1/lib1.h"], t["lib1/lib1.h"])
+        self.assertEqual(cas.sig(lt["lib2"]), cas.sig(t["lib2"]))
+        self.assertEqual(os.fspath(lt), os.fspath(t))
+
     def test_blob_path(self):
         t = fs.src_root.contents()
         p1 = t / "somefile.txt"
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import concurrent.futures, hashlib, os, tempfile, unittest, unittest.mock
+import fs_sig_cache
+
+
+class FsSigCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.dir.name, "fs_sig_db")
+        self.hashed = []
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def hasher(self, path):
+        self.hashed.append(path)
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).digest()
+
+    def cache(self):
+        return fs_sig_cache.FsSigCache(self.db, hasher=self.hasher)
+
+    def write(self, name, data):
+        p = os.path.join(self.dir.name, name)
+        with open(p, "wb") as f:
+            f.write(data)
+        return p
+
+    def test_persist(self):
+        paths = [self.write(f"f{i}", b"contents %d" % i) for i in range(10)]
+        c = self.cache()
+        hs = [c.hash(p) for p in paths]
+        self.assertEqual(len(self.hashed), 10)
+        self.assertEqual(c.hash(paths[0]), hs[0])
+        self.assertEqual(len(self.hashed), 10)
+        c.close()
+
+        # loaded from the snapshot
+        c = self.cache()
+        self.assertEqual([c.hash(p) for p in paths], hs)
+        self.assertEqual(len(self.hashed), 10)
+        self.write("f0", b"changed, and a different size")
+        self.assertNotEqual(c.hash(paths[0]), hs[0])
+        self.assertEqual(len(self.hashed), 11)
+        c.flush()  # to the journal
+
+        # a crash mid-append leaves a torn record
+        with open(self.db + ".journal", "ab") as f:
+            f.write(b"\x01\x02\x03")
+        c2 = self.cache()
+        self.assertEqual(c2.hash(paths[0]), c.hash(paths[0]))
+        self.assertEqual(len(self.hashed), 11)
+        p = self.write("new", b"new file")
+        c2.hash(p)
+        c2.close()
+
+        # compaction keeps entries from both instances
+        c.compact()
+        c.close()
+        with open(self.db + ".journal", "rb") as f:
+            self.assertEqual(f.read(), fs_sig_cache.JOURNAL_MAGIC)
+        c = self.cache()
+        for q in paths + [p]:
+            c.hash(q)
+        self.assertEqual(len(self.hashed), 12)
+        c.close()
+
+    def test_hash_many(self):
+        paths = [self.write(f"f{i}", b"contents %d" % i) for i in range(10)]
+        c = self.cache()
+        c.hash(paths[0])
+        missing = os.path.join(self.dir.name, "missing")
+        entries = [(p, None) for p in paths] + [(missing, None), (self.dir.name, None)]
+        with concurrent.futures.ThreadPoolExecutor(4) as pool:
+            with unittest.mock.patch.object(c, "_put_many", wraps=c._put_many) as put:
+                hs = c.hash_many(entries, pool)
+        self.assertEqual(put.call_count, 1)  # written back together
+        self.assertEqual(len(self.hashed), 10)
+        self.assertEqual(hs[:10], [c.hash(p) for p in paths])
+        self.assertIsInstance(hs[10], FileNotFoundError)
+        self.assertIsInstance(hs[11], IsADirectoryError)
+        self.assertEqual(c.hash_many([(p, os.stat(p)) for p in paths]), hs[:10])
+        self.assertEqual(len(self.hashed), 10)
+
+        # a file changed while hashing is reported, and not cached
+        def hasher(path):
+            h = self.hasher(path)
+            if path.endswith(b"f3"):
+                self.write("f3", b"changed while hashing")
+            return h
+
+        self.write("f2", b"changed")
+        self.write("f3", b"changed")
+        c._hasher = hasher
+        hs = c.hash_many([(p, None) for p in paths])
+        self.assertIsInstance(hs[3], fs_sig_cache.RaceError)
+        self.assertEqual(hs[2], c.hash(paths[2]))
+        with self.assertRaises(fs_sig_cache.RaceError):
+            c.hash(paths[3])
+        c.close()
+
+    def test_damaged_snapshot(self):
+        p = self.write("f", b"contents")
+        c = self.cache()
+        c.hash(p)
+        c.close()
+        with open(self.db + ".snap", "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"?")
+        c = self.cache()
+        c.hash(p)  # hashed again
+        self.assertEqual(len(self.hashed), 2)
+        c.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import os, shutil, subprocess, tempfile, unittest, unittest.mock
+import cas, config, fs, gitstore
+
+
+def git(repo, *args):
+    subprocess.run(
+        ["git", "-C", repo, "-c", "user.name=test", "-c", "user.email=test@example.com"]
+        + list(args),
+        check=True,
+        capture_output=True,
+    )
+
+
+@unittest.skipIf(shutil.which("git") is None, "needs git")
+class GitStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.dir.name, "src")
+        os.makedirs(os.path.join(self.src, "sub"))
+        git(self.src, "init", "-q")
+        self.files = {
+            "a.txt": b"some file contents\n" * 10,
+            "sub/b.txt": b"more file contents\n" * 10,
+            "run.sh": b"#!/bin/sh\necho hello, world\n",
+        }
+        for (name, data) in self.files.items():
+            with open(os.path.join(self.src, name), "wb") as f:
+                f.write(data)
+        os.chmod(os.path.join(self.src, "run.sh"), 0o755)
+        git(self.src, "add", ".")
+        git(self.src, "commit", "-q", "-m", "test")
+        config.init(db_root=os.path.join(self.dir.name, "db"), src_root=self.src)
+
+    def tearDown(self):
+        config.init()
+        self.dir.cleanup()
+
+    def test_tree(self):
+        t = gitstore.GitRepo(self.src).tree()
+        # contents weren't copied into the CAS
+        self.assertFalse(os.path.exists(os.path.join(fs.cas_root, "blob")))
+        self.assertIsInstance(t["run.sh"], fs.XBlob)
+        blob = lambda name, cls=fs.Blob: cls(content_sig=cas.sig(self.files[name]))
+        expected = fs.Tree(
+            {
+                "a.txt": blob("a.txt"),
+                "sub": fs.Tree({"b.txt": blob("sub/b.txt")}),
+                "run.sh": blob("run.sh", fs.XBlob),
+            }
+        )
+        self.assertEqual(cas.sig(t), cas.sig(expected))
+
+        # later revisions in the working tree don't matter
+        with open(os.path.join(self.src, "a.txt"), "wb") as f:
+            f.write(b"changed")
+        config.init(db_root=os.path.join(self.dir.name, "db"), src_root=self.src)
+        # an unchanged tree is found by one lookup, and its entries are only
+        # read when used
+        with unittest.mock.patch.object(
+            cas.Sig, "_get_bits", autospec=True, side_effect=cas.Sig._get_bits
+        ) as get:
+            t = gitstore.GitRepo(self.src).tree("HEAD")
+        read = {c.args[0] for c in get.call_args_list}
+        self.assertNotIn(cas.sig(expected["sub"]), read)
+        for (name, data) in self.files.items():
+            self.assertEqual(t[name].bytes(), data)
+        with open(t["sub/b.txt"], "rb") as f:
+            self.assertEqual(f.read(), self.files["sub/b.txt"])
+        self.assertTrue(os.path.exists(os.fspath(t)))
+
+        with self.assertRaises(ValueError):
+            gitstore.GitRepo(self.src).tree("no-such-rev")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import os, tempfile, unittest, unittest.mock
+import kvstore
+
+
+class KVStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def check_engine(self, engine):
+        path = os.path.join(self.dir.name, "db")
+        db = kvstore.open_store(path, engine)
+        self.assertIsNone(db.get(b"a"))
+        self.assertNotIn(b"a", db)
+        db.put(b"a", b"1")
+        db[b"b"] = b"2"
+        db.put_many([(b"c", b"3"), (b"d", b"4"), (b"c", b"5")])
+        self.assertEqual(db[b"a"], b"1")
+        self.assertEqual(db.get(b"c"), b"5")
+        self.assertIn(b"d", db)
+        with self.assertRaises(KeyError):
+            db[b"x"]
+        self.assertEqual(
+            sorted(db.items()), [(b"a", b"1"), (b"b", b"2"), (b"c", b"5"), (b"d", b"4")]
+        )
+        self.assertEqual(sorted(db.keys()), [b"a", b"b", b"c", b"d"])
+        db.delete_many([b"a", b"x"])
+        self.assertNotIn(b"a", db)
+        self.assertEqual(sorted(db.keys()), [b"b", b"c", b"d"])
+        db.close()
+
+        # contents persist across reopen
+        db = kvstore.open_store(path, engine)
+        self.assertEqual(db.get(b"b"), b"2")
+        db.clear()
+        self.assertEqual(list(db.keys()), [])
+        db.close()
+
+    def test_sqlite(self):
+        self.check_engine("sqlite")
+
+    def test_dbm(self):
+        self.check_engine("dbm")
+
+    def test_dbm_shared(self):
+        path = os.path.join(self.dir.name, "db")
+        a = kvstore.open_store(path, "dbm")
+        b = kvstore.open_store(path, "dbm")
+        a.put(b"k", b"1")
+        with unittest.mock.patch("dbm.open", wraps=kvstore.dbm.open) as dbm_open:
+            # reads reuse a handle until something is written
+            for _ in range(10):
+                self.assertEqual(b.get(b"k"), b"1")
+            self.assertEqual(dbm_open.call_count, 1)
+            a.put(b"k", b"2")
+            self.assertEqual(b.get(b"k"), b"2")
+        a.close()
+        b.close()
+
+    def test_sqlite_concurrent_reader(self):
+        path = os.path.join(self.dir.name, "db")
+        w = kvstore.open_store(path, "sqlite")
+        r = kvstore.open_store(path, "sqlite")
+        w.put_many([(bytes([i]), b"x") for i in range(10)])
+        self.assertEqual(len(list(r.keys())), 10)
+        r.close()
+        w.close()
+
+    def test_bad_engine(self):
+        with self.assertRaises(ValueError):
+            kvstore.open_store(os.path.join(self.dir.name, "db"), "nope")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Stress test: several builder processes sharing one cas_root.
+"""
+import multiprocessing, os, tempfile, unittest
+import cas, config, fs, memo, validate_cas
+
+PROCESSES = 4
+ROUNDS = 20
+
+
+@memo.memoize
+def make_tree(n):
+    # overlaps with other n, so processes race on the same objects
+    return fs.Tree(
+        {
+            "common": fs.Blob(bytes=b"shared by every tree " * 20),
+            "mine": fs.Blob(bytes=f"tree number {n} ".encode() * 20),
+            "sub": fs.Tree({"tool": fs.XBlob(bytes=b"#!/bin/sh\n" * (n % 3 + 10))}),
+        }
+    )
+
+
+def _builder(db_root, engine, seed):
+    config.init(db_root=db_root, db_engine=engine, blob_file_threshold=64)
+    try:
+        sigs = {}
+        for i in range(ROUNDS):
+            n = (seed + i) % 7
+            tree = make_tree(n)
+            path = os.fspath(tree)
+            with open(os.path.join(path, "mine"), "rb") as f:
+                assert f.read() == f"tree number {n} ".encode() * 20
+            assert os.access(os.path.join(path, "sub", "tool"), os.X_OK)
+            tree.write_copy(fs.out_root / f"{seed}" / f"{i}", makedirs=True)
+            cas.store([f"record {i}, long enough to be stored", seed % 2])
+            sigs[n] = cas.sig(tree).hash.hex()
+        return sigs
+    finally:
+        config.uninit()
+
+
+class MultiprocessTest(unittest.TestCase):
+    def test_shared_cas_root(self):
+        ctx = multiprocessing.get_context("spawn")
+        for engine in ("sqlite", "dbm"):
+            with self.subTest(engine=engine), tempfile.TemporaryDirectory() as d:
+                with ctx.Pool(PROCESSES) as pool:
+                    results = pool.starmap(
+                        _builder, [(d, engine, seed) for seed in range(PROCESSES)]
+                    )
+                # everybody agrees on every result
+                merged = {}
+                for sigs in results:
+                    for (n, h) in sigs.items():
+                        self.assertEqual(merged.setdefault(n, h), h)
+
+                config.init(db_root=d, db_engine=engine, blob_file_threshold=64)
+                try:
+                    report = validate_cas.validate(jobs=1)
+                    self.assertTrue(report["ok"], report["errors"])
+                    self.assertEqual(report["warnings"], [])
+                    for (n, h) in merged.items():
+                        tree = memo.get(make_tree.__wrapped__, n)
+                        self.assertEqual(cas.sig(tree).hash.hex(), h)
+                finally:
+                    config.init()
+
+
+if __name__ == "__main__":
+    unittest.main()
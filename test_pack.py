@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import hashlib, tempfile, unittest
+import cas, config, pack
+
+
+def key(i):
+    return hashlib.sha256(str(i).encode()).digest()
+
+
+class PackTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_pack(self):
+        items = {key(i): str(i).encode() * (i % 7) for i in range(1000)}
+        path = pack.write_pack(self.dir.name, items.items())
+        p = pack.Pack(path)
+        self.assertEqual(len(p), len(items))
+        for (k, v) in items.items():
+            self.assertEqual(p.get(k), v)
+            self.assertIn(k, p)
+        self.assertIsNone(p.get(key(-1)))
+        self.assertNotIn(key(-1), p)
+        self.assertEqual(list(p.keys()), sorted(items))
+        self.assertEqual(dict(p.items()), items)
+        p.close()
+
+        self.assertIsNone(pack.write_pack(self.dir.name, []))
+
+    def test_packs(self):
+        packs = pack.Packs(self.dir.name)
+        other = pack.Packs(self.dir.name)
+        self.assertIsNone(packs.get(key(1)))
+        taken = packs.repack([(key(1), b"one"), (key(2), b"two")])
+        self.assertEqual(taken, [key(1), key(2)])
+        packs.repack([(key(3), b"three")])
+        self.assertEqual(len(packs), 2)
+        self.assertEqual(packs.get(key(3)), b"three")
+
+        # other instances see new packs once they refresh
+        self.assertIsNone(other.get(key(1)))
+        self.assertTrue(other.refresh())
+        self.assertFalse(other.refresh())
+        self.assertEqual(other.get(key(1)), b"one")
+
+        packs.repack([(key(4), b"four")], keep=lambda k: k != key(2))
+        self.assertEqual(len(packs), 1)
+        self.assertEqual(sorted(packs.keys()), sorted([key(1), key(3), key(4)]))
+        other.refresh()
+        self.assertEqual(other.get(key(4)), b"four")
+        packs.close()
+        other.close()
+
+
+class CasPackTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        config.init(db_root=self.dir.name)
+
+    def tearDown(self):
+        config.init()
+        self.dir.cleanup()
+
+    def test_repack(self):
+        xs = [[f"record {i}, long enough to be stored", i] for i in range(100)]
+        hs = [cas.store(x) for x in xs]
+        text = cas.store(b"compressible text " * 100)
+        other = cas.CasDB(cas._cas_root)
+
+        cas._cas_db.repack()
+        self.assertEqual(list(cas._cas_db._db.keys()), [])
+        for (x, h) in zip(xs, hs):
+            self.assertEqual(h.object(), x)
+            self.assertIn(h.hash, cas._cas_db)
+        self.assertEqual(text.object(), b"compressible text " * 100)
+        # another process with the packs already loaded
+        self.assertEqual(other[hs[0].hash], cas._cas_db[hs[0].hash])
+        other.close()
+
+        # packed records aren't stored again
+        cas.store(xs[0])
+        self.assertEqual(list(cas._cas_db._db.keys()), [])
+        new = cas.store(["a new record, long enough to be stored"])
+        self.assertIn(new.hash, cas._cas_db._db)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import os, tempfile, threading, unittest, unittest.mock
+import cas, config, fs, memo, remote_cache
+
+
+@memo.memoize
+def make(n):
+    return [f"result number {n}, long enough to be stored", fs.Blob(bytes=b"x" * 100 * n)]
+
+
+class RemoteCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.server = remote_cache.Server(os.path.join(self.dir.name, "server"))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.trace = []
+        memo.set_trace(self.trace)
+
+    def tearDown(self):
+        memo.set_trace(None)
+        config.init()
+        self.server.shutdown()
+        self.server.server_close()
+        self.dir.cleanup()
+
+    def init(self, name):
+        # a fresh local cache, sharing the server
+        config.init(
+            db_root=os.path.join(self.dir.name, name),
+            blob_file_threshold=64,
+            remote_cache=self.server.url,
+        )
+
+    def test_share(self):
+        self.init("a")
+        self.assertEqual(make(3)[0], "result number 3, long enough to be stored")
+        self.assertEqual(self.trace[-1][0], "store")
+        remote_cache.client.flush()
+        stats = remote_cache.client.stats
+        self.assertEqual(stats.count["miss"], 1)
+        self.assertGreaterEqual(stats.count["upload"], 2)
+
+        self.init("b")
+        res = make(3)
+        self.assertEqual(self.trace[-1][0], "hit")
+        self.assertEqual(res[1].bytes(), b"x" * 300)
+        self.assertTrue(os.path.exists(os.fspath(res[1])))
+        stats = remote_cache.client.stats
+        self.assertEqual(stats.count["hit"], 1)
+        self.assertGreaterEqual(stats.count["fetch"], 2)
+        self.assertIn("1 hits", remote_cache.summary())
+
+        # now it's local
+        self.init("b")
+        make(3)
+        self.assertEqual(self.trace[-1][0], "hit")
+        self.assertEqual(remote_cache.client.stats.count["hit"], 0)
+
+    def test_large_tree(self):
+        # Trees above cas.SUM_THRESHOLD entries are hashed differently
+        self.init("a")
+        tree = fs.Tree({f"f{i}": fs.Blob(bytes=b"%d" % i * 40) for i in range(1000)})
+        memo.put_memo(cas.sig("big"), cas.store(tree))
+        remote_cache.client.flush()
+        self.assertEqual(remote_cache.client.stats.count["error"], 0)
+
+        self.init("b")
+        res = memo.get_memo(cas.sig("big"))
+        self.assertEqual(res, cas.sig(tree))
+        self.assertEqual(res.object()["f7"].bytes(), b"7" * 40)
+
+    def test_tampered_dict(self):
+        # a large dict's hash doesn't cover its entries, so they're checked
+        self.init("a")
+        d = {f"key {i}": i for i in range(1000)}
+        s = cas.store(d)
+        memo.put_memo(cas.sig("dict"), s)
+        remote_cache.client.flush()
+        total, ks, _ = cas.hsplit(s._get_bits())[1:]
+        other = cas.store([666] * 1000)
+        forged = cas._DICT_SUM.hash + total.hash + ks.hash + other.hash
+        c = remote_cache.client
+        c._request("PUT", f"/cas/{other.hash.hex()}", other._get_bits())
+        # the server keeps what it has
+        status, _ = c._pool.request("PUT", f"/cas/{s.hash.hex()}", forged)
+        self.assertEqual(status, 200)
+        self.assertEqual(c.get_objects([s.hash]), [s._get_bits()])
+
+        # and clients refuse a forged copy
+        real = remote_cache.Client.get_objects
+
+        def get_objects(c, hs):
+            hs = list(hs)
+            return [forged if h == s.hash else x for (h, x) in zip(hs, real(c, hs))]
+
+        self.init("b")
+        with unittest.mock.patch.object(remote_cache.Client, "get_objects", get_objects):
+            self.assertIsNone(memo.get_memo(cas.sig("dict")))
+            self.assertIsNone(remote_cache.client.fetch(s.hash))
+        self.assertEqual(memo.get_memo(cas.sig("dict")), s)
+        self.assertEqual(s.object(), d)
+
+    def test_fetch_missing(self):
+        self.init("a")
+        s = cas.store(["a record, long enough to be stored", "and another"])
+        memo.put_memo(cas.sig("arg"), s)
+        remote_cache.client.flush()
+
+        self.init("b")
+        self.assertNotIn(s.hash, cas._cas_db)
+        self.assertEqual(s.object()[1], "and another")
+        self.assertIn(s.hash, cas._cas_db)
+
+        # no remote cache
+        config.init(db_root=os.path.join(self.dir.name, "c"))
+        self.assertIsNone(remote_cache.summary())
+        with self.assertRaises(KeyError):
+            s.object()
+
+    def test_server(self):
+        self.init("a")
+        c = remote_cache.client
+        h = cas.sig(["a record, long enough to be stored"]).hash
+        self.assertEqual(c.has([h]), [False])
+        self.assertEqual(c.get_objects([h]), [None])
+        # bad contents and dangling memo entries are refused
+        status, _ = c._pool.request("PUT", f"/cas/{h.hex()}", b"junk")
+        self.assertEqual(status, 400)
+        status, _ = c._pool.request("PUT", f"/memo/{h.hex()}", h)
+        self.assertEqual(status, 409)
+        self.assertEqual(c.get_memos([h]), [None])
+        # and so are clients using another hash algorithm
+        with unittest.mock.patch.object(cas, "hash_algorithm", return_value="blake2b"):
+            status, _ = c._pool.request("POST", "/cas/has", remote_cache._pack_hashes([h]))
+        self.assertEqual(status, 400)
+
+    def test_unreachable(self):
+        config.init(
+            db_root=os.path.join(self.dir.name, "a"),
+            remote_cache="http://127.0.0.1:1",
+        )
+        self.assertEqual(make(2)[0], "result number 2, long enough to be stored")
+        remote_cache.client.flush()
+        self.assertGreaterEqual(remote_cache.client.stats.count["error"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
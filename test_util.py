@@ -42,6 +42,24 @@ def fooey(msg):
     return "foo " + msg
 
 
+class ImdictTest(unittest.TestCase):
+    def test_immutable(self):
+        d = util.imdict(a=1, b=2)
+        for change in (
+            lambda: d.__setitem__("a", 3),
+            lambda: d.__delitem__("a"),
+            lambda: d.__ior__({"c": 3}),
+            d.clear,
+            lambda: d.update(c=3),
+            lambda: d.pop("a"),
+            d.popitem,
+            lambda: d.setdefault("c", 3),
+        ):
+            with self.assertRaises(TypeError):
+                change()
+        self.assertEqual(d, {"a": 1, "b": 2})
+
+
 class DecoratorTest(unittest.TestCase):
     def test_decorate_fun(self):
         self.assertEqual(ffoo("x"), "foo x nope")
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import json, os, stat, tempfile, unittest
+import cas, config, fs, memo, validate_cas
+
+
+class ValidateTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        config.init(db_root=self.dir.name, blob_file_threshold=64)
+        self.blob = fs.Blob(bytes=b"some file contents " * 10)
+        self.tree = fs.Tree({"a": self.blob, "x": fs.XBlob(bytes=b"#!/bin/sh")})
+        self.res = cas.store(["a result, long enough to be stored", self.tree])
+        memo.put_memo(cas.sig("arg"), self.res)
+        os.fspath(self.tree)
+
+    def tearDown(self):
+        config.init()
+        self.dir.cleanup()
+
+    def validate(self, **kwargs):
+        return validate_cas.validate(jobs=1, **kwargs)
+
+    def test_ok(self):
+        report = self.validate()
+        self.assertTrue(report["ok"], report)
+        self.assertEqual(report["checked"]["files"], 2)
+        self.assertEqual(report["checked"]["trees"], 1)
+        self.assertEqual(report["checked"]["memos"], 1)
+        self.assertGreater(report["checked"]["records"], 2)
+
+        report = self.validate(sample=0.0)
+        self.assertEqual(sum(report["checked"].values()), 0)
+
+    def test_large_dict(self):
+        # dicts above SUM_THRESHOLD are hashed by their entries' sum
+        big = fs.Tree({f"f{i}": self.blob for i in range(cas.SUM_THRESHOLD + 1)})
+        memo.put_memo(cas.sig("big"), cas.store({i: str(i) for i in range(1000)}))
+        memo.put_memo(cas.sig("tree"), cas.store(big))
+        report = self.validate()
+        self.assertTrue(report["ok"], report)
+
+    def test_corrupt(self):
+        record = cas.hsplit(self.res._get_bits())[1].hash
+        cas._cas_db._db.put(record, b"not what it should be" * 2)
+
+        path = self.blob.content_sig.stored_fspath()
+        os.chmod(path, stat.S_IWUSR | stat.S_IRUSR)
+        with open(path, "ab") as f:
+            f.write(b"!")
+
+        report = self.validate()
+        self.assertFalse(report["ok"])
+        errors = {(e["check"], e["id"]) for e in report["errors"]}
+        self.assertIn(("records", record.hex()), errors)
+        self.assertIn(("files", os.path.relpath(path, cas._cas_root)), errors)
+        self.assertIn("trees", {check for (check, _) in errors})
+
+    def test_corrupt_large_dict(self):
+        # the hash doesn't cover the entries, so they're checked by their sum
+        h = cas.store({i: str(i) for i in range(1000)})
+        total, ks, vs = cas.hsplit(h._get_bits())[1:]
+        other = cas.store(["666"] * 1000)
+        cas._cas_db._db.put(h.hash, cas._DICT_SUM.hash + total.hash + ks.hash + other.hash)
+        report = self.validate()
+        self.assertFalse(report["ok"])
+        self.assertIn(
+            ("records", h.hash.hex()), {(e["check"], e["id"]) for e in report["errors"]}
+        )
+
+    def test_missing(self):
+        record = cas.hsplit(self.res._get_bits())[1].hash
+        cas._cas_db.discard_records([record])
+        report = self.validate()
+        self.assertEqual(
+            [e["check"] for e in report["errors"]], ["memos"], report["errors"]
+        )
+
+    def test_resume(self):
+        checkpoint = os.path.join(self.dir.name, "checkpoint.json")
+        state = {
+            "options": {"sample": None, "seed": 0},
+            "phases": {"records": {"checked": 0, "complete": True}},
+            "errors": [],
+            "warnings": [],
+        }
+        with open(checkpoint, "w") as f:
+            json.dump(state, f)
+        report = self.validate(checkpoint=checkpoint)
+        self.assertEqual(report["checked"]["records"], 0)
+        self.assertEqual(report["checked"]["files"], 2)
+        self.assertFalse(os.path.exists(checkpoint))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import unittest
+import config
+import fs
+import cas, cas_gc, watcher
+import os, tempfile, unittest.mock
+
+
+@unittest.skipUnless(watcher.available(), "needs inotify")
+class WatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.root = self.dir.name
+        self.write("a", b"a")
+        self.write("sub/b", b"b")
+        self.write("other/c", b"c")
+        self.w = watcher.Watcher([self.root])
+
+    def tearDown(self):
+        self.w.close()
+        self.dir.cleanup()
+
+    def write(self, rel, data):
+        p = os.path.join(self.root, rel)
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        with open(p, "wb") as f:
+            f.write(data)
+
+    def changed(self, rel, since):
+        return self.w.changed(os.path.join(self.root, rel), since)
+
+    def test_changes(self):
+        g = self.w.generation()
+        self.assertFalse(self.changed("", g))
+        self.write("sub/b", b"changed")
+        g2 = self.w.generation()
+        self.assertGreater(g2, g)
+        for rel in ("sub/b", "sub", ""):
+            self.assertTrue(self.changed(rel, g))
+            self.assertFalse(self.changed(rel, g2))
+        self.assertFalse(self.changed("other", g))
+        self.assertFalse(self.changed("a", g))
+
+    def test_new_dirs(self):
+        self.write("new/deeper/d", b"d")
+        g = self.w.generation()
+        self.assertTrue(self.changed("new", g - 1))
+        self.write("new/deeper/d", b"changed")
+        self.w.generation()
+        self.assertTrue(self.changed("new/deeper", g))
+        self.assertFalse(self.changed("other", g))
+
+    def test_out_of_watches(self):
+        g = self.w.generation()
+        with unittest.mock.patch.object(self.w, "_watch_tree", return_value=False):
+            self.write("new/d", b"d")
+            self.w.generation()
+        self.assertTrue(self.changed("new", g))
+        self.assertTrue(self.changed("other", self.w.generation()))
+
+    def test_symlinks(self):
+        # changes behind a symlink aren't seen
+        outside = tempfile.TemporaryDirectory()
+        self.addCleanup(outside.cleanup)
+        os.symlink(outside.name, os.path.join(self.root, "sub", "link"))
+        g = self.w.generation()
+        for rel in ("sub/link", "sub/link/x", "sub", ""):
+            self.assertTrue(self.changed(rel, g))
+        self.assertFalse(self.changed("other", g))
+
+        # including ones there from the start
+        w = watcher.Watcher([self.root])
+        self.addCleanup(w.close)
+        self.assertTrue(w.changed(os.path.join(self.root, "sub"), w.generation()))
+
+    def test_unknown(self):
+        g = self.w.generation()
+        # from before we started watching, or outside what we watch
+        self.assertTrue(self.changed("", 0))
+        self.assertTrue(self.w.changed(os.path.dirname(self.root), g))
+        # after we missed events
+        self.w._event(-1, watcher.IN_Q_OVERFLOW, "", g + 1)
+        self.assertTrue(self.changed("other", g))
+        self.assertFalse(self.changed("other", self.w.generation()))
+
+
+@unittest.skipUnless(watcher.available(), "needs inotify")
+class WatchedScanTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.dir.name, "src")
+        self.write("a", b"a" * 100)
+        self.write("sub/b", b"b" * 100)
+        self.write("sub/deeper/c", b"c" * 100)
+        self.write("other/d", b"d" * 100)
+        config.init(db_root=self.dir.name, src_root=self.src, watch_files=True)
+
+    def tearDown(self):
+        config.init()
+        self.dir.cleanup()
+
+    def write(self, rel, data):
+        p = os.path.join(self.src, rel)
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        with open(p, "wb") as f:
+            f.write(data)
+
+    def scan(self):
+        # (contents, number of stat calls)
+        with unittest.mock.patch("os.stat", wraps=os.stat) as st:
+            t = fs.src_root.contents()
+        return t, st.call_count
+
+    def test_scan(self):
+        t, _ = self.scan()
+        t2, n = self.scan()
+        self.assertEqual(n, 1)  # just src_root itself
+        self.assertIs(t2, t)
+
+        self.write("sub/deeper/c", b"changed")
+        t3, _ = self.scan()
+        self.assertEqual(t3["sub/deeper/c"].bytes(), b"changed")
+        self.assertIs(t3["other"], t["other"])
+        t4, n = self.scan()
+        self.assertEqual(n, 1)
+        self.assertIs(t4, t3)
+
+        # what a subdirectory's contents() sees is the same Tree
+        self.assertIs((fs.src_root / "sub").contents(), t4["sub"])
+
+        # gc may delete the contents, so everything is looked at again
+        cas_gc.collect()
+        t5, n = self.scan()
+        self.assertGreater(n, 1)
+        self.assertEqual(cas.sig(t5), cas.sig(t4))
+        self.assertEqual(t5["sub/b"].bytes(), b"b" * 100)
+
+    def test_symlink(self):
+        outside = os.path.join(self.dir.name, "outside")
+        os.makedirs(outside)
+        with open(os.path.join(outside, "x"), "wb") as f:
+            f.write(b"x\n")
+        os.symlink(outside, os.path.join(self.src, "sub", "link"))
+        t, _ = self.scan()
+        self.assertEqual(t["sub/link/x"].bytes(), b"x\n")
+        with open(os.path.join(outside, "x"), "wb") as f:
+            f.write(b"CHANGED\n")
+        t2, _ = self.scan()
+        self.assertEqual(t2["sub/link/x"].bytes(), b"CHANGED\n")
+        self.assertIs(t2["other"], t["other"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,24 @@
 #!/usr/bin/env python3
 import argparse, logging, os
-import fs, cas, config
+import fs, cas, cas_gc, config
+
+
+def parse_size(s):
+    # e.g. "500M", "20G"
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    if s[-1:].upper() in units:
+        return int(float(s[:-1]) * units[s[-1].upper()])
+    return int(s)
 
 
 if __name__ == "__main__":
     # logging.basicConfig(level=logging.INFO)
     parser = argparse.ArgumentParser()
     parser.add_argument("command")
-    parser.add_argument("path")
+    parser.add_argument("path", nargs="?")
+    parser.add_argument(
+        "--budget", type=parse_size, help="gc: evict old memo entries to fit this size"
+    )
     args = parser.parse_args()
 
     config.init()
@@ -15,3 +26,7 @@ if __name__ == "__main__":
     if args.command == "hash":
         tree = (fs.src_root / args.path).contents()
         print(cas.sig(tree, False))
+    elif args.command == "gc":
+        print(f"{cas_gc.collect(args.budget)} bytes in use")
+    elif args.command == "repack":
+        cas._cas_db.repack()
@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 from functools import wraps
+import contextlib
 import sys
 import os
 import posixpath
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows
+
 
 def decorator(d):
     """
@@ -98,7 +104,8 @@ class imdict(dict):
     Immutable dictionary type
     """
 
-    __slots__ = "__sig__", "__weakref__"
+    # __sum__, __base__: see "Large dicts" in cas.py
+    __slots__ = "__sig__", "__sum__", "__base__", "__weakref__"
 
     def __hash__(self):
         return hash(frozenset(self.items()))
@@ -110,18 +117,32 @@ class imdict(dict):
         ks = my_ks - set(other)
         if ks == my_ks:
             return self
-        return imdict({k: self[k] for k in ks})
+        return self._derive({k: self[k] for k in ks}, my_ks - ks)
 
     def __and__(self, other):
         other = set(other)
-        return imdict({k: v for (k, v) in self.items() if k in other})
+        return self._derive(
+            {k: v for (k, v) in self.items() if k in other},
+            [k for k in self if k not in other],
+        )
 
     def updated(self, *args, **kwargs):
+        changes = dict(*args, **kwargs)
         temp = dict(self)
-        temp.update(*args, **kwargs)
-        return imdict(temp)
+        temp.update(changes)
+        return self._derive(temp, list(changes))
+
+    def _derive(self, d, changed_keys):
+        # new imdict from d, which differs from self only at changed_keys
+        d = imdict(d)
+        if getattr(self, "__sum__", None) is not None:
+            d.__base__ = (self, changed_keys)
+        return d
 
     __setitem__ = _err_immutable
+    __delitem__ = _err_immutable
+    __ior__ = _err_immutable
+    clear = _err_immutable
     update = _err_immutable
     pop = _err_immutable
     popitem = _err_immutable
@@ -131,10 +152,30 @@ class imdict(dict):
 # Hashable misc. struct class until I decide how to do it properly
 class Struct:
     _ser_fields = ...
+    _cache_sig = True
+
+    # __sig__ is a slot so it doesn't show up as a field
+    __slots__ = "__sig__", "__dict__", "__weakref__"
 
     def __init__(self, **data):
         self.__dict__.update(data)
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name != "__sig__":
+            self._forget_sig()
+
+    def __delattr__(self, name):
+        object.__delattr__(self, name)
+        self._forget_sig()
+
+    def _forget_sig(self):
+        # invalidate the signature cached by cas.sig
+        try:
+            object.__delattr__(self, "__sig__")
+        except AttributeError:
+            pass
+
     def __repr__(self):
         return "".join(
             ["Struct(", *(f"{k}={v!r}" for (k, v) in self.__dict__.items()), ")"]
@@ -171,6 +212,24 @@ else:
     from os import symlink
 
 
+@contextlib.contextmanager
+def file_lock(path, shared=False):
+    """
+    Hold an advisory lock on the file at `path` (created if needed) for the
+    duration of the `with` block, shared or exclusive, between processes.
+    A no-op where there's no `fcntl`.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(path, "ab") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
 def makelink(src, dst, target_is_directory=None):
     if target_is_directory is None:
         target_is_directory = os.path.isdir(src)
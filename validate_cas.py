@@ -1 +1,349 @@
 #!/usr/bin/env python3
+"""
+Integrity checker for a cas_root.
+
+Checks that:
+- every `cas_db` record hashes to its key (see `cas.verify_record`)
+- every file under `blob/`, `xblob/` and `zblob/` hashes to its name (after
+  decompressing, for `zblob/`), with the right mode bits
+- every `tree/` directory holds the entries of the Tree its name is the sig
+  of
+- every memo result resolves: all the records it refers to, transitively,
+  are present
+
+Hashing is spread over a process pool, `jobs` processes (default: one per
+CPU). Progress is saved to a checkpoint file after each batch, so an
+interrupted run picks up where it stopped when run again with the same
+options. `sample` checks only that fraction of everything (chosen by hash, so
+a resumed run picks the same sample), for quick regular runs.
+
+The result is a report dict, also written as JSON by the command line:
+
+    {"ok": bool, "checked": {phase: count}, "errors": [...], "warnings": [...]}
+
+where each error or warning is {"check": phase, "id": hash or path,
+"error": description}. Warnings are things that may be harmless, like stray
+files or a record that looks like a hash but isn't there.
+"""
+import argparse, collections, concurrent.futures, itertools, json, logging
+import multiprocessing, os, stat, sys, zlib
+import cas, cas_gc, config, fs, gitstore, memo
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+def validate(*, jobs=None, sample=None, seed=0, checkpoint=None):
+    """
+    Check the current cas_root (see `config.init`) and return a report.
+    """
+    if checkpoint is None:
+        checkpoint = os.path.join(cas._cas_root, "validate_cas.json")
+    options = {"sample": sample, "seed": seed}
+    state = _load_checkpoint(checkpoint, options)
+
+    def selected(key):
+        if sample is None:
+            return True
+        return zlib.crc32(key, seed) < sample * (1 << 32)
+
+    ctx = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(
+        jobs, mp_context=ctx, initializer=_init_worker, initargs=(dict(config.config),)
+    ) as pool:
+        phases = [
+            ("records", _list_records, _check_records),
+            ("files", _list_files, _check_files),
+            ("trees", _list_trees, _check_trees),
+        ]
+        for (name, lister, check) in phases:
+            items = (x for x in lister() if selected(x.encode() if type(x) is str else x))
+            _run_phase(state, checkpoint, name, items, pool, jobs, check)
+    _check_memos(state, checkpoint, selected)
+
+    os.remove(checkpoint)
+    return {
+        "ok": not state["errors"],
+        "checked": {k: v["checked"] for (k, v) in state["phases"].items()},
+        "errors": state["errors"],
+        "warnings": state["warnings"],
+    }
+
+
+def _load_checkpoint(path, options):
+    try:
+        with open(path) as f:
+            state = json.load(f)
+        if state["options"] == options:
+            logger.info("resuming from %s", path)
+            return state
+    except FileNotFoundError:
+        pass
+    return {"options": options, "phases": {}, "errors": [], "warnings": []}
+
+
+def _save_checkpoint(path, state):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def _run_phase(state, checkpoint, name, items, pool, jobs, check):
+    # check `items` in batches on the pool, saving progress after each batch
+    # (in order, so the checkpoint is just how many items are done)
+    ph = state["phases"].setdefault(
+        name, {"done": 0, "last": None, "checked": 0, "complete": False}
+    )
+    if ph["complete"]:
+        return
+    if ph["done"]:
+        skipped = list(itertools.islice(items, ph["done"]))
+        if not skipped or _key(skipped[-1]) != ph["last"]:
+            # the listing changed since the checkpoint; can't resume
+            raise RuntimeError(f"{checkpoint} is out of date; delete it to start over")
+
+    def finish():
+        batch, fut = pending.popleft()
+        checked, errors, warnings = fut.result()
+        ph["done"] += len(batch)
+        ph["last"] = _key(batch[-1])
+        ph["checked"] += checked
+        state["errors"].extend(errors)
+        state["warnings"].extend(warnings)
+        _save_checkpoint(checkpoint, state)
+
+    pending = collections.deque()
+    window = 2 * (jobs or os.cpu_count() or 1)
+    while True:
+        batch = list(itertools.islice(items, BATCH_SIZE))
+        if not batch:
+            break
+        pending.append((batch, pool.submit(check, batch)))
+        if len(pending) > window:
+            finish()
+    while pending:
+        finish()
+    ph["complete"] = True
+    _save_checkpoint(checkpoint, state)
+
+
+def _key(item):
+    return item if type(item) is str else item.hex()
+
+
+def _problem(check, id, error):
+    return {"check": check, "id": _key(id), "error": error}
+
+
+def _init_worker(cfg):
+    config.init(**cfg)
+
+
+def _list_records():
+    for h in cas._cas_db.record_hashes():
+        if len(h) == cas.HASH_SIZE:
+            yield h
+
+
+def _check_records(hs):
+    errors = []
+    checked = 0
+    for h in hs:
+        bits = cas._cas_db.record(h)
+        if bits is None:
+            continue  # deleted since it was listed
+        checked += 1
+        if not cas.verify_record(h, bits):
+            errors.append(_problem("records", h, "contents don't match hash"))
+    return checked, errors, []
+
+
+def _list_files():
+    # paths relative to cas_root, in a stable order
+    for kind in ("blob", "xblob", "zblob"):
+        yield from _list_dir(kind)
+
+
+def _list_dir(kind):
+    top = os.path.join(cas._cas_root, kind)
+    if not os.path.isdir(top):
+        return
+    for d in sorted(os.listdir(top)):
+        if os.path.isdir(os.path.join(top, d)):
+            for name in sorted(os.listdir(os.path.join(top, d))):
+                yield f"{kind}/{d}/{name}"
+
+
+def _parse_rel(rel):
+    # return hash for a path like blob/ab/cdef..., or None
+    kind, d, name = rel.split("/")
+    try:
+        h = bytes.fromhex(d + name)
+    except ValueError:
+        return None
+    if h[0] & cas.HFLAG_LONG:
+        return h if len(h) == cas.HASH_SIZE else None
+    return h if (h[0] & cas.HFLAG_MASK) == len(h) else None  # short hash
+
+
+def _check_files(rels):
+    errors, warnings = [], []
+    checked = 0
+    for rel in rels:
+        h = _parse_rel(rel)
+        if h is None:
+            warnings.append(_problem("files", rel, "stray file"))
+            continue
+        path = os.path.join(cas._cas_root, rel)
+        compressed = rel.startswith("zblob/")
+        try:
+            mode = os.stat(path).st_mode
+            ok = cas.verify_file(h, path, compressed=compressed)
+        except FileNotFoundError:
+            continue
+        except Exception:
+            ok = False  # e.g. a bad compressed stream
+        checked += 1
+        if not ok:
+            errors.append(_problem("files", rel, "contents don't match hash"))
+        elif not compressed and bool(mode & stat.S_IXUSR) != rel.startswith("xblob/"):
+            errors.append(_problem("files", rel, f"wrong mode 0{mode:o}"))
+    return checked, errors, warnings
+
+
+def _list_trees():
+    yield from _list_dir("tree")
+
+
+def _check_trees(rels):
+    errors, warnings = [], []
+    checked = 0
+    for rel in rels:
+        h = _parse_rel(rel)
+        if h is None:
+            warnings.append(_problem("trees", rel, "stray file"))
+            continue
+        checked += 1
+        try:
+            error = _check_tree(cas.Sig(hash=h), os.path.join(cas._cas_root, rel))
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        if error:
+            errors.append(_problem("trees", rel, error))
+    return checked, errors, warnings
+
+
+def _check_tree(s, path):
+    # return a description of what's wrong with materialized tree `path`, or None
+    if s.hash not in cas._cas_db:
+        # not stored; rebuild it from what's on disk and compare sigs
+        if cas.sig(_read_tree(path)) != s:
+            return "contents don't match hash"
+        return None
+
+    tree = s.object()
+    names = set(os.listdir(path))
+    if names != set(tree._entries):
+        return f"wrong entries: {sorted(names ^ set(tree._entries))}"
+    for (name, v) in tree.items():
+        p = os.path.join(path, name)
+        if isinstance(v, fs.Tree):
+            expected = os.path.realpath(cas.sig(v).get_fspath(kind="tree"))
+            if os.path.realpath(p) != expected:
+                return f"{name}: wrong link"
+        else:
+            mode = os.lstat(p).st_mode
+            if not cas.verify_file(v.content_sig.hash, p):
+                return f"{name}: contents don't match"
+            if bool(mode & stat.S_IXUSR) != isinstance(v, fs.XBlob):
+                return f"{name}: wrong mode 0{mode:o}"
+    return None
+
+
+def _read_tree(path):
+    # Tree of the files in a materialized tree dir
+    entries = {}
+    for e in os.scandir(path):
+        if e.is_symlink():
+            entries[e.name] = _read_tree(os.path.realpath(e.path))
+        else:
+            cls = fs.XBlob if e.stat().st_mode & stat.S_IXUSR else fs.Blob
+            entries[e.name] = cls(content_sig=cas.file_sig(e.path))
+    return fs.Tree(entries)
+
+
+def _check_memos(state, checkpoint, selected):
+    # every memo result must resolve completely; runs in this process, since
+    # it's just lookups
+    ph = state["phases"].setdefault("memos", {"checked": 0, "complete": False})
+    if ph["complete"]:
+        return
+    seen = set()
+    for (arg, res, _) in memo.iter_memos():
+        if not selected(arg):
+            continue
+        ph["checked"] += 1
+        missing, maybe_missing = _missing_refs(res.hash, seen)
+        for h in missing:
+            state["errors"].append(
+                _problem("memos", arg, f"result {_key(res.hash)} can't resolve {_key(h)}")
+            )
+        for h in maybe_missing:
+            state["warnings"].append(
+                _problem("memos", arg, f"result {_key(res.hash)} may be missing {_key(h)}")
+            )
+    ph["complete"] = True
+    _save_checkpoint(checkpoint, state)
+
+
+def _missing_refs(h, seen):
+    # return (missing or unreadable hashes, missing maybe-hashes) reachable
+    # from h
+    missing, maybe_missing = [], []
+    stack = [(h, True)]
+    while stack:
+        h, sure = stack.pop()
+        if not h[0] & cas.HFLAG_LONG or h in seen:
+            continue
+        seen.add(h)
+        bits = cas._cas_db.record(h)
+        if bits is None:
+            if h[0] & cas.HFLAG_COMPOUND or h not in cas._cas_db:
+                (missing if sure else maybe_missing).append(h)
+            continue
+        try:
+            refs = cas_gc.references(h, bits)
+        except AssertionError:
+            missing.append(h)  # garbage where a list of hashes should be
+            continue
+        compound = bool(h[0] & cas.HFLAG_COMPOUND)
+        stack.extend((r, compound) for r in refs)
+    return missing, maybe_missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--jobs", type=int, help="worker processes")
+    parser.add_argument("--sample", type=float, help="fraction of objects to check")
+    parser.add_argument("--seed", type=int, default=0, help="seed for --sample")
+    parser.add_argument("--checkpoint", help="checkpoint file")
+    parser.add_argument("--report", help="write the JSON report here")
+    args = parser.parse_args()
+
+    config.init()
+    report = validate(
+        jobs=args.jobs, sample=args.sample, seed=args.seed, checkpoint=args.checkpoint
+    )
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    sys.exit(0 if report["ok"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""
+Watching source trees for changes with Linux inotify.
+
+Even with the fs sig cache and the directory cache (see `fs._scan_tree`),
+checking that a source tree is unchanged costs a stat per file. With
+`watch_files` in the config, a `Watcher` on src_root instead tells us which
+paths have changed, so a process that scans the same trees over and over
+(e.g. repeated builds) only looks again at what was touched.
+
+Changes are numbered by generation: `generation()` is the current one, and
+`changed(path, since)` says whether anything at or under `path` may have
+changed after generation `since`. It errs towards True: for paths that
+aren't watched, for generations from before watching started, and after the
+kernel's event queue overflowed (when all we know is that we missed
+something). Scans follow symlinks but watches don't, so it's also True for
+anything with a symlink at, in or above it. Nothing is remembered between processes, so a new process always
+starts with a full scan.
+
+inotify is reached through ctypes, so there are no extra dependencies. Where
+it isn't available (not Linux, or out of watches), `watch_files` is ignored.
+"""
+import ctypes, ctypes.util, errno, logging, os, select, struct, threading
+import config
+
+logger = logging.getLogger(__name__)
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+_EVENT = struct.Struct("iIII")  # wd, mask, cookie, name length; then name
+
+_libc = None
+_watcher = None
+
+
+def _inotify():
+    # libc with the inotify functions set up, or None
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        except (OSError, AttributeError):
+            libc = False
+        _libc = libc
+    return _libc or None
+
+
+def available():
+    return _inotify() is not None
+
+
+class Watcher:
+    """
+    Watches the directory trees under `roots` (see the module docstring).
+    Events are read by a background thread, and also on every
+    `generation()` call, so that changes made before it are always counted.
+    """
+
+    def __init__(self, roots):
+        libc = _inotify()
+        if libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._libc = libc
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._lock = threading.RLock()
+        self._gen = 0
+        self._changed = {}  # path -> last generation it or anything under it changed
+        self._wds = {}  # watch descriptor -> directory
+        self._roots = {}  # root -> generation from which changes under it are known
+        self._links = set()  # symlinks seen under the roots
+        self._stop_r, self._stop_w = os.pipe()
+        with self._lock:
+            for root in roots:
+                self._watch_root(os.path.abspath(root))
+        self._thread = threading.Thread(target=self._run, name="watcher", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        os.write(self._stop_w, b"x")
+        self._thread.join()
+        for fd in (self._fd, self._stop_r, self._stop_w):
+            os.close(fd)
+
+    def generation(self):
+        """
+        Return the current generation, counting every change made before
+        the call.
+        """
+        with self._lock:
+            self._read_events()
+            return self._gen
+
+    def changed(self, path, since):
+        """
+        True if anything at or under `path` may have changed after
+        generation `since`.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            root = self._root_of(path)
+            if root is None or since < self._roots[root] or self._linked(path):
+                return True
+            return self._changed.get(path, -1) > since
+
+    def _linked(self, path):
+        # is there a symlink at, under or above path? (we don't see changes
+        # to what it points at)
+        under = path + os.sep
+        return any(
+            link == path or link.startswith(under) or path.startswith(link + os.sep)
+            for link in self._links
+        )
+
+    def _root_of(self, path):
+        for root in self._roots:
+            if path == root or path.startswith(root + os.sep):
+                return root
+        return None
+
+    def _watch_root(self, root):
+        # (holding the lock) changes from before the walk finishes are
+        # unknown, since we may not have been watching yet
+        if self._watch_tree(root):
+            self._gen += 1
+            self._roots[root] = self._gen
+        else:
+            self._roots.pop(root, None)
+
+    def _watch_tree(self, top):
+        # add watches for top and every directory under it, noting symlinks;
+        # False if we ran out of watches
+        stack = [top]
+        while stack:
+            d = stack.pop()
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(d), _MASK)
+            if wd < 0:
+                e = ctypes.get_errno()
+                if e in (errno.ENOENT, errno.ENOTDIR):
+                    continue  # gone already; its parent's events cover it
+                logger.warning("can't watch %s: %s; watching less", d, os.strerror(e))
+                return False
+            self._wds[wd] = d
+            try:
+                entries = list(os.scandir(d))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for e in entries:
+                if e.is_symlink():
+                    self._links.add(e.path)
+                elif e.is_dir():
+                    stack.append(e.path)
+        return True
+
+    def _unwatch_tree(self, top):
+        for (wd, d) in list(self._wds.items()):
+            if d == top or d.startswith(top + os.sep):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._wds[wd]
+
+    def _run(self):
+        while True:
+            ready, _, _ = select.select([self._fd, self._stop_r], [], [])
+            if self._stop_r in ready:
+                return
+            with self._lock:
+                self._read_events()
+
+    def _read_events(self):
+        # (holding the lock) process everything in the queue as one
+        # generation
+        gen = self._gen + 1
+        seen = False
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            seen = True
+            i = 0
+            while i < len(data):
+                wd, mask, _, n = _EVENT.unpack_from(data, i)
+                name = data[i + _EVENT.size : i + _EVENT.size + n].rstrip(b"\0")
+                i += _EVENT.size + n
+                self._event(wd, mask, os.fsdecode(name), gen)
+        if seen:
+            self._gen = gen
+
+    def _event(self, wd, mask, name, gen):
+        if mask & IN_Q_OVERFLOW:
+            # we missed events, so we know nothing about anything before now;
+            # we may also have missed new directories, so look again
+            logger.warning("inotify queue overflowed; rescanning watches")
+            for root in list(self._roots):
+                self._watch_root(root)
+            return
+        d = self._wds.get(wd)
+        if d is None:
+            return
+        if mask & IN_IGNORED:
+            del self._wds[wd]
+            return
+        path = os.path.join(d, name) if name else d
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            if not self._watch_tree(path):
+                # we won't see changes in there, so stop answering for the
+                # whole root
+                root = self._root_of(path)
+                if root is not None:
+                    del self._roots[root]
+                    self._unwatch_tree(root)
+                return
+        elif mask & (IN_CREATE | IN_MOVED_TO) and os.path.islink(path):
+            self._links.add(path)
+        elif mask & IN_MOVE_SELF:
+            self._unwatch_tree(d)  # we don't know where it went
+        self._mark(path, gen)
+
+    def _mark(self, path, gen):
+        # record a change at path, and so under each of its parents
+        root = self._root_of(path)
+        if root is None:
+            return
+        while True:
+            self._changed[path] = gen
+            if path == root:
+                return
+            path = os.path.dirname(path)
+
+
+def current():
+    """
+    The Watcher for src_root, or None if `watch_files` is off.
+    """
+    return _watcher
+
+
+class _Closer:
+    def __init__(self, w):
+        self.watcher = w
+
+    def close(self):
+        global _watcher
+        _watcher = None
+        if self.watcher is not None:
+            self.watcher.close()
+
+
+@config.oninit
+def init(src_root, watch_files=False, **_):
+    global _watcher
+    if watch_files and available() and os.path.isdir(src_root):
+        _watcher = Watcher([src_root])
+    return _Closer(_watcher)